@@ -1,4 +1,4 @@
-import asyncio
+import base64
 import os
 import threading
 import time
@@ -22,29 +22,34 @@ except:
 
 import uvicorn
 from PIL import Image
-from fastapi import APIRouter, FastAPI, Request, UploadFile
+from fastapi import APIRouter, FastAPI, Form, Request, UploadFile
 from fastapi.encoders import jsonable_encoder
-from fastapi.exceptions import HTTPException
+from fastapi.exceptions import HTTPException, RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from loguru import logger
-from socketio import AsyncServer
+from pydantic import ValidationError
 
 from iopaint.file_manager import FileManager
+from iopaint.image_store import ImageStore, StoredImage
+from iopaint.job_queue import JobQueue, QueueFullError, Job
 from iopaint.helper import (
     load_img,
     decode_base64_to_image,
+    decode_image_file,
     pil_to_bytes,
     numpy_to_bytes,
     concat_alpha_channel,
     gen_frontend_mask,
     adjust_mask,
 )
+from iopaint.metrics import metric_labels, registry, size_bucket, span
 from iopaint.model.utils import torch_gc
 from iopaint.model_manager import ModelManager
+from iopaint.progress import ProgressBus, progress_job
 from iopaint.plugins import build_plugins, RealESRGANUpscaler, InteractiveSeg
-from iopaint.plugins.base_plugin import BasePlugin
+from iopaint.plugins.base_plugin import BasePlugin, ImageNotCachedError
 from iopaint.plugins.remove_bg import RemoveBG
 from iopaint.api_auth import router as auth_router
 from iopaint.supabase_client import is_supabase_enabled
@@ -55,6 +60,10 @@ from iopaint.schema import (
     SwitchModelRequest,
     InpaintRequest,
     RunPluginRequest,
+    RunPluginBatchRequest,
+    RunPluginBatchResponse,
+    RunPluginImageBatchRequest,
+    RunPluginImageBatchResponse,
     SDSampler,
     PluginInfo,
     AdjustMaskRequest,
@@ -63,6 +72,11 @@ from iopaint.schema import (
     ModelInfo,
     InteractiveSegModel,
     RealESRGANModel,
+    JobInfo,
+    JobStatus,
+    ImageInfo,
+    ModelType,
+    HDStrategy,
 )
 
 CURRENT_DIR = Path(__file__).parent.absolute().resolve()
@@ -106,7 +120,9 @@ def api_middleware(app: FastAPI):
             else:
                 traceback.print_exc()
         return JSONResponse(
-            status_code=vars(e).get("status_code", 500), content=jsonable_encoder(err)
+            status_code=vars(e).get("status_code", 500),
+            content=jsonable_encoder(err),
+            headers=vars(e).get("headers", None),
         )
 
     @app.middleware("http")
@@ -129,21 +145,26 @@ def api_middleware(app: FastAPI):
         "allow_headers": ["*"],
         "allow_origins": ["*"],
         "allow_credentials": True,
-        "expose_headers": ["X-Seed"],
+        "expose_headers": [
+            "X-Seed",
+            "X-Job-Id",
+            "X-Queue-Time",
+            "X-Process-Time",
+            "X-Image-Id",
+        ],
     }
     app.add_middleware(CORSMiddleware, **cors_options)
 
 
-global_sio: AsyncServer = None
+global_progress_bus = ProgressBus()
 
 
 def diffuser_callback(pipe, step: int, timestep: int, callback_kwargs: Dict = {}):
     # self: DiffusionPipeline, step: int, timestep: int, callback_kwargs: Dict
     # logger.info(f"diffusion callback: step={step}, timestep={timestep}")
 
-    # We use asyncio loos for task processing. Perhaps in the future, we can add a processing queue similar to InvokeAI,
-    # but for now let's just start a separate event loop. It shouldn't make a difference for single person use
-    asyncio.run(global_sio.emit("diffusion_progress", {"step": step}))
+    # runs in the inference thread, the event is sent by the server event loop
+    global_progress_bus.publish("diffusion_progress", {"step": step})
     return {}
 
 
@@ -158,6 +179,15 @@ class Api:
         self.file_manager = self._build_file_manager()
         self.plugins = self._build_plugins()
         self.model_manager = self._build_model_manager()
+        self.image_store = ImageStore(
+            int(config.image_store_mb * 1024 * 1024),
+            config.image_store_dir,
+            spill_max_size=int(config.image_store_dir_mb * 1024 * 1024),
+        )
+        self.job_queue = JobQueue(
+            num_workers=self.config.inpaint_workers,
+            max_size=self.config.max_queue_size,
+        )
 
         # fmt: off
         self.add_api_route("/api/v1/gen-info", self.api_geninfo, methods=["POST"], response_model=GenInfoResponse)
@@ -167,20 +197,34 @@ class Api:
         self.add_api_route("/api/v1/model", self.api_switch_model, methods=["POST"], response_model=ModelInfo)
         self.add_api_route("/api/v1/inputimage", self.api_input_image, methods=["GET"])
         self.add_api_route("/api/v1/inpaint", self.api_inpaint, methods=["POST"])
+        self.add_api_route("/api/v1/inpaint_binary", self.api_inpaint_binary, methods=["POST"])
+        self.add_api_route("/api/v1/jobs/inpaint", self.api_submit_inpaint_job, methods=["POST"], response_model=JobInfo)
+        self.add_api_route("/api/v1/jobs/inpaint_binary", self.api_submit_inpaint_binary_job, methods=["POST"], response_model=JobInfo)
+        self.add_api_route("/api/v1/jobs/{job_id}", self.api_job_info, methods=["GET"], response_model=JobInfo)
+        self.add_api_route("/api/v1/jobs/{job_id}/result", self.api_job_result, methods=["GET"])
+        self.add_api_route("/api/v1/jobs/{job_id}", self.api_cancel_job, methods=["DELETE"], response_model=JobInfo)
+        self.add_api_route("/api/v1/images", self.api_upload_image, methods=["POST"], response_model=ImageInfo)
+        self.add_api_route("/api/v1/images/{image_id}", self.api_delete_image, methods=["DELETE"])
         self.add_api_route("/api/v1/switch_plugin_model", self.api_switch_plugin_model, methods=["POST"])
         self.add_api_route("/api/v1/run_plugin_gen_mask", self.api_run_plugin_gen_mask, methods=["POST"])
         self.add_api_route("/api/v1/run_plugin_gen_image", self.api_run_plugin_gen_image, methods=["POST"])
+        self.add_api_route("/api/v1/run_plugin_gen_mask_batch", self.api_run_plugin_gen_mask_batch, methods=["POST"],
+                           response_model=RunPluginBatchResponse)
+        self.add_api_route("/api/v1/run_plugin_gen_image_batch", self.api_run_plugin_gen_image_batch, methods=["POST"],
+                           response_model=RunPluginImageBatchResponse)
         self.add_api_route("/api/v1/samplers", self.api_samplers, methods=["GET"])
         self.add_api_route("/api/v1/adjust_mask", self.api_adjust_mask, methods=["POST"])
         self.add_api_route("/api/v1/save_image", self.api_save_image, methods=["POST"])
+        self.add_api_route("/metrics", self.api_metrics, methods=["GET"])
         self.app.mount("/", StaticFiles(directory=WEB_APP_DIR, html=True), name="assets")
         # fmt: on
 
-        global global_sio
         self.sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
         self.combined_asgi_app = socketio.ASGIApp(self.sio, self.app)
         self.app.mount("/ws", self.combined_asgi_app)
-        global_sio = self.sio
+        self.progress_bus = global_progress_bus
+        self.progress_bus.sio = self.sio
+        self.sio.on("connect", self.progress_bus.on_connect)
 
     def add_api_route(self, path: str, endpoint, **kwargs):
         return self.app.add_api_route(path, endpoint, **kwargs)
@@ -210,7 +254,8 @@ class Api:
     def api_switch_model(self, req: SwitchModelRequest) -> ModelInfo:
         if req.name == self.model_manager.name:
             return self.model_manager.current_model
-        self.model_manager.switch(req.name)
+        with self.queue_lock, self.job_queue.exclusive():
+            self.model_manager.switch(req.name)
         return self.model_manager.current_model
 
     def api_switch_plugin_model(self, req: SwitchPluginModelRequest):
@@ -271,39 +316,255 @@ class Api:
         return GenInfoResponse(prompt=prompt, negative_prompt=negative_prompt)
 
     def api_inpaint(self, req: InpaintRequest):
-        image, alpha_channel, infos, ext = decode_base64_to_image(req.image)
-        mask, _, _, _ = decode_base64_to_image(req.mask, gray=True)
+        with span("response") as labels:
+            job = self._submit_inpaint_job(req)
+            job.wait()
+            labels.update(job.labels)
+            return self._job_response(job)
+
+    def api_inpaint_binary(
+        self,
+        mask: UploadFile,
+        image: Optional[UploadFile] = None,
+        config: str = Form(
+            "{}", description="InpaintRequest in json, without image and mask"
+        ),
+    ):
+        """Same as /api/v1/inpaint, image and mask are sent as multipart files
+        instead of base64 strings"""
+        with span("response") as labels:
+            job = self._submit_inpaint_binary_job(image, mask, config)
+            job.wait()
+            labels.update(job.labels)
+            return self._job_response(job)
+
+    def api_submit_inpaint_job(self, req: InpaintRequest) -> JobInfo:
+        job = self._submit_inpaint_job(req)
+        return self.job_queue.info(job)
+
+    def api_submit_inpaint_binary_job(
+        self,
+        mask: UploadFile,
+        image: Optional[UploadFile] = None,
+        config: str = Form(
+            "{}", description="InpaintRequest in json, without image and mask"
+        ),
+    ) -> JobInfo:
+        job = self._submit_inpaint_binary_job(image, mask, config)
+        return self.job_queue.info(job)
+
+    def api_upload_image(self, image: UploadFile) -> ImageInfo:
+        """Decode the image once and keep it, later requests send its id instead
+        of the image"""
+        with span("decode"):
+            rgb_np_img, alpha_channel, infos, ext = decode_image_file(image.file)
+        image_id = self.image_store.put(
+            StoredImage(rgb_np_img, alpha_channel, infos, ext)
+        )
+        height, width = rgb_np_img.shape[:2]
+        return ImageInfo(id=image_id, width=width, height=height)
+
+    def api_delete_image(self, image_id: str):
+        if not self.image_store.delete(image_id):
+            raise HTTPException(status_code=404, detail=f"Image {image_id} not found")
+
+    def api_job_info(self, job_id: str) -> JobInfo:
+        return self.job_queue.info(self._get_job(job_id))
+
+    def api_job_result(self, job_id: str):
+        job = self._get_job(job_id)
+        if not job.done:
+            raise HTTPException(
+                status_code=409, detail=f"Job {job_id} is {job.status.value}"
+            )
+        return self._job_response(job)
+
+    def api_cancel_job(self, job_id: str) -> JobInfo:
+        job = self._get_job(job_id)
+        if not self.job_queue.cancel(job_id) and not job.done:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Job {job_id} is {job.status.value}, can not be cancelled",
+            )
+        return self.job_queue.info(job)
+
+    def _get_job(self, job_id: str) -> Job:
+        job = self.job_queue.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+        return job
+
+    def _job_response(self, job: Job) -> Response:
+        if job.status == JobStatus.failed:
+            raise job.exception
+        if job.status == JobStatus.cancelled:
+            raise HTTPException(status_code=410, detail=f"Job {job.id} cancelled")
+        res_img_bytes, ext, seed, image_id = job.result
+        headers = {
+            "X-Seed": str(seed),
+            "X-Job-Id": job.id,
+            "X-Queue-Time": f"{job.queue_time_ms:.2f}",
+            "X-Process-Time": f"{job.run_time_ms:.2f}",
+        }
+        if image_id is not None:
+            headers["X-Image-Id"] = image_id
+        return Response(
+            content=res_img_bytes, media_type=f"image/{ext}", headers=headers
+        )
+
+    def _job_priority(self, req: InpaintRequest) -> int:
+        # cheap erase models should not wait behind a burst of diffusion jobs
+        model_info = self.model_manager.current_model
+        if req.model:
+            model_info = self.model_manager.available_models[req.model]
+        if model_info.model_type == ModelType.INPAINT:
+            return 0
+        return 1
+
+    def _check_routed_model(self, req: InpaintRequest):
+        if not req.model or req.model == self.model_manager.name:
+            return
+        if req.model not in self.model_manager.available_models:
+            raise HTTPException(status_code=422, detail=f"Model {req.model} not found")
+        if req.enable_controlnet or req.enable_brushnet or req.enable_powerpaint_v2:
+            raise HTTPException(
+                status_code=422,
+                detail="ControlNet/BrushNet/PowerPaint v2 are only available for the current model",
+            )
+
+    def _submit_inpaint_job(self, req: InpaintRequest) -> Job:
+        self._check_routed_model(req)
+        with span("decode", **self._inpaint_labels(req)) as labels:
+            image, alpha_channel, infos, ext = self._decode_image(
+                req.image, req.image_id
+            )
+            mask, _, _, _ = decode_base64_to_image(req.mask, gray=True)
+            labels["size"] = size_bucket(*image.shape[:2])
+        return self._submit_decoded_inpaint_job(
+            req, image, mask, alpha_channel, infos, ext
+        )
+
+    def _submit_inpaint_binary_job(
+        self, image: Optional[UploadFile], mask: UploadFile, config: str
+    ) -> Job:
+        try:
+            req = InpaintRequest.model_validate_json(config)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        self._check_routed_model(req)
+        # decode straight from the uploaded file, no base64 or extra copy
+        with span("decode", **self._inpaint_labels(req)) as labels:
+            if image is not None:
+                image, alpha_channel, infos, ext = decode_image_file(image.file)
+            else:
+                image, alpha_channel, infos, ext = self._decode_image(
+                    None, req.image_id
+                )
+            mask, _, _, _ = decode_image_file(mask.file, gray=True)
+            labels["size"] = size_bucket(*image.shape[:2])
+        return self._submit_decoded_inpaint_job(
+            req, image, mask, alpha_channel, infos, ext
+        )
+
+    def _submit_decoded_inpaint_job(
+        self, req: InpaintRequest, image, mask, alpha_channel, infos, ext
+    ) -> Job:
         logger.info(f"image ext: {ext}")
 
-        mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
+        labels = self._inpaint_labels(req, image)
+        with span("threshold", **labels):
+            mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
         if image.shape[:2] != mask.shape[:2]:
             raise HTTPException(
                 400,
                 detail=f"Image size({image.shape[:2]}) and mask size({mask.shape[:2]}) not match.",
             )
 
+        prev_mask = None
+        if req.incremental and not req.image and req.image_id:
+            prev_mask = self.image_store.get_mask(req.image_id)
+
+        def run(job: Job):
+            with progress_job(job.id), metric_labels(**labels):
+                return self._inpaint(
+                    image, mask, alpha_channel, infos, ext, req, prev_mask
+                )
+
+        try:
+            job = self.job_queue.submit(run, priority=self._job_priority(req))
+        except QueueFullError as e:
+            raise HTTPException(
+                status_code=429,
+                detail=str(e),
+                headers={"Retry-After": str(e.retry_after)},
+            )
+        job.labels = labels
+        return job
+
+    def _decode_image(self, image: Optional[str], image_id: Optional[str]):
+        """Decode the base64 image, or take it from the image store if it is empty"""
+        if image:
+            return decode_base64_to_image(image)
+        if not image_id:
+            raise HTTPException(status_code=422, detail="image or image_id is required")
+        stored = self.image_store.get(image_id)
+        if stored is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Image {image_id} not found, upload the image again",
+            )
+        return stored.image, stored.alpha_channel, stored.infos, stored.ext
+
+    def _inpaint_labels(self, req: InpaintRequest, image=None) -> Dict[str, str]:
+        labels = dict(
+            model=req.model or self.model_manager.name,
+            strategy=HDStrategy(req.hd_strategy).value,
+        )
+        if image is not None:
+            labels["size"] = size_bucket(*image.shape[:2])
+        return labels
+
+    def _inpaint(
+        self,
+        image,
+        mask,
+        alpha_channel,
+        infos,
+        ext,
+        req: InpaintRequest,
+        prev_mask=None,
+    ):
         start = time.time()
-        rgb_np_img = self.model_manager(image, mask, req)
+        with span("inpaint"):
+            if prev_mask is not None:
+                rgb_np_img = self.model_manager(image, mask, req, prev_mask=prev_mask)
+            else:
+                rgb_np_img = self.model_manager(image, mask, req)
         logger.info(f"process time: {(time.time() - start) * 1000:.2f}ms")
         torch_gc()
 
-        rgb_np_img = cv2.cvtColor(rgb_np_img.astype(np.uint8), cv2.COLOR_BGR2RGB)
-        rgb_res = concat_alpha_channel(rgb_np_img, alpha_channel)
+        with span("encode"):
+            rgb_np_img = cv2.cvtColor(rgb_np_img.astype(np.uint8), cv2.COLOR_BGR2RGB)
+            rgb_res = concat_alpha_channel(rgb_np_img, alpha_channel)
 
-        res_img_bytes = pil_to_bytes(
-            Image.fromarray(rgb_res),
-            ext=ext,
-            quality=self.config.quality,
-            infos=infos,
-        )
+            res_img_bytes = pil_to_bytes(
+                Image.fromarray(rgb_res),
+                ext=ext,
+                quality=self.config.quality,
+                infos=infos,
+            )
 
-        asyncio.run(self.sio.emit("diffusion_finish"))
+        image_id = None
+        if req.store_result or req.incremental:
+            # next edit of the result can refer to it instead of uploading it
+            if prev_mask is not None and prev_mask.shape == mask.shape:
+                mask = np.maximum(mask, prev_mask)
+            image_id = self.image_store.put(
+                StoredImage(rgb_np_img, alpha_channel, infos, ext, mask)
+            )
 
-        return Response(
-            content=res_img_bytes,
-            media_type=f"image/{ext}",
-            headers={"X-Seed": str(req.sd_seed)},
-        )
+        self.progress_bus.publish("diffusion_finish", final=True)
+        return res_img_bytes, ext, req.sd_seed, image_id
 
     def api_run_plugin_gen_image(self, req: RunPluginRequest):
         ext = "png"
@@ -313,25 +574,38 @@ class Api:
             raise HTTPException(
                 status_code=422, detail="Plugin does not support output image"
             )
-        rgb_np_img, alpha_channel, infos, _ = decode_base64_to_image(req.image)
-        bgr_or_rgba_np_img = self.plugins[req.name].gen_image(rgb_np_img, req)
-        torch_gc()
-
-        if bgr_or_rgba_np_img.shape[2] == 4:
-            rgba_np_img = bgr_or_rgba_np_img
-        else:
-            rgba_np_img = cv2.cvtColor(bgr_or_rgba_np_img, cv2.COLOR_BGR2RGB)
-            rgba_np_img = concat_alpha_channel(rgba_np_img, alpha_channel)
-
-        return Response(
-            content=pil_to_bytes(
-                Image.fromarray(rgba_np_img),
-                ext=ext,
-                quality=self.config.quality,
-                infos=infos,
-            ),
-            media_type=f"image/{ext}",
-        )
+        with span("response", plugin=req.name) as labels:
+            with span("decode", plugin=req.name) as decode_labels:
+                rgb_np_img, alpha_channel, infos, _ = self._decode_image(
+                    req.image, req.image_id
+                )
+                decode_labels["size"] = size_bucket(*rgb_np_img.shape[:2])
+            labels["size"] = decode_labels["size"]
+            with metric_labels(**labels):
+                plugin = self.plugins[req.name]
+                input_np_img = rgb_np_img
+                if alpha_channel is not None and plugin.support_alpha_channel:
+                    input_np_img = concat_alpha_channel(rgb_np_img, alpha_channel)
+                with span("forward"):
+                    bgr_or_rgba_np_img = plugin.gen_image(input_np_img, req)
+                torch_gc()
+
+                with span("encode"):
+                    if bgr_or_rgba_np_img.shape[2] == 4:
+                        rgba_np_img = bgr_or_rgba_np_img
+                    else:
+                        rgba_np_img = cv2.cvtColor(
+                            bgr_or_rgba_np_img, cv2.COLOR_BGR2RGB
+                        )
+                        rgba_np_img = concat_alpha_channel(rgba_np_img, alpha_channel)
+                    content = pil_to_bytes(
+                        Image.fromarray(rgba_np_img),
+                        ext=ext,
+                        quality=self.config.quality,
+                        infos=infos,
+                    )
+
+            return Response(content=content, media_type=f"image/{ext}")
 
     def api_run_plugin_gen_mask(self, req: RunPluginRequest):
         if req.name not in self.plugins:
@@ -340,14 +614,89 @@ class Api:
             raise HTTPException(
                 status_code=422, detail="Plugin does not support output image"
             )
-        rgb_np_img, _, _, _ = decode_base64_to_image(req.image)
-        bgr_or_gray_mask = self.plugins[req.name].gen_mask(rgb_np_img, req)
-        torch_gc()
-        res_mask = gen_frontend_mask(bgr_or_gray_mask)
-        return Response(
-            content=numpy_to_bytes(res_mask, "png"),
-            media_type="image/png",
-        )
+        plugin = self.plugins[req.name]
+        with span("response", plugin=req.name) as labels:
+            rgb_np_img = None
+            # plugins like InteractiveSeg may only need the id of an image seen before
+            if req.image or not (req.image_id and plugin.is_image_cached(req.image_id)):
+                with span("decode", plugin=req.name) as decode_labels:
+                    rgb_np_img, _, _, _ = self._decode_image(req.image, req.image_id)
+                    decode_labels["size"] = size_bucket(*rgb_np_img.shape[:2])
+                labels["size"] = decode_labels["size"]
+            with metric_labels(**labels):
+                with span("forward"):
+                    try:
+                        bgr_or_gray_mask = plugin.gen_mask(rgb_np_img, req)
+                    except ImageNotCachedError:
+                        # evicted after the is_image_cached check
+                        rgb_np_img, _, _, _ = self._decode_image(None, req.image_id)
+                        bgr_or_gray_mask = plugin.gen_mask(rgb_np_img, req)
+                torch_gc()
+                with span("encode"):
+                    res_mask = gen_frontend_mask(bgr_or_gray_mask)
+                    content = numpy_to_bytes(res_mask, "png")
+            headers = {}
+            if req.image_id:
+                headers["X-Image-Id"] = req.image_id
+            return Response(content=content, media_type="image/png", headers=headers)
+
+    def api_run_plugin_gen_mask_batch(
+        self, req: RunPluginBatchRequest
+    ) -> RunPluginBatchResponse:
+        """Masks of many images and prompts (clicks and/or box) in one call, for
+        auto-masking jobs"""
+        if req.name not in self.plugins:
+            raise HTTPException(status_code=422, detail="Plugin not found")
+        plugin = self.plugins[req.name]
+        if not plugin.support_gen_mask_batch:
+            raise HTTPException(
+                status_code=422, detail="Plugin does not support batch mask output"
+            )
+        with metric_labels(plugin=req.name):
+            with span("decode"):
+                rgb_np_imgs = [
+                    decode_base64_to_image(it.image)[0] for it in req.items
+                ]
+            with span("forward"):
+                masks = plugin.gen_mask_batch(
+                    rgb_np_imgs, [it.prompts for it in req.items]
+                )
+            torch_gc()
+            with span("encode"):
+                masks = [
+                    [
+                        base64.b64encode(numpy_to_bytes(mask, "png")).decode()
+                        for mask in image_masks
+                    ]
+                    for image_masks in masks
+                ]
+        return RunPluginBatchResponse(masks=masks)
+
+    def api_run_plugin_gen_image_batch(
+        self, req: RunPluginImageBatchRequest
+    ) -> RunPluginImageBatchResponse:
+        """Output images of many images in one call, for background removal jobs"""
+        if req.name not in self.plugins:
+            raise HTTPException(status_code=422, detail="Plugin not found")
+        plugin = self.plugins[req.name]
+        if not plugin.support_gen_image_batch:
+            raise HTTPException(
+                status_code=422, detail="Plugin does not support batch image output"
+            )
+        with metric_labels(plugin=req.name):
+            with span("decode"):
+                rgb_np_imgs = [decode_base64_to_image(it)[0] for it in req.images]
+            with span("forward"):
+                rgba_np_imgs = plugin.gen_image_batch(rgb_np_imgs)
+            torch_gc()
+            with span("encode"):
+                images = [
+                    base64.b64encode(
+                        numpy_to_bytes(cv2.cvtColor(it, cv2.COLOR_RGBA2BGRA), "png")
+                    ).decode()
+                    for it in rgba_np_imgs
+                ]
+        return RunPluginImageBatchResponse(images=images)
 
     def api_samplers(self) -> List[str]:
         return [member.value for member in SDSampler.__members__.values()]
@@ -357,6 +706,12 @@ class Api:
         mask = adjust_mask(mask, req.kernel_size, req.operate)
         return Response(content=numpy_to_bytes(mask, "png"), media_type="image/png")
 
+    def api_metrics(self):
+        """Latency histograms in the Prometheus text format"""
+        return Response(
+            content=registry.render(), media_type="text/plain; version=0.0.4"
+        )
+
     def launch(self):
         self.app.include_router(self.router)
         # Include auth router if Supabase is enabled
@@ -393,6 +748,7 @@ class Api:
             self.config.remove_bg_device,
             self.config.remove_bg_model,
             self.config.enable_anime_seg,
+            self.config.anime_seg_device,
             self.config.enable_realesrgan,
             self.config.realesrgan_device,
             self.config.realesrgan_model,
@@ -413,5 +769,9 @@ class Api:
             sd_cpu_textencoder=self.config.cpu_textencoder,
             local_files_only=self.config.local_files_only,
             cpu_offload=self.config.cpu_offload,
+            erase_batch_size=self.config.erase_batch_size,
+            erase_batch_wait_ms=self.config.erase_batch_wait_ms,
+            model_cache_vram_gb=self.config.model_cache_vram_gb,
+            model_cache_ram_gb=self.config.model_cache_ram_gb,
             callback=diffuser_callback,
         )
@@ -1,9 +1,20 @@
+import hashlib
+import io
+import itertools
 import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
+import torch
 from PIL import Image
 from loguru import logger
 from rich.console import Console
@@ -35,6 +46,41 @@ def glob_images(path: Path) -> Dict[str, Path]:
         return res
 
 
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """Parse "i/N" into (i, N), 0 <= i < N"""
+    try:
+        index, count = [int(it) for it in shard.split("/")]
+    except ValueError:
+        raise ValueError(f"invalid shard: {shard}, expected i/N, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"invalid shard: {shard}, expected 0 <= i < N")
+    return index, count
+
+
+def in_shard(stem: str, index: int, count: int) -> bool:
+    # stable across processes and machines, unlike hash()
+    return int(hashlib.md5(stem.encode("utf-8")).hexdigest(), 16) % count == index
+
+
+def load_manifest(path: Path) -> Dict[str, Dict]:
+    """Last record of every image in a JSONL manifest"""
+    records = {}
+    if not path.exists():
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # partially written line of a crashed run
+                continue
+            records[record["stem"]] = record
+    return records
+
+
 def batch_inpaint(
     model: str,
     device,
@@ -43,12 +89,27 @@ def batch_inpaint(
     output: Path,
     config: Optional[Path] = None,
     concat: bool = False,
+    prefetch: int = 4,
+    prefetch_workers: int = 2,
+    write_workers: int = 2,
+    shard: Optional[str] = None,
+    resume: bool = False,
+    manifest: Optional[Path] = None,
+    workers: int = 1,
+    worker_threads: Optional[int] = None,
 ):
     if image.is_dir() and output.is_file():
         logger.error(
             "invalid --output: when image is a directory, output should be a directory"
         )
         exit(-1)
+    if workers > 1:
+        if torch.device(device).type != "cpu":
+            logger.error("invalid --workers: multiple workers only support cpu device")
+            exit(-1)
+        if "fork" not in multiprocessing.get_all_start_methods():
+            logger.error("invalid --workers: multiple workers need fork support")
+            exit(-1)
     output.mkdir(parents=True, exist_ok=True)
 
     image_paths = glob_images(image)
@@ -63,15 +124,35 @@ def batch_inpaint(
     if config is None:
         inpaint_request = InpaintRequest()
         logger.info(f"Using default config: {inpaint_request}")
+        config_bytes = b""
     else:
-        with open(config, "r", encoding="utf-8") as f:
-            inpaint_request = InpaintRequest(**json.load(f))
+        config_bytes = config.read_bytes()
+        inpaint_request = InpaintRequest(**json.loads(config_bytes))
         logger.info(f"Using config: {inpaint_request}")
 
+    if shard is not None:
+        try:
+            shard_index, shard_count = parse_shard(shard)
+        except ValueError as e:
+            logger.error(f"invalid --shard: {e}")
+            exit(-1)
+        image_paths = {
+            stem: p
+            for stem, p in image_paths.items()
+            if in_shard(stem, shard_index, shard_count)
+        }
+        logger.info(f"Shard {shard}: {len(image_paths)} images")
+
+    records = load_manifest(manifest) if manifest is not None and resume else {}
+    manifest_f = open(manifest, "a", encoding="utf-8") if manifest else None
+
+    # with multiple workers, the model is loaded before the workers are forked,
+    # so they share its weights copy-on-write
     model_manager = ModelManager(name=model, device=device)
     first_mask = list(mask_paths.values())[0]
 
     console = Console()
+    failed = 0
 
     with Progress(
         SpinnerColumn(),
@@ -84,45 +165,308 @@ def batch_inpaint(
         transient=False,
     ) as progress:
         task = progress.add_task("Batch processing...", total=len(image_paths))
+        items = []
         for stem, image_p in image_paths.items():
             if stem not in mask_paths and mask.is_dir():
                 progress.log(f"mask for {image_p} not found")
                 progress.update(task, advance=1)
                 continue
-            mask_p = mask_paths.get(stem, first_mask)
+            items.append(
+                (stem, image_p, mask_paths.get(stem, first_mask), output / f"{stem}.png")
+            )
 
-            infos = Image.open(image_p).info
+        def load(stem, image_p, mask_p, save_p):
+            return _load_item(
+                stem, image_p, mask_p, save_p, config_bytes, resume, records.get(stem)
+            )
 
-            img = np.array(Image.open(image_p).convert("RGB"))
-            mask_img = np.array(Image.open(mask_p).convert("L"))
+        def finish(record: Dict):
+            nonlocal failed
+            if record["status"] == "failed":
+                failed += 1
+                progress.log(f"{record['stem']} failed: {record['error']}")
+            if manifest_f is not None:
+                manifest_f.write(json.dumps(record) + "\n")
+                manifest_f.flush()
+            progress.update(task, advance=1)
 
-            if mask_img.shape[:2] != img.shape[:2]:
-                progress.log(
-                    f"resize mask {mask_p.name} to image {image_p.name} size: {img.shape[:2]}"
-                )
-                mask_img = cv2.resize(
-                    mask_img,
-                    (img.shape[1], img.shape[0]),
-                    interpolation=cv2.INTER_NEAREST,
+        if workers > 1:
+            for record, message in _run_workers(
+                model_manager,
+                items,
+                workers,
+                worker_threads,
+                inpaint_request,
+                concat,
+                config_bytes,
+                resume,
+                records,
+            ):
+                if message:
+                    progress.log(message)
+                finish(record)
+        else:
+            # decode next images while the model is running, encode and write
+            # results in another pool, both stages are bounded
+            with ThreadPoolExecutor(
+                prefetch_workers, thread_name_prefix="batch-load"
+            ) as load_pool, ThreadPoolExecutor(
+                write_workers, thread_name_prefix="batch-write"
+            ) as write_pool:
+                loading = deque()
+                writing = deque()
+                items = iter(items)
+                for it in itertools.islice(items, prefetch):
+                    loading.append(load_pool.submit(load, *it))
+
+                while loading:
+                    item = loading.popleft().result()
+                    for it in itertools.islice(items, 1):
+                        loading.append(load_pool.submit(load, *it))
+                    if item.get("message"):
+                        progress.log(item["message"])
+                    if item["record"]["status"] != "ok":
+                        finish(item["record"])
+                        continue
+
+                    start = time.time()
+                    try:
+                        # bgr
+                        inpaint_result = model_manager(
+                            item["img"], item["mask_img"], inpaint_request
+                        )
+                    except Exception as e:
+                        logger.exception(f"inpaint {item['stem']} failed")
+                        item["record"].update(status="failed", error=str(e))
+                        finish(item["record"])
+                        continue
+                    item["record"]["latency_ms"] = round((time.time() - start) * 1000, 2)
+
+                    while len(writing) >= prefetch:
+                        finish(writing.popleft().result())
+                    writing.append(
+                        write_pool.submit(_save_item, item, inpaint_result, concat)
+                    )
+
+                while writing:
+                    finish(writing.popleft().result())
+        torch_gc()
+
+    if manifest_f is not None:
+        manifest_f.close()
+    if failed:
+        logger.error(f"{failed} images failed")
+
+
+def _load_item(
+    stem: str,
+    image_p: Path,
+    mask_p: Path,
+    save_p: Path,
+    config_bytes: bytes,
+    resume: bool,
+    last_record: Optional[Dict],
+):
+    record = dict(
+        stem=stem,
+        image=str(image_p),
+        mask=str(mask_p),
+        output=str(save_p),
+        status="ok",
+    )
+    try:
+        image_bytes = image_p.read_bytes()
+        mask_bytes = mask_p.read_bytes()
+        md5 = hashlib.md5(image_bytes)
+        md5.update(mask_bytes)
+        md5.update(config_bytes)
+        record["hash"] = md5.hexdigest()
+        # outputs of a previous run are skipped, unless the manifest shows that
+        # the image, mask or config has changed since then
+        if (
+            resume
+            and save_p.exists()
+            and (
+                last_record is None
+                or (
+                    last_record["status"] in ["ok", "skipped"]
+                    and last_record.get("hash") == record["hash"]
                 )
-            mask_img[mask_img >= 127] = 255
-            mask_img[mask_img < 127] = 0
+            )
+        ):
+            record["status"] = "skipped"
+            return dict(stem=stem, record=record)
 
-            # bgr
-            inpaint_result = model_manager(img, mask_img, inpaint_request)
-            inpaint_result = cv2.cvtColor(inpaint_result, cv2.COLOR_BGR2RGB)
-            if concat:
-                mask_img = cv2.cvtColor(mask_img, cv2.COLOR_GRAY2RGB)
-                inpaint_result = cv2.hconcat([img, mask_img, inpaint_result])
+        message = None
+        image = Image.open(io.BytesIO(image_bytes))
+        infos = image.info
+        img = np.array(image.convert("RGB"))
+        mask_img = np.array(Image.open(io.BytesIO(mask_bytes)).convert("L"))
 
-            img_bytes = pil_to_bytes(Image.fromarray(inpaint_result), "png", 100, infos)
-            save_p = output / f"{stem}.png"
-            with open(save_p, "wb") as fw:
-                fw.write(img_bytes)
+        if mask_img.shape[:2] != img.shape[:2]:
+            message = (
+                f"resize mask {mask_p.name} to image {image_p.name} size: {img.shape[:2]}"
+            )
+            mask_img = cv2.resize(
+                mask_img,
+                (img.shape[1], img.shape[0]),
+                interpolation=cv2.INTER_NEAREST,
+            )
+        mask_img[mask_img >= 127] = 255
+        mask_img[mask_img < 127] = 0
+    except Exception as e:
+        record.update(status="failed", error=str(e))
+        return dict(stem=stem, record=record)
+    return dict(
+        stem=stem,
+        img=img,
+        mask_img=mask_img,
+        infos=infos,
+        message=message,
+        save_p=save_p,
+        record=record,
+    )
 
-            progress.update(task, advance=1)
-            torch_gc()
-            # pid = psutil.Process().pid
-            # memory_info = psutil.Process(pid).memory_info()
-            # memory_in_mb = memory_info.rss / (1024 * 1024)
-            # print(f"原图大小：{img.shape},当前进程的内存占用：{memory_in_mb}MB")
+
+def _save_item(item: Dict, inpaint_result, concat: bool) -> Dict:
+    record = item["record"]
+    try:
+        inpaint_result = cv2.cvtColor(inpaint_result, cv2.COLOR_BGR2RGB)
+        if concat:
+            mask_img = cv2.cvtColor(item["mask_img"], cv2.COLOR_GRAY2RGB)
+            inpaint_result = cv2.hconcat([item["img"], mask_img, inpaint_result])
+
+        img_bytes = pil_to_bytes(
+            Image.fromarray(inpaint_result), "png", 100, item["infos"]
+        )
+        # write to a temp file first, a crash never leaves a truncated output
+        tmp_p = item["save_p"].with_suffix(".png.tmp")
+        with open(tmp_p, "wb") as fw:
+            fw.write(img_bytes)
+        os.replace(tmp_p, item["save_p"])
+    except Exception as e:
+        record.update(status="failed", error=str(e))
+    return record
+
+
+def _process_item(
+    model_manager,
+    item: Tuple,
+    inpaint_request: InpaintRequest,
+    concat: bool,
+    config_bytes: bytes,
+    resume: bool,
+    last_record: Optional[Dict],
+) -> Tuple[Dict, Optional[str]]:
+    loaded = _load_item(*item, config_bytes, resume, last_record)
+    record = loaded["record"]
+    message = loaded.get("message")
+    if record["status"] != "ok":
+        return record, message
+
+    start = time.time()
+    try:
+        # bgr
+        inpaint_result = model_manager(
+            loaded["img"], loaded["mask_img"], inpaint_request
+        )
+    except Exception as e:
+        logger.exception(f"inpaint {record['stem']} failed")
+        record.update(status="failed", error=str(e))
+        return record, message
+    record["latency_ms"] = round((time.time() - start) * 1000, 2)
+    return _save_item(loaded, inpaint_result, concat), message
+
+
+def _worker_loop(
+    model_manager,
+    num_threads: int,
+    inpaint_request: InpaintRequest,
+    concat: bool,
+    config_bytes: bytes,
+    resume: bool,
+    records: Dict[str, Dict],
+    task_queue,
+    result_queue,
+):
+    torch.set_num_threads(num_threads)
+    while True:
+        item = task_queue.get()
+        if item is None:
+            break
+        result_queue.put(
+            _process_item(
+                model_manager,
+                item,
+                inpaint_request,
+                concat,
+                config_bytes,
+                resume,
+                records.get(item[0]),
+            )
+        )
+
+
+def _run_workers(
+    model_manager,
+    items: List[Tuple],
+    workers: int,
+    worker_threads: Optional[int],
+    inpaint_request: InpaintRequest,
+    concat: bool,
+    config_bytes: bytes,
+    resume: bool,
+    records: Dict[str, Dict],
+):
+    """Process items in forked worker processes, yield (record, message) in
+    completion order"""
+    if worker_threads is None:
+        worker_threads = max(1, (os.cpu_count() or 1) // workers)
+    logger.info(f"Start {workers} workers, {worker_threads} threads per worker")
+
+    ctx = multiprocessing.get_context("fork")
+    task_queue = ctx.Queue(maxsize=workers * 2)
+    result_queue = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=_worker_loop,
+            args=(
+                model_manager,
+                worker_threads,
+                inpaint_request,
+                concat,
+                config_bytes,
+                resume,
+                records,
+                task_queue,
+                result_queue,
+            ),
+            daemon=True,
+        )
+        for _ in range(workers)
+    ]
+    for it in processes:
+        it.start()
+
+    def feed():
+        for it in items:
+            task_queue.put(it)
+        for _ in processes:
+            task_queue.put(None)
+
+    threading.Thread(target=feed, daemon=True).start()
+
+    remaining = len(items)
+    while remaining > 0:
+        try:
+            result = result_queue.get(timeout=1)
+        except queue.Empty:
+            if not any(it.is_alive() for it in processes):
+                logger.error(f"Workers exited, {remaining} images not processed")
+                break
+            continue
+        remaining -= 1
+        yield result
+
+    for it in processes:
+        it.join()
@@ -1,16 +1,47 @@
 #!/usr/bin/env python3
+"""
+Benchmark erase/diffusion models and plugins, or a running server.
 
+    # every registered erase model and plugin on cpu
+    python -m iopaint.benchmark --output result.json
+    # selected targets, compared against a previous run
+    python -m iopaint.benchmark --targets lama,plugin:RemoveBG --sizes 512x512,1024x1024 \\
+        --threads 1,4 --output new.json --compare result.json
+    # cost and quality of the RealESRGAN alpha channel upsamplers
+    python -m iopaint.benchmark --targets alpha:realesrgan,alpha:fast,alpha:linear
+    # load test a running server
+    python -m iopaint.benchmark --http http://127.0.0.1:8080 --concurrency 8 --requests 200
+"""
 import argparse
+import base64
+import io
+import json
 import os
+import platform
+import sys
+import threading
 import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
+import cv2
 import numpy as np
-import nvidia_smi
-import psutil
 import torch
+from loguru import logger
+from PIL import Image
 
-from iopaint.model_manager import ModelManager
-from iopaint.schema import InpaintRequest, HDStrategy, SDSampler
+from iopaint.schema import (
+    AlphaUpsampler,
+    InpaintRequest,
+    HDStrategy,
+    SDSampler,
+    RunPluginRequest,
+    InteractiveSegModel,
+    RemoveBGModel,
+    RealESRGANModel,
+)
 
 try:
     torch._C._jit_override_can_fuse_on_cpu(False)
@@ -20,90 +51,600 @@ try:
 except:
     pass
 
-NUM_THREADS = str(4)
-
-os.environ["OMP_NUM_THREADS"] = NUM_THREADS
-os.environ["OPENBLAS_NUM_THREADS"] = NUM_THREADS
-os.environ["MKL_NUM_THREADS"] = NUM_THREADS
-os.environ["VECLIB_MAXIMUM_THREADS"] = NUM_THREADS
-os.environ["NUMEXPR_NUM_THREADS"] = NUM_THREADS
 if os.environ.get("CACHE_DIR"):
     os.environ["TORCH_HOME"] = os.environ["CACHE_DIR"]
 
+PLUGIN_PREFIX = "plugin:"
+ALPHA_PREFIX = "alpha:"
+# build_plugins flag of every plugin
+PLUGIN_FLAGS = {
+    "InteractiveSeg": "enable_interactive_seg",
+    "RemoveBG": "enable_remove_bg",
+    "AnimeSeg": "enable_anime_seg",
+    "RealESRGAN": "enable_realesrgan",
+    "GFPGAN": "enable_gfpgan",
+    "RestoreFormer": "enable_restoreformer",
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of this process over the whole run"""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+
+            return psutil.Process().memory_info().peak_wset / 1024 / 1024
+        except Exception:
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class RssSampler:
+    """Sample resident memory in a thread, the process peak (ru_maxrss) only grows
+    and says nothing about a single case"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.start_rss = None
+        self.peak_rss = None
+        self._stop = threading.Event()
+        self._thread = None
+        try:
+            import psutil
+
+            self._process = psutil.Process()
+        except ImportError:
+            self._process = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
 
-def run_model(model, size):
-    # RGB
-    image = np.random.randint(0, 256, (size[0], size[1], 3)).astype(np.uint8)
-    mask = np.random.randint(0, 255, size).astype(np.uint8)
-
-    config = InpaintRequest(
-        ldm_steps=2,
-        hd_strategy=HDStrategy.ORIGINAL,
-        hd_strategy_crop_margin=128,
-        hd_strategy_crop_trigger_size=128,
-        hd_strategy_resize_limit=128,
-        prompt="a fox is sitting on a bench",
-        sd_steps=5,
-        sd_sampler=SDSampler.ddim,
+    def __enter__(self):
+        if self._process is not None:
+            self.start_rss = self.peak_rss = self._process.memory_info().rss
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+
+    @property
+    def peak_delta_mb(self) -> Optional[float]:
+        """Peak resident memory above the start of the case, None without psutil"""
+        if self.start_rss is None:
+            return None
+        return round((self.peak_rss - self.start_rss) / 1024 / 1024, 2)
+
+
+def synthetic_image(height: int, width: int, seed: int = 0) -> np.ndarray:
+    """RGB image with smooth gradients and texture, closer to a photo than noise"""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.stack(
+        [
+            128 + 100 * np.sin(x / width * np.pi * 3),
+            128 + 100 * np.cos(y / height * np.pi * 2),
+            128 + 60 * np.sin((x + y) / (width + height) * np.pi * 5),
+        ],
+        axis=-1,
     )
-    model(image, mask, config)
-
-
-def benchmark(model, times: int, empty_cache: bool):
-    sizes = [(512, 512)]
-
-    nvidia_smi.nvmlInit()
-    device_id = 0
-    handle = nvidia_smi.nvmlDeviceGetHandleByIndex(device_id)
-
-    def format(metrics):
-        return f"{np.mean(metrics):.2f} ± {np.std(metrics):.2f}"
-
-    process = psutil.Process(os.getpid())
-    # 每个 size 给出显存和内存占用的指标
-    for size in sizes:
-        torch.cuda.empty_cache()
-        time_metrics = []
-        cpu_metrics = []
-        memory_metrics = []
-        gpu_memory_metrics = []
-        for _ in range(times):
-            start = time.time()
-            run_model(model, size)
-            torch.cuda.synchronize()
-
-            # cpu_metrics.append(process.cpu_percent())
-            time_metrics.append((time.time() - start) * 1000)
-            memory_metrics.append(process.memory_info().rss / 1024 / 1024)
-            gpu_memory_metrics.append(
-                nvidia_smi.nvmlDeviceGetMemoryInfo(handle).used / 1024 / 1024
+    image += rng.normal(0, 12, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def synthetic_mask(height: int, width: int, coverage: float, seed: int = 0):
+    """Mask made of random strokes, about `coverage` of the image is masked"""
+    rng = np.random.RandomState(seed)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    target = coverage * height * width
+    thickness = max(4, min(height, width) // 40)
+    while np.count_nonzero(mask) < target:
+        p1 = (rng.randint(0, width), rng.randint(0, height))
+        p2 = (
+            int(np.clip(p1[0] + rng.randint(-width // 4, width // 4), 0, width - 1)),
+            int(np.clip(p1[1] + rng.randint(-height // 4, height // 4), 0, height - 1)),
+        )
+        cv2.line(mask, p1, p2, 255, thickness)
+    return mask
+
+
+def synthetic_alpha(height: int, width: int, seed: int = 0) -> np.ndarray:
+    """Alpha in [0, 1] of a soft edged subject with thin strands, like hair"""
+    rng = np.random.RandomState(seed)
+    alpha = np.zeros((height, width), dtype=np.float32)
+    center = (width // 2, height // 2)
+    axes = (width // 3, height // 3)
+    cv2.ellipse(alpha, center, axes, 0, 0, 360, 1.0, -1, cv2.LINE_AA)
+    for _ in range(60):
+        angle = rng.uniform(0, 2 * np.pi)
+        start = np.array(center) + np.array(axes) * [np.cos(angle), np.sin(angle)]
+        turn = angle + rng.uniform(-0.5, 0.5)
+        length = rng.uniform(0.05, 0.15) * min(height, width)
+        end = start + length * np.array([np.cos(turn), np.sin(turn)])
+        thickness = int(rng.randint(1, max(2, min(height, width) // 200)))
+        cv2.line(
+            alpha,
+            tuple(start.astype(int)),
+            tuple(end.astype(int)),
+            1.0,
+            thickness,
+            cv2.LINE_AA,
+        )
+    alpha = cv2.GaussianBlur(alpha, (0, 0), max(height, width) / 1024)
+    return np.clip(alpha, 0, 1)
+
+
+class BenchTarget:
+    """Something that can be benchmarked. Subclass and add to TARGET_TYPES to
+    benchmark new kinds of targets."""
+
+    name: str
+    # whether mask coverage and hd strategy change the workload
+    use_mask = True
+
+    def run(self, image: np.ndarray, mask: np.ndarray, strategy: HDStrategy): ...
+
+    def quality(self, image: np.ndarray) -> Optional[Dict]:
+        """Quality metrics of the result for image, added to the benchmark result"""
+        return None
+
+
+class ModelTarget(BenchTarget):
+    def __init__(self, name: str, device):
+        from iopaint.model_manager import ModelManager
+
+        self.name = name
+        self.model = ModelManager(
+            name=name,
+            device=device,
+            disable_nsfw=True,
+            sd_cpu_textencoder=str(device) == "cuda",
+        )
+
+    def run(self, image, mask, strategy):
+        config = InpaintRequest(
+            ldm_steps=2,
+            hd_strategy=strategy,
+            hd_strategy_crop_margin=128,
+            hd_strategy_crop_trigger_size=800,
+            hd_strategy_resize_limit=800,
+            prompt="a fox is sitting on a bench",
+            sd_steps=5,
+            sd_sampler=SDSampler.ddim,
+        )
+        self.model(image, mask, config)
+
+
+class PluginTarget(BenchTarget):
+    use_mask = False
+
+    def __init__(self, name: str, device, no_half: bool = False):
+        from iopaint.plugins import build_plugins
+
+        self.name = PLUGIN_PREFIX + name
+        kwargs = dict(
+            enable_interactive_seg=False,
+            interactive_seg_model=InteractiveSegModel.vit_b,
+            interactive_seg_device=device,
+            enable_remove_bg=False,
+            remove_bg_device=device,
+            remove_bg_model=RemoveBGModel.briaai_rmbg_1_4,
+            enable_anime_seg=False,
+            anime_seg_device=device,
+            enable_realesrgan=False,
+            realesrgan_device=device,
+            realesrgan_model=RealESRGANModel.realesr_general_x4v3,
+            enable_gfpgan=False,
+            gfpgan_device=device,
+            enable_restoreformer=False,
+            restoreformer_device=device,
+            no_half=no_half,
+        )
+        kwargs[PLUGIN_FLAGS[name]] = True
+        self.plugin = build_plugins(**kwargs)[name]
+
+    def run(self, image, mask, strategy):
+        height, width = image.shape[:2]
+        req = RunPluginRequest(
+            name=self.plugin.name, image="", clicks=[[width // 2, height // 2, 1]]
+        )
+        if self.plugin.support_gen_mask:
+            self.plugin.gen_mask(image, req)
+        else:
+            self.plugin.gen_image(image, req)
+
+
+class AlphaTarget(BenchTarget):
+    """RealESRGAN upscaling of an RGBA image with one of the alpha upsamplers. The
+    input alpha is downscaled from a ground truth, quality is measured against it"""
+
+    use_mask = False
+
+    def __init__(self, name: str, device, no_half: bool = False):
+        from iopaint.plugins.realesrgan import RealESRGANUpscaler
+
+        self.name = ALPHA_PREFIX + name
+        self.alpha_upsampler = AlphaUpsampler(name)
+        self.upscaler = RealESRGANUpscaler(
+            RealESRGANModel.realesr_general_x4v3, device, no_half
+        )
+        self.scale = self.upscaler.model.scale
+        self._alphas = {}
+
+    def _alpha(self, height: int, width: int):
+        """Ground truth alpha at output size and the uint8 input alpha"""
+        if (height, width) not in self._alphas:
+            truth = synthetic_alpha(height * self.scale, width * self.scale)
+            alpha = cv2.resize(truth, (width, height), interpolation=cv2.INTER_AREA)
+            alpha = np.clip(alpha * 255 + 0.5, 0, 255).astype(np.uint8)
+            self._alphas[(height, width)] = (truth, alpha)
+        return self._alphas[(height, width)]
+
+    def _upscale(self, image):
+        _, alpha = self._alpha(*image.shape[:2])
+        req = RunPluginRequest(
+            name=self.upscaler.name,
+            image="",
+            scale=self.scale,
+            alpha_upsampler=self.alpha_upsampler,
+        )
+        rgba = np.concatenate([image, alpha[:, :, np.newaxis]], axis=-1)
+        return self.upscaler.gen_image(rgba, req)
+
+    def run(self, image, mask, strategy):
+        self._upscale(image)
+
+    def quality(self, image):
+        truth, _ = self._alpha(*image.shape[:2])
+        alpha = self._upscale(image)[:, :, 3].astype(np.float32) / 255
+        error = np.abs(alpha - truth)
+        mse = max(float(np.mean(error**2)), 1e-10)
+        edge = (truth > 0.02) & (truth < 0.98)
+        return dict(
+            alpha_psnr=round(10 * np.log10(1 / mse), 2),
+            alpha_edge_mae=round(float(error[edge].mean()), 4),
+        )
+
+
+def all_targets() -> List[str]:
+    from iopaint.model import models
+
+    erase_models = [name for name, it in models.items() if it.is_erase_model]
+    return (
+        erase_models
+        + [PLUGIN_PREFIX + it for it in PLUGIN_FLAGS]
+        + [ALPHA_PREFIX + it for it in AlphaUpsampler.values()]
+    )
+
+
+def build_target(name: str, device, no_half: bool) -> BenchTarget:
+    if name.startswith(PLUGIN_PREFIX):
+        return PluginTarget(name[len(PLUGIN_PREFIX) :], device, no_half)
+    if name.startswith(ALPHA_PREFIX):
+        return AlphaTarget(name[len(ALPHA_PREFIX) :], device, no_half)
+    return ModelTarget(name, device)
+
+
+def sync(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+    elif str(device) == "mps":
+        torch.mps.synchronize()
+
+
+def bench_case(
+    target: BenchTarget,
+    device,
+    size,
+    coverage: float,
+    strategy: HDStrategy,
+    threads: int,
+    warmup: int,
+    times: int,
+) -> Dict:
+    if threads > 0:
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+    height, width = size
+    image = synthetic_image(height, width)
+    mask = synthetic_mask(height, width, coverage)
+    if str(device).startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats()
+
+    def timed():
+        start = time.perf_counter()
+        # the model may modify inputs in place
+        target.run(image.copy(), mask.copy(), strategy)
+        sync(device)
+        return (time.perf_counter() - start) * 1000
+
+    with RssSampler() as rss:
+        warmup_ms = [timed() for _ in range(warmup)]
+        latency_ms = [timed() for _ in range(times)]
+    mean = float(np.mean(latency_ms))
+    result = dict(
+        target=target.name,
+        width=width,
+        height=height,
+        coverage=coverage if target.use_mask else None,
+        strategy=strategy.value if target.use_mask else None,
+        threads=threads or torch.get_num_threads(),
+        warmup_ms=[round(it, 2) for it in warmup_ms],
+        mean_ms=round(mean, 2),
+        p50_ms=round(percentile(latency_ms, 50), 2),
+        p95_ms=round(percentile(latency_ms, 95), 2),
+        p99_ms=round(percentile(latency_ms, 99), 2),
+        throughput=round(1000 / mean, 3) if mean > 0 else None,
+        peak_rss_delta_mb=rss.peak_delta_mb,
+    )
+    if str(device).startswith("cuda"):
+        result["peak_vram_mb"] = torch.cuda.max_memory_allocated() / 1024 / 1024
+    quality = target.quality(image.copy())
+    if quality:
+        result.update(quality)
+    logger.info(
+        f"{result['target']} {width}x{height} coverage={result['coverage']} "
+        f"strategy={result['strategy']} threads={result['threads']}: "
+        f"warmup {result['warmup_ms']}ms, p50 {result['p50_ms']}ms, "
+        f"p95 {result['p95_ms']}ms, p99 {result['p99_ms']}ms"
+        + "".join(f", {k} {v}" for k, v in (quality or {}).items())
+    )
+    return result
+
+
+def case_key(result: Dict):
+    # http results are keyed by concurrency, bench_case results by threads
+    keys = ["target", "width", "height", "coverage", "strategy", "threads"]
+    return tuple(result.get(k) for k in keys + ["concurrency"])
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float) -> int:
+    """Print cases slower than baseline by more than tolerance, return their count"""
+    baseline = {case_key(it): it for it in baseline}
+    regressions = 0
+    for it in results:
+        old = baseline.get(case_key(it))
+        if old is None or not old["p50_ms"]:
+            continue
+        change = it["p50_ms"] / old["p50_ms"] - 1
+        flag = "REGRESSION" if change > tolerance else "ok"
+        regressions += change > tolerance
+        params = "".join(
+            f" {k}={it[k]}"
+            for k in ["coverage", "strategy", "threads", "concurrency"]
+            if k in it
+        )
+        print(
+            f"{flag:>10} {it['target']} {it['width']}x{it['height']}{params}: "
+            f"p50 {old['p50_ms']}ms -> {it['p50_ms']}ms ({change:+.1%})"
+        )
+    return regressions
+
+
+def http_inpaint_request(url: str, endpoint: str, image_bytes: bytes, mask_bytes: bytes):
+    if endpoint == "inpaint_binary":
+        boundary = uuid.uuid4().hex
+        body = b""
+        for field, data in [("image", image_bytes), ("mask", mask_bytes)]:
+            body += (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{field}"; filename="{field}.png"\r\n'
+                f"Content-Type: image/png\r\n\r\n"
+            ).encode() + data + b"\r\n"
+        body += f"--{boundary}--\r\n".encode()
+        content_type = f"multipart/form-data; boundary={boundary}"
+    else:
+        body = json.dumps(
+            dict(
+                image=base64.b64encode(image_bytes).decode(),
+                mask=base64.b64encode(mask_bytes).decode(),
             )
+        ).encode()
+        content_type = "application/json"
+    return urllib.request.Request(
+        f"{url.rstrip('/')}/api/v1/{endpoint}",
+        data=body,
+        headers={"Content-Type": content_type},
+        method="POST",
+    )
+
 
-        print(f"size: {size}".center(80, "-"))
-        # print(f"cpu: {format(cpu_metrics)}")
-        print(f"latency: {format(time_metrics)}ms")
-        print(f"memory: {format(memory_metrics)} MB")
-        print(f"gpu memory: {format(gpu_memory_metrics)} MB")
+def http_load_test(
+    url: str,
+    endpoint: str,
+    size,
+    coverage: float,
+    concurrency: int,
+    num_requests: int,
+) -> Dict:
+    height, width = size
 
-    nvidia_smi.nvmlShutdown()
+    def png(arr):
+        buf = io.BytesIO()
+        Image.fromarray(arr).save(buf, format="png")
+        return buf.getvalue()
+
+    image_bytes = png(synthetic_image(height, width))
+    mask_bytes = png(synthetic_mask(height, width, coverage))
+    status = {}
+    lock = threading.Lock()
+
+    def send(_):
+        req = http_inpaint_request(url, endpoint, image_bytes, mask_bytes)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=600) as res:
+                res.read()
+                code = res.status
+        except urllib.error.HTTPError as e:
+            code = e.code
+        except Exception as e:
+            code = type(e).__name__
+        latency = (time.perf_counter() - start) * 1000
+        with lock:
+            status[str(code)] = status.get(str(code), 0) + 1
+        return code, latency
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        responses = list(pool.map(send, range(num_requests)))
+    elapsed = time.perf_counter() - start
+    latency_ms = [latency for code, latency in responses if code == 200]
+    result = dict(
+        target=f"http:{endpoint}",
+        width=width,
+        height=height,
+        coverage=coverage,
+        concurrency=concurrency,
+        requests=num_requests,
+        status=status,
+        p50_ms=round(percentile(latency_ms, 50), 2),
+        p95_ms=round(percentile(latency_ms, 95), 2),
+        p99_ms=round(percentile(latency_ms, 99), 2),
+        throughput=round(len(latency_ms) / elapsed, 3),
+    )
+    logger.info(f"{result}")
+    return result
+
+
+def parse_sizes(value: str):
+    sizes = []
+    for it in value.split(","):
+        width, height = it.lower().split("x")
+        sizes.append((int(height), int(width)))
+    return sizes
 
 
 def get_args_parser():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--name")
-    parser.add_argument("--device", default="cuda", type=str)
-    parser.add_argument("--times", default=10, type=int)
-    parser.add_argument("--empty-cache", action="store_true")
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--targets",
+        default=None,
+        help="Comma separated model names and plugin:<name>, default: all erase models and plugins",
+    )
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--no-half", action="store_true")
+    parser.add_argument("--sizes", default="512x512,1024x1024", help="WxH,WxH")
+    parser.add_argument("--coverages", default="0.05,0.3", help="Masked area ratios")
+    parser.add_argument(
+        "--strategies",
+        default=",".join(it.value for it in HDStrategy),
+        help="HD strategies for models",
+    )
+    parser.add_argument(
+        "--threads", default="0", help="Torch thread counts, 0 keeps the default"
+    )
+    parser.add_argument("--warmup", default=1, type=int)
+    parser.add_argument("--times", default=5, type=int)
+    parser.add_argument("--output", default=None, help="Write results to a json file")
+    parser.add_argument("--compare", default=None, help="Baseline json to compare to")
+    parser.add_argument(
+        "--tolerance", default=0.1, type=float, help="Allowed p50 slowdown ratio"
+    )
+    parser.add_argument("--http", default=None, help="Load test a server at this url")
+    parser.add_argument(
+        "--endpoint", default="inpaint", choices=["inpaint", "inpaint_binary"]
+    )
+    parser.add_argument("--concurrency", default=4, type=int)
+    parser.add_argument("--requests", default=50, type=int)
     return parser.parse_args()
 
 
-if __name__ == "__main__":
-    args = get_args_parser()
-    device = torch.device(args.device)
-    model = ModelManager(
-        name=args.name,
-        device=device,
-        disable_nsfw=True,
-        sd_cpu_textencoder=True,
+def environment(args) -> Dict:
+    return dict(
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        torch=torch.__version__,
+        cpu_count=os.cpu_count(),
+        device=args.device,
+        cuda_device=(
+            torch.cuda.get_device_name() if args.device.startswith("cuda") else None
+        ),
+        peak_rss_mb=peak_rss_mb(),
     )
-    benchmark(model, args.times, args.empty_cache)
+
+
+def main():
+    args = get_args_parser()
+    sizes = parse_sizes(args.sizes)
+    coverages = [float(it) for it in args.coverages.split(",")]
+    results = []
+
+    if args.http:
+        for size in sizes:
+            for coverage in coverages:
+                results.append(
+                    http_load_test(
+                        args.http,
+                        args.endpoint,
+                        size,
+                        coverage,
+                        args.concurrency,
+                        args.requests,
+                    )
+                )
+    else:
+        device = torch.device(args.device)
+        strategies = [HDStrategy(it) for it in args.strategies.split(",")]
+        threads = [int(it) for it in args.threads.split(",")]
+        targets = args.targets.split(",") if args.targets else all_targets()
+        for name in targets:
+            try:
+                target = build_target(name, device, args.no_half)
+            except Exception as e:
+                logger.error(f"Skip {name}, failed to load: {e}")
+                continue
+            for size in sizes:
+                for n in threads:
+                    if not target.use_mask:
+                        results.append(
+                            bench_case(
+                                target, device, size, 0, HDStrategy.ORIGINAL, n,
+                                args.warmup, args.times,
+                            )
+                        )  # fmt: skip
+                        continue
+                    for coverage in coverages:
+                        for strategy in strategies:
+                            results.append(
+                                bench_case(
+                                    target, device, size, coverage, strategy, n,
+                                    args.warmup, args.times,
+                                )
+                            )  # fmt: skip
+            del target
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(dict(env=environment(args), results=results), f, indent=2)
+        logger.info(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            logger.error(f"{regressions} cases slower than baseline")
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
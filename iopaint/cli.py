@@ -75,6 +75,32 @@ def run(
     concat: bool = Option(
         False, help="Concat original image, mask and output images into one image"
     ),
+    prefetch: int = Option(
+        4, help="Number of images decoded ahead and results waiting to be written"
+    ),
+    shard: str = Option(
+        None,
+        help="Only process shard i of N (0 <= i < N), e.g. 0/4. "
+        "Images are split by file name, so shards can run on different machines.",
+    ),
+    resume: bool = Option(
+        False,
+        help="Skip images whose output already exists. With --manifest, images whose "
+        "image, mask or config changed since the last run are processed again.",
+    ),
+    manifest: Path = Option(
+        None,
+        help="JSONL file to append status, latency and content hash of every image to.",
+        dir_okay=False,
+    ),
+    workers: int = Option(
+        1,
+        help="Number of worker processes, cpu only. The model is loaded once and "
+        "shared by the forked workers.",
+    ),
+    worker_threads: int = Option(
+        None, help="Torch threads per worker, default: cpu count / workers"
+    ),
     model_dir: Path = Option(
         DEFAULT_MODEL_DIR,
         help=MODEL_DIR_HELP,
@@ -91,7 +117,21 @@ def run(
 
     from iopaint.batch_processing import batch_inpaint
 
-    batch_inpaint(model, device, image, mask, output, config, concat)
+    batch_inpaint(
+        model,
+        device,
+        image,
+        mask,
+        output,
+        config,
+        concat,
+        prefetch,
+        shard=shard,
+        resume=resume,
+        manifest=manifest,
+        workers=workers,
+        worker_threads=worker_threads,
+    )
 
 
 @typer_app.command(help="Start IOPaint server")
@@ -136,6 +176,7 @@ def start(
     remove_bg_device: Device = Option(Device.cpu, help=REMOVE_BG_DEVICE_HELP),
     remove_bg_model: RemoveBGModel = Option(RemoveBGModel.briaai_rmbg_1_4),
     enable_anime_seg: bool = Option(False, help=ANIMESEG_HELP),
+    anime_seg_device: Device = Option(Device.cpu, help=ANIME_SEG_DEVICE_HELP),
     enable_realesrgan: bool = Option(False),
     realesrgan_device: Device = Option(Device.cpu),
     realesrgan_model: RealESRGANModel = Option(RealESRGANModel.realesr_general_x4v3),
@@ -143,10 +184,22 @@ def start(
     gfpgan_device: Device = Option(Device.cpu),
     enable_restoreformer: bool = Option(False),
     restoreformer_device: Device = Option(Device.cpu),
+    inpaint_workers: int = Option(1, help=INPAINT_WORKERS_HELP),
+    max_queue_size: int = Option(16, help=MAX_QUEUE_SIZE_HELP),
+    erase_batch_size: int = Option(1, help=ERASE_BATCH_SIZE_HELP),
+    erase_batch_wait_ms: float = Option(5.0, help=ERASE_BATCH_WAIT_MS_HELP),
+    model_cache_vram: float = Option(0, help=MODEL_CACHE_VRAM_HELP),
+    model_cache_ram: float = Option(0, help=MODEL_CACHE_RAM_HELP),
+    image_store_size: float = Option(1024, help=IMAGE_STORE_SIZE_HELP),
+    image_store_dir: Optional[Path] = Option(
+        None, help=IMAGE_STORE_DIR_HELP, file_okay=False
+    ),
+    image_store_dir_size: float = Option(10240, help=IMAGE_STORE_DIR_SIZE_HELP),
 ):
     dump_environment_info()
     device = check_device(device)
     remove_bg_device = check_device(remove_bg_device)
+    anime_seg_device = check_device(anime_seg_device)
     realesrgan_device = check_device(realesrgan_device)
     gfpgan_device = check_device(gfpgan_device)
 
@@ -217,6 +270,7 @@ def start(
         remove_bg_device=remove_bg_device,
         remove_bg_model=remove_bg_model,
         enable_anime_seg=enable_anime_seg,
+        anime_seg_device=anime_seg_device,
         enable_realesrgan=enable_realesrgan,
         realesrgan_device=realesrgan_device,
         realesrgan_model=realesrgan_model,
@@ -224,6 +278,15 @@ def start(
         gfpgan_device=gfpgan_device,
         enable_restoreformer=enable_restoreformer,
         restoreformer_device=restoreformer_device,
+        inpaint_workers=inpaint_workers,
+        max_queue_size=max_queue_size,
+        erase_batch_size=erase_batch_size,
+        erase_batch_wait_ms=erase_batch_wait_ms,
+        model_cache_vram_gb=model_cache_vram,
+        model_cache_ram_gb=model_cache_ram,
+        image_store_mb=image_store_size,
+        image_store_dir=image_store_dir,
+        image_store_dir_mb=image_store_dir_size,
     )
     print(api_config.model_dump_json(indent=4))
     api = Api(app, api_config)
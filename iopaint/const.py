@@ -127,10 +127,44 @@ INTERACTIVE_SEG_HELP = "Enable interactive segmentation using Segment Anything."
 INTERACTIVE_SEG_MODEL_HELP = "Model size: mobile_sam < vit_b < vit_l < vit_h. Bigger model size means better segmentation but slower speed."
 REMOVE_BG_HELP = "Enable remove background plugin."
 REMOVE_BG_DEVICE_HELP = "Device for remove background plugin. 'cuda' only supports briaai models(briaai/RMBG-1.4 and briaai/RMBG-2.0)"
-ANIMESEG_HELP = "Enable anime segmentation plugin. Always run on CPU"
+ANIMESEG_HELP = "Enable anime segmentation plugin"
+ANIME_SEG_DEVICE_HELP = "Device for anime segmentation plugin. Runs in half precision on cuda unless --no-half is set"
 REALESRGAN_HELP = "Enable realesrgan super resolution"
 GFPGAN_HELP = "Enable GFPGAN face restore. To also enhance background, use with --enable-realesrgan"
 RESTOREFORMER_HELP = "Enable RestoreFormer face restore. To also enhance background, use with --enable-realesrgan"
 GIF_HELP = "Enable GIF plugin. Make GIF to compare original and cleaned image"
 
+INPAINT_WORKERS_HELP = """
+Number of worker threads running inpaint jobs. All workers share the loaded model,
+only erase models with --erase-batch-size larger than 1 run several requests at once,
+other models run one request at a time.
+"""
+MAX_QUEUE_SIZE_HELP = """
+Maximum number of pending inpaint jobs. When the queue is full, new requests get
+a 429 response with a Retry-After header.
+"""
+ERASE_BATCH_SIZE_HELP = """
+Maximum number of concurrent requests batched into one forward pass for erase models(lama/migan/mat/fcf).
+Requests are only batched when their padded image sizes match. 1 disables batching.
+Use together with --inpaint-workers larger than 1.
+"""
+ERASE_BATCH_WAIT_MS_HELP = "How long the first request of a batch waits for others to join, in milliseconds."
+MODEL_CACHE_VRAM_HELP = """
+GPU memory budget (GB) for keeping switched out models on the device, including the model in use.
+Least recently used models beyond the budget are offloaded to cpu. 0 disables it.
+"""
+MODEL_CACHE_RAM_HELP = """
+CPU memory budget (GB) for offloaded models, so switching back to them is a device move instead of a reload.
+Least recently used models beyond the budget are destroyed. 0 disables it.
+"""
+IMAGE_STORE_SIZE_HELP = """
+Memory budget (MB) for images uploaded to /api/v1/images, so editing requests can send an image id
+instead of the whole image. Least recently used images beyond the budget are dropped, or spilled to --image-store-dir.
+"""
+IMAGE_STORE_DIR_HELP = "Directory for images spilled out of the image store memory budget. Default: no spilling."
+IMAGE_STORE_DIR_SIZE_HELP = """
+Disk budget (MB) for images spilled to --image-store-dir. Least recently spilled images beyond the budget are deleted.
+Spilled images of previous runs are deleted at startup.
+"""
+
 INBROWSER_HELP = "Automatically launch IOPaint in a new tab on the default browser"
@@ -1,8 +1,8 @@
 import glob
 import json
 import os
-from functools import lru_cache
-from typing import List, Optional
+import threading
+from typing import List, Optional, Tuple
 
 from iopaint.schema import ModelType, ModelInfo
 from loguru import logger
@@ -45,10 +45,58 @@ def folder_name_to_show_name(name: str) -> str:
     return name.replace("models--", "").replace("--", "/")
 
 
-@lru_cache(maxsize=512)
+# first conv of the unet, [320, in_channels, 3, 3], in original and diffusers layout
+UNET_IN_CONV_KEYS = [
+    "model.diffusion_model.input_blocks.0.0.weight",
+    "unet.conv_in.weight",
+    "conv_in.weight",
+]
+
+
+def get_unet_in_channels(model_abs_path: str) -> Optional[int]:
+    """Input channels of the unet of a single file checkpoint, read from the
+    safetensors header without loading weights. None if it can't be known without
+    loading the model"""
+    if Path(model_abs_path).suffix != ".safetensors":
+        return None
+    from safetensors import safe_open
+
+    try:
+        with safe_open(model_abs_path, framework="pt") as f:
+            keys = set(f.keys())
+            for key in UNET_IN_CONV_KEYS:
+                if key in keys:
+                    shape = f.get_slice(key).get_shape()
+                    if len(shape) == 4:
+                        return shape[1]
+    except Exception as e:
+        logger.warning(f"Failed to read safetensors header {model_abs_path}: {e}")
+    return None
+
+
+def _model_type_from_in_channels(
+    model_abs_path: str, in_channels: int, model_type: ModelType, inpaint_type
+) -> Optional[ModelType]:
+    if in_channels == 9:
+        return inpaint_type
+    if in_channels == 4:
+        return model_type
+    logger.info(f"Ignore {in_channels} input channels model: {model_abs_path}")
+    return None
+
+
 def get_sd_model_type(model_abs_path: str) -> Optional[ModelType]:
     if "inpaint" in Path(model_abs_path).name.lower():
-        model_type = ModelType.DIFFUSERS_SD_INPAINT
+        return ModelType.DIFFUSERS_SD_INPAINT
+
+    in_channels = get_unet_in_channels(model_abs_path)
+    if in_channels is not None:
+        model_type = _model_type_from_in_channels(
+            model_abs_path,
+            in_channels,
+            ModelType.DIFFUSERS_SD,
+            ModelType.DIFFUSERS_SD_INPAINT,
+        )
     else:
         # load once to check num_in_channels
         from diffusers import StableDiffusionInpaintPipeline
@@ -73,10 +121,18 @@ def get_sd_model_type(model_abs_path: str) -> Optional[ModelType]:
     return model_type
 
 
-@lru_cache()
 def get_sdxl_model_type(model_abs_path: str) -> Optional[ModelType]:
     if "inpaint" in model_abs_path:
-        model_type = ModelType.DIFFUSERS_SDXL_INPAINT
+        return ModelType.DIFFUSERS_SDXL_INPAINT
+
+    in_channels = get_unet_in_channels(model_abs_path)
+    if in_channels is not None:
+        model_type = _model_type_from_in_channels(
+            model_abs_path,
+            in_channels,
+            ModelType.DIFFUSERS_SDXL,
+            ModelType.DIFFUSERS_SDXL_INPAINT,
+        )
     else:
         # load once to check num_in_channels
         from diffusers import StableDiffusionXLInpaintPipeline
@@ -105,10 +161,19 @@ def get_sdxl_model_type(model_abs_path: str) -> Optional[ModelType]:
     return model_type
 
 
-def scan_single_file_diffusion_models(cache_dir) -> List[ModelInfo]:
-    cache_dir = Path(cache_dir)
-    stable_diffusion_dir = cache_dir / "stable_diffusion"
-    cache_file = stable_diffusion_dir / "iopaint_cache.json"
+def _stat_key(path: Path) -> Tuple[int, int]:
+    try:
+        stat = path.stat()
+    except OSError:
+        return 0, 0
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _scan_single_file_dir(model_dir: Path, get_model_type) -> List[ModelInfo]:
+    """Single file checkpoints in model_dir. Model types are kept in
+    iopaint_cache.json with the mtime and size of the file they were found for,
+    only new or changed files are inspected again"""
+    cache_file = model_dir / "iopaint_cache.json"
     model_type_cache = {}
     if cache_file.exists():
         try:
@@ -118,18 +183,30 @@ def scan_single_file_diffusion_models(cache_dir) -> List[ModelInfo]:
         except:
             pass
 
+    new_cache = {}
     res = []
-    for it in stable_diffusion_dir.glob("*.*"):
+    for it in sorted(model_dir.glob("*.*")):
         if it.suffix not in [".safetensors", ".ckpt"]:
             continue
         model_abs_path = str(it.absolute())
-        model_type = model_type_cache.get(it.name)
-        if model_type is None:
-            model_type = get_sd_model_type(model_abs_path)
+        mtime, size = _stat_key(it)
+        entry = model_type_cache.get(it.name)
+        if isinstance(entry, str):
+            # written by older versions, without mtime and size
+            model_type = entry
+        elif (
+            isinstance(entry, dict)
+            and entry.get("mtime") == mtime
+            and entry.get("size") == size
+        ):
+            model_type = entry.get("model_type")
+        else:
+            model_type = get_model_type(model_abs_path)
+        # unsupported files are remembered too, so they are not loaded again
+        new_cache[it.name] = {"model_type": model_type, "mtime": mtime, "size": size}
         if model_type is None:
             continue
 
-        model_type_cache[it.name] = model_type
         res.append(
             ModelInfo(
                 name=it.name,
@@ -138,44 +215,18 @@ def scan_single_file_diffusion_models(cache_dir) -> List[ModelInfo]:
                 is_single_file_diffusers=True,
             )
         )
-    if stable_diffusion_dir.exists():
+    if model_dir.exists() and new_cache != model_type_cache:
         with open(cache_file, "w", encoding="utf-8") as fw:
-            json.dump(model_type_cache, fw, indent=2, ensure_ascii=False)
-
-    stable_diffusion_xl_dir = cache_dir / "stable_diffusion_xl"
-    sdxl_cache_file = stable_diffusion_xl_dir / "iopaint_cache.json"
-    sdxl_model_type_cache = {}
-    if sdxl_cache_file.exists():
-        try:
-            with open(sdxl_cache_file, "r", encoding="utf-8") as f:
-                sdxl_model_type_cache = json.load(f)
-                assert isinstance(sdxl_model_type_cache, dict)
-        except:
-            pass
-
-    for it in stable_diffusion_xl_dir.glob("*.*"):
-        if it.suffix not in [".safetensors", ".ckpt"]:
-            continue
-        model_abs_path = str(it.absolute())
-        model_type = sdxl_model_type_cache.get(it.name)
-        if model_type is None:
-            model_type = get_sdxl_model_type(model_abs_path)
-        if model_type is None:
-            continue
+            json.dump(new_cache, fw, indent=2, ensure_ascii=False)
+    return res
 
-        sdxl_model_type_cache[it.name] = model_type
-        if stable_diffusion_xl_dir.exists():
-            with open(sdxl_cache_file, "w", encoding="utf-8") as fw:
-                json.dump(sdxl_model_type_cache, fw, indent=2, ensure_ascii=False)
 
-        res.append(
-            ModelInfo(
-                name=it.name,
-                path=model_abs_path,
-                model_type=model_type,
-                is_single_file_diffusers=True,
-            )
-        )
+def scan_single_file_diffusion_models(cache_dir) -> List[ModelInfo]:
+    cache_dir = Path(cache_dir)
+    res = _scan_single_file_dir(cache_dir / "stable_diffusion", get_sd_model_type)
+    res.extend(
+        _scan_single_file_dir(cache_dir / "stable_diffusion_xl", get_sdxl_model_type)
+    )
     return res
 
 
@@ -204,8 +255,9 @@ def scan_diffusers_models() -> List[ModelInfo]:
     cache_dir = Path(HF_HUB_CACHE)
     # logger.info(f"Scanning diffusers models in {cache_dir}")
     diffusers_model_names = []
+    # models--{org}--{name}/snapshots/{revision}/model_index.json
     model_index_files = glob.glob(
-        os.path.join(cache_dir, "**/*", "model_index.json"), recursive=True
+        os.path.join(cache_dir, "models--*", "snapshots", "*", "model_index.json")
     )
     for it in model_index_files:
         it = Path(it)
@@ -304,11 +356,58 @@ def scan_converted_diffusers_models(cache_dir) -> List[ModelInfo]:
     return available_models
 
 
-def scan_models() -> List[ModelInfo]:
+def _scan_fingerprint(model_dir) -> Tuple:
+    """mtime and size of the files and directories that change when diffusion
+    models are added, removed or replaced"""
+    from huggingface_hub.constants import HF_HUB_CACHE
+
+    paths = []
+    model_dir = Path(model_dir)
+    for it in [model_dir / "stable_diffusion", model_dir / "stable_diffusion_xl"]:
+        paths.append(it)
+        if it.is_dir():
+            # single file checkpoints and converted diffusers directories
+            paths.extend(sorted(it.iterdir()))
+    paths.append(Path(HF_HUB_CACHE))
+    paths.extend(sorted(Path(HF_HUB_CACHE).glob("models--*/snapshots/*")))
+    return tuple((str(it), *_stat_key(it)) for it in paths)
+
+
+class ModelScanCache:
+    """Diffusion models found by the last scan, kept in memory until the model
+    directories change. Erase models are checked on every scan, it only takes a
+    few file exists calls"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        self._models: List[ModelInfo] = []
+
+    def diffusion_models(self, model_dir, refresh: bool = False) -> List[ModelInfo]:
+        with self._lock:
+            fingerprint = (str(model_dir), _scan_fingerprint(model_dir))
+            if refresh or fingerprint != self._fingerprint:
+                models = []
+                models.extend(scan_single_file_diffusion_models(model_dir))
+                models.extend(scan_diffusers_models())
+                models.extend(scan_converted_diffusers_models(model_dir))
+                self._models = models
+                # after the scan, it may have updated iopaint_cache.json
+                self._fingerprint = (str(model_dir), _scan_fingerprint(model_dir))
+            return list(self._models)
+
+    def clear(self):
+        with self._lock:
+            self._fingerprint = None
+            self._models = []
+
+
+model_scan_cache = ModelScanCache()
+
+
+def scan_models(refresh: bool = False) -> List[ModelInfo]:
     model_dir = os.getenv("XDG_CACHE_HOME", DEFAULT_MODEL_DIR)
     available_models = []
     available_models.extend(scan_inpaint_models(model_dir))
-    available_models.extend(scan_single_file_diffusion_models(model_dir))
-    available_models.extend(scan_diffusers_models())
-    available_models.extend(scan_converted_diffusers_models(model_dir))
+    available_models.extend(model_scan_cache.diffusion_models(model_dir, refresh))
     return available_models
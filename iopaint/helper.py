@@ -266,6 +266,48 @@ def boxes_from_mask(mask: np.ndarray) -> List[np.ndarray]:
     return boxes
 
 
+def merge_boxes(
+    boxes: List[np.ndarray], margin: int, max_size: Optional[int] = None
+) -> List[np.ndarray]:
+    """Merge boxes that sit close together, when one crop (box + margin) around
+    both of them is not larger than the two separate crops.
+
+    Args:
+        boxes: list of [left, top, right, bottom]
+        margin: crop margin added around every box
+        max_size: merged crop width/height limit
+
+    Returns:
+        merged boxes
+    """
+
+    def crop_area(box):
+        return (box[2] - box[0] + margin * 2) * (box[3] - box[1] + margin * 2)
+
+    boxes = [np.array(it).astype(int) for it in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                union = np.concatenate(
+                    [np.minimum(a[:2], b[:2]), np.maximum(a[2:], b[2:])]
+                )
+                union_size = max(union[2:] - union[:2]) + margin * 2
+                if max_size is not None and union_size > max_size:
+                    continue
+                if crop_area(union) > crop_area(a) + crop_area(b):
+                    continue
+                boxes[i] = union
+                del boxes[j]
+                merged = True
+                break
+            if merged:
+                break
+    return boxes
+
+
 def only_keep_largest_contour(mask: np.ndarray) -> List[np.ndarray]:
     """
     Args:
@@ -313,8 +355,15 @@ def decode_base64_to_image(
     ):
         encoding = encoding.split(";")[1].split(",")[1]
     image_bytes = base64.b64decode(encoding)
-    ext = get_image_ext(image_bytes)
-    image = Image.open(io.BytesIO(image_bytes))
+    return decode_image_file(io.BytesIO(image_bytes), gray=gray)
+
+
+def decode_image_file(
+    fp, gray=False
+) -> Tuple[np.array, Optional[np.array], Dict, str]:
+    """Decode an image from a file object, the image is only opened once"""
+    image = Image.open(fp)
+    ext = image.format.lower() if image.format else "jpeg"
 
     alpha_channel = None
     try:
@@ -361,6 +410,50 @@ def concat_alpha_channel(rgb_np_img, alpha_channel) -> np.ndarray:
     return rgb_np_img
 
 
+def histogram_lookup(source_histogram, reference_histogram) -> np.ndarray:
+    """Lookup tables mapping each source value to the first reference value whose
+    cdf reaches the source cdf, one row per channel of the (C, 256) histograms"""
+    source_cdf = source_histogram.cumsum(axis=-1, dtype=np.float64)
+    reference_cdf = reference_histogram.cumsum(axis=-1, dtype=np.float64)
+    source_cdf /= np.maximum(source_cdf[:, -1:], 1)
+    reference_cdf /= np.maximum(reference_cdf[:, -1:], 1)
+    lookup = np.stack(
+        [np.searchsorted(ref, src) for src, ref in zip(source_cdf, reference_cdf)]
+    )
+    return np.minimum(lookup, 255).astype(np.uint8)
+
+
+def match_histograms(
+    source: np.ndarray, reference: np.ndarray, mask: np.ndarray
+) -> np.ndarray:
+    """Map the colors of source so its histogram outside the mask matches reference.
+
+    Args:
+        source: [H, W, C] uint8
+        reference: [H, W, C] uint8
+        mask: [H, W] or [H, W, 1], histograms only use pixels where mask == 0
+    """
+    if len(mask.shape) == 3:
+        mask = mask[:, :, -1]
+    keep = mask == 0
+    if not keep.any():
+        return source
+
+    channels = source.shape[-1]
+    offsets = np.arange(channels, dtype=np.intp) * 256
+
+    def histograms(image):
+        # all channels in one bincount, channel c counted in [c * 256, c * 256 + 256)
+        values = image[keep].astype(np.intp) + offsets
+        return np.bincount(values.ravel(), minlength=channels * 256).reshape(
+            channels, 256
+        )
+
+    lookup = histogram_lookup(histograms(source), histograms(reference))
+    # [256, 1, C] table, cv2.LUT maps each channel with its own lookup
+    return cv2.LUT(np.ascontiguousarray(source), lookup.T[:, None, :].copy())
+
+
 def adjust_mask(mask: np.ndarray, kernel_size: int, operate):
     # fronted brush color "ffcc00bb"
     # kernel_size = kernel_size*2+1
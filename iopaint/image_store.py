@@ -0,0 +1,150 @@
+import pickle
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+from loguru import logger
+
+from iopaint.lru_cache import LRUCache, nbytes
+
+
+class StoredImage:
+    def __init__(
+        self,
+        image: np.ndarray,
+        alpha_channel: Optional[np.ndarray],
+        infos: Dict,
+        ext: str,
+        mask: Optional[np.ndarray] = None,
+    ):
+        # RGB, same as decode_base64_to_image
+        self.image = image
+        self.alpha_channel = alpha_channel
+        self.infos = infos
+        self.ext = ext
+        # for inpainting results, the mask inpainted so far
+        self.mask = mask
+
+    @property
+    def nbytes(self) -> int:
+        return nbytes([self.image, self.alpha_channel, self.mask])
+
+
+class ImageStore:
+    """Decoded images uploaded once and referred to by id in later requests.
+
+    Images live in memory up to ``max_size`` bytes. Least recently used images
+    beyond it are written to ``spill_dir`` if set, and loaded back when used
+    again, otherwise they are dropped and clients have to upload them again.
+    Spilled files are deleted least recently spilled first beyond
+    ``spill_max_size`` bytes, and at startup, ids do not outlive the server.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        spill_dir: Optional[Path] = None,
+        spill_max_size: int = 10 * 1024**3,
+    ):
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            spill_dir.mkdir(parents=True, exist_ok=True)
+            self._clear_spill_dir()
+        # reentrant, spilling a file may evict and delete others
+        self._spill_lock = threading.RLock()
+        # spilled image id -> file size
+        self._spilled = LRUCache(
+            spill_max_size, size_fn=lambda it: it, on_evict=self._delete_spilled
+        )
+        self._images = LRUCache(
+            max_size, size_fn=lambda it: it.nbytes, on_evict=self._spill
+        )
+
+    def put(self, image: StoredImage, image_id: Optional[str] = None) -> str:
+        image_id = image_id or uuid.uuid4().hex
+        self._images.put(image_id, image)
+        return image_id
+
+    def get(self, image_id: str) -> Optional[StoredImage]:
+        """Copy of the stored image, models may modify their input in place"""
+        image = self._get(image_id)
+        if image is None:
+            return None
+        return StoredImage(
+            image.image.copy(),
+            None if image.alpha_channel is None else image.alpha_channel.copy(),
+            dict(image.infos),
+            image.ext,
+            None if image.mask is None else image.mask.copy(),
+        )
+
+    def get_mask(self, image_id: str) -> Optional[np.ndarray]:
+        image = self._get(image_id)
+        if image is None or image.mask is None:
+            return None
+        return image.mask.copy()
+
+    def _get(self, image_id: str) -> Optional[StoredImage]:
+        image = self._images.get(image_id)
+        if image is None:
+            image = self._load_spilled(image_id)
+            if image is None:
+                return None
+            self._images.put(image_id, image)
+        return image
+
+    def delete(self, image_id: str) -> bool:
+        found = self._images.pop(image_id) is not None
+        if self._spilled.pop(image_id) is not None:
+            self._delete_spilled(image_id)
+            found = True
+        return found
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self._images or image_id in self._spilled
+
+    def _spill_path(self, image_id: str) -> Optional[Path]:
+        # ids are generated by put, never use them as paths otherwise
+        if self.spill_dir is None or not image_id.isalnum():
+            return None
+        return self.spill_dir / f"{image_id}.pkl"
+
+    def _spill(self, image_id: str, image: StoredImage):
+        path = self._spill_path(image_id)
+        if path is None:
+            return
+        tmp_path = path.with_suffix(".tmp")
+        with self._spill_lock:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(image, f, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_path.replace(path)
+            self._spilled.put(image_id, path.stat().st_size)
+
+    def _delete_spilled(self, image_id: str, size: int = 0):
+        path = self._spill_path(image_id)
+        with self._spill_lock:
+            path.unlink(missing_ok=True)
+
+    def _clear_spill_dir(self):
+        paths = list(self.spill_dir.glob("*.pkl")) + list(self.spill_dir.glob("*.tmp"))
+        if paths:
+            logger.info(f"Delete {len(paths)} spilled images of previous runs")
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    def _load_spilled(self, image_id: str) -> Optional[StoredImage]:
+        path = self._spill_path(image_id)
+        with self._spill_lock:
+            if path is None or self._spilled.pop(image_id) is None:
+                return None
+            try:
+                with open(path, "rb") as f:
+                    image = pickle.load(f)
+            except Exception as e:
+                logger.warning(f"Failed to load spilled image {image_id}: {e}")
+                return None
+            finally:
+                path.unlink(missing_ok=True)
+        return image
@@ -0,0 +1,238 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from iopaint.lru_cache import nbytes
+from iopaint.schema import JobInfo, JobStatus
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Job queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Job:
+    def __init__(self, fn: Callable[["Job"], Any], priority: int = 0):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.priority = priority
+        self.status = JobStatus.pending
+        self.result = None
+        self.error: Optional[str] = None
+        self.exception: Optional[Exception] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # metric labels of the request, e.g. model and image size
+        self.labels: Dict[str, str] = {}
+        self._done = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    @property
+    def queue_time_ms(self) -> Optional[float]:
+        end = self.started_at or self.finished_at
+        if end is None:
+            return None
+        return (end - self.created_at) * 1000
+
+    @property
+    def run_time_ms(self) -> Optional[float]:
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at) * 1000
+
+    def _finish(self, status: JobStatus, result=None, error: Optional[str] = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self._done.set()
+
+
+class JobQueue:
+    """Bounded priority queue served by a pool of worker threads.
+
+    Lower ``priority`` values run first, jobs with the same priority run in
+    submission order. Finished jobs are kept for polling until more than
+    ``max_finished_jobs`` have accumulated, or their results take more than
+    ``max_finished_size`` bytes. The latest finished job is always kept.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = 1,
+        max_size: int = 16,
+        max_finished_jobs: int = 256,
+        max_finished_size: int = 256 * 1024 * 1024,
+        name: str = "inpaint",
+    ):
+        assert num_workers >= 1, "num_workers must be >= 1"
+        self.num_workers = num_workers
+        self.max_size = max_size
+        self.max_finished_jobs = max_finished_jobs
+        self.max_finished_size = max_finished_size
+        self.name = name
+
+        self._heap: List = []
+        self._counter = itertools.count()
+        self._jobs: Dict[str, Job] = {}
+        # finished job id -> bytes of its result
+        self._finished: "OrderedDict[str, int]" = OrderedDict()
+        self._finished_size = 0
+        self._cond = threading.Condition()
+        self._running = 0
+        self._paused = False
+        self._stopped = False
+        # exponential moving average of run time, used to estimate Retry-After
+        self._avg_run_time = None
+        self._workers = [
+            threading.Thread(
+                target=self._worker_loop, name=f"{name}-worker-{i}", daemon=True
+            )
+            for i in range(num_workers)
+        ]
+        for it in self._workers:
+            it.start()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def submit(self, fn: Callable[[Job], Any], priority: int = 0) -> Job:
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError(f"{self.name} job queue is stopped")
+            if len(self._heap) >= self.max_size:
+                raise QueueFullError(self._retry_after())
+            job = Job(fn, priority)
+            self._jobs[job.id] = job
+            heapq.heappush(self._heap, (priority, next(self._counter), job))
+            self._cond.notify()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a pending job. Running jobs can not be interrupted."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != JobStatus.pending:
+                return False
+            self._heap = [it for it in self._heap if it[2] is not job]
+            heapq.heapify(self._heap)
+            job._finish(JobStatus.cancelled)
+            self._record_finished(job)
+            return True
+
+    def position(self, job: Job) -> Optional[int]:
+        with self._cond:
+            if job.status != JobStatus.pending:
+                return None
+            entry = next(it for it in self._heap if it[2] is job)
+            return sum(1 for it in self._heap if it[:2] < entry[:2])
+
+    def info(self, job: Job) -> JobInfo:
+        return JobInfo(
+            id=job.id,
+            status=job.status,
+            position=self.position(job),
+            error=job.error,
+            queue_time_ms=job.queue_time_ms,
+            run_time_ms=job.run_time_ms,
+        )
+
+    @contextmanager
+    def exclusive(self):
+        """Stop dispatching new jobs and wait for running ones to finish,
+        e.g. while the model is being switched."""
+        with self._cond:
+            while self._paused:
+                self._cond.wait()
+            self._paused = True
+            while self._running > 0:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._paused = False
+                self._cond.notify_all()
+
+    def shutdown(self, wait: bool = True):
+        with self._cond:
+            self._stopped = True
+            for _, _, job in self._heap:
+                job._finish(JobStatus.cancelled)
+            self._heap = []
+            self._cond.notify_all()
+        if wait:
+            for it in self._workers:
+                it.join()
+
+    def _retry_after(self) -> int:
+        avg = self._avg_run_time if self._avg_run_time is not None else 1.0
+        return max(1, math.ceil(avg * (len(self._heap) + 1) / self.num_workers))
+
+    def _record_finished(self, job: Job):
+        size = nbytes(job.result)
+        self._finished[job.id] = size
+        self._finished_size += size
+        while len(self._finished) > 1 and (
+            len(self._finished) > self.max_finished_jobs
+            or self._finished_size > self.max_finished_size
+        ):
+            old_id, old_size = self._finished.popitem(last=False)
+            self._finished_size -= old_size
+            self._jobs.pop(old_id, None)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (self._paused or not self._heap):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+                job.status = JobStatus.running
+                job.started_at = time.time()
+                self._running += 1
+
+            try:
+                result = job.fn(job)
+                status, error = JobStatus.succeeded, None
+            except Exception as e:
+                logger.exception(f"{self.name} job {job.id} failed")
+                result, status, error = None, JobStatus.failed, str(e)
+                job.exception = e
+
+            with self._cond:
+                job._finish(status, result, error)
+                run_time = job.finished_at - job.started_at
+                if self._avg_run_time is None:
+                    self._avg_run_time = run_time
+                else:
+                    self._avg_run_time = 0.8 * self._avg_run_time + 0.2 * run_time
+                self._running -= 1
+                self._record_finished(job)
+                self._cond.notify_all()
+            logger.info(
+                f"{self.name} job {job.id} {status.value}, "
+                f"queue time: {job.queue_time_ms:.2f}ms, run time: {job.run_time_ms:.2f}ms"
+            )
@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+import torch
+
+
+def nbytes(value) -> int:
+    """Memory held by arrays and tensors in value, including nested containers"""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(nbytes(it) for it in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(it) for it in value)
+    return 0
+
+
+class LRUCache:
+    """Thread safe cache bounded by the total size of its values. Least recently
+    used values are evicted once the size exceeds ``max_size`` bytes, a value
+    larger than ``max_size`` is not cached at all. ``on_evict(key, value)`` is
+    called for evicted values, outside of the cache lock."""
+
+    def __init__(
+        self,
+        max_size: int,
+        size_fn: Callable[[Any], int] = nbytes,
+        on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        self.max_size = max_size
+        self.size_fn = size_fn
+        self.on_evict = on_evict
+        self.size = 0
+        self._items: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key: Hashable, value) -> bool:
+        size = self.size_fn(value)
+        evicted = []
+        cached = size <= self.max_size
+        with self._lock:
+            self._pop(key)
+            if not cached:
+                evicted.append((key, value))
+            else:
+                self._items[key] = (value, size)
+                self.size += size
+                while self.size > self.max_size:
+                    evicted_key = next(iter(self._items))
+                    evicted.append((evicted_key, self._pop(evicted_key)[0]))
+        if self.on_evict is not None:
+            for it in evicted:
+                self.on_evict(*it)
+        return cached
+
+    def pop(self, key: Hashable, default=None):
+        with self._lock:
+            item = self._pop(key)
+            return default if item is None else item[0]
+
+    def _pop(self, key: Hashable) -> Optional[tuple]:
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+        return item
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def keys(self):
+        with self._lock:
+            return list(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
@@ -0,0 +1,153 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+_local = threading.local()
+
+# seconds, covers cheap stages like threshold up to slow diffusion runs
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    30.0, 60.0,
+)  # fmt: skip
+SPAN_LABELS = ("stage", "model", "plugin", "strategy", "size")
+
+
+def size_bucket(height: int, width: int) -> str:
+    """Coarse image size label, keeps the number of series small"""
+    longest = max(height, width)
+    for limit in [512, 1024, 2048]:
+        if longest <= limit:
+            return f"<={limit}"
+    return ">2048"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    """Prometheus histogram, one series per label values"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._lock = threading.Lock()
+        # label values -> [bucket counts, sum, count]
+        self._series: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(it) or "") for it in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self._series[key] = series
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels) -> int:
+        key = tuple(str(labels.get(it) or "") for it in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            return series[2] if series else 0
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            labels = ",".join(
+                f'{name}="{_escape(value)}"'
+                for name, value in zip(self.labelnames, key)
+            )
+            cumulative = 0
+            for upper, it in zip(self.buckets, counts):
+                cumulative += it
+                sep = "," if labels else ""
+                lines.append(
+                    f'{self.name}_bucket{{{labels}{sep}le="{_format_value(upper)}"}} {cumulative}'
+                )
+            lines.append(f"{self.name}_sum{{{labels}}} {_format_value(total)}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, documentation: str, labelnames, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(
+                    name, documentation, labelnames, **kwargs
+                )
+            return self._metrics[name]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(it.render() for it in metrics)
+
+
+registry = MetricsRegistry()
+stage_seconds = registry.histogram(
+    "iopaint_stage_duration_seconds",
+    "Time spent in each stage of a request",
+    SPAN_LABELS,
+)
+
+
+def current_labels() -> Dict[str, str]:
+    return getattr(_local, "labels", {})
+
+
+@contextmanager
+def metric_labels(**labels):
+    """Labels added to every span recorded by the current thread, e.g. the model
+    and hd strategy of the request being processed"""
+    old_labels = current_labels()
+    _local.labels = {**old_labels, **{k: v for k, v in labels.items() if v}}
+    try:
+        yield
+    finally:
+        _local.labels = old_labels
+
+
+@contextmanager
+def span(stage: str, histogram: Optional[Histogram] = None, **labels):
+    """Time the block and record it as `stage`. The yielded dict can be updated
+    inside the block, for labels only known after the work is done (e.g. the
+    size of a decoded image). Nothing is recorded if the block raises."""
+    labels = {**current_labels(), **labels}
+    start = time.perf_counter()
+    yield labels
+    labels["stage"] = stage
+    (histogram or stage_seconds).observe(time.perf_counter() - start, **labels)
@@ -1,19 +1,26 @@
 import abc
-from typing import Optional
+import itertools
+from typing import Optional, List
 
 import cv2
 import torch
 import numpy as np
+from diffusers import DiffusionPipeline
 from loguru import logger
 
 from iopaint.helper import (
     boxes_from_mask,
+    match_histograms,
+    merge_boxes,
     resize_max_size,
     pad_img_to_modulo,
     switch_mps_device,
 )
+from iopaint.metrics import metric_labels, size_bucket, span
 from iopaint.schema import InpaintRequest, HDStrategy, SDSampler
 from .helper.g_diffuser_bot import expand_image
+from .micro_batch import MicroBatcher
+from .tiling import available_memory, feather_weight, pick_tile_size, tile_boxes
 from .utils import get_scheduler
 
 
@@ -23,6 +30,19 @@ class InpaintModel:
     pad_mod = 8
     pad_to_square = False
     is_erase_model = False
+    # models that only run at one input size, their _call resizes crops to it
+    fixed_input_size: Optional[int] = None
+    # forward_batch runs several same size inputs in one model call
+    support_batch = False
+    # max number of crops in one forward_batch call
+    max_batch_size = 8
+    # weights can be moved between devices with to(), see ModelCache
+    can_offload = True
+    # peak memory of a forward pass per input pixel, picks the tile size of
+    # HDStrategy.TILE. A heuristic shared by all models, not measured per model:
+    # the picked tile size may not fit in memory for heavier models, set
+    # hd_strategy_tile_size in the request then
+    memory_per_pixel = 4096
 
     def __init__(self, device, **kwargs):
         """
@@ -34,6 +54,16 @@ class InpaintModel:
         self.device = device
         self.init_model(device, **kwargs)
 
+        self.micro_batcher = None
+        erase_batch_size = kwargs.get("erase_batch_size", 1)
+        if self.support_batch and erase_batch_size > 1:
+            logger.info(f"Enable micro batching for {self.name}: {erase_batch_size}")
+            self.micro_batcher = MicroBatcher(
+                self.forward_batch,
+                max_batch_size=erase_batch_size,
+                max_wait_ms=kwargs.get("erase_batch_wait_ms", 5.0),
+            )
+
     @abc.abstractmethod
     def init_model(self, device, **kwargs): ...
 
@@ -51,23 +81,115 @@ class InpaintModel:
         """
         ...
 
+    def forward_batch(
+        self, images: List[np.ndarray], masks: List[np.ndarray], config: InpaintRequest
+    ) -> List[np.ndarray]:
+        """Input images in a batch have the same size
+        images: list of [H, W, C] RGB
+        masks: list of [H, W]
+        return: list of BGR IMAGE
+        """
+        return [self.forward(image, mask, config) for image, mask in zip(images, masks)]
+
     @staticmethod
     def download(): ...
 
-    def _pad_forward(self, image, mask, config: InpaintRequest):
-        origin_height, origin_width = image.shape[:2]
+    def _torch_modules(self) -> List[torch.nn.Module]:
+        modules = []
+        for value in vars(self).values():
+            if isinstance(value, torch.nn.Module):
+                modules.append(value)
+            elif isinstance(value, DiffusionPipeline):
+                modules.extend(
+                    it
+                    for it in value.components.values()
+                    if isinstance(it, torch.nn.Module)
+                )
+        return modules
+
+    def memory_size(self) -> int:
+        """Bytes of weights held by the model"""
+        tensors = {}
+        for module in self._torch_modules():
+            for it in itertools.chain(module.parameters(), module.buffers()):
+                tensors[id(it)] = it.numel() * it.element_size()
+        for value in vars(self).values():
+            if isinstance(value, torch.Tensor):
+                tensors[id(value)] = value.numel() * value.element_size()
+        return sum(tensors.values())
+
+    def to(self, device):
+        """Move the model to device, e.g. to offload a cold model to cpu"""
+        for name, value in list(vars(self).items()):
+            if isinstance(value, (torch.nn.Module, torch.Tensor, DiffusionPipeline)):
+                setattr(self, name, value.to(device))
+        self.device = device
+        return self
+
+    def _pad(self, image, mask):
         pad_image = pad_img_to_modulo(
             image, mod=self.pad_mod, square=self.pad_to_square, min_size=self.min_size
         )
         pad_mask = pad_img_to_modulo(
             mask, mod=self.pad_mod, square=self.pad_to_square, min_size=self.min_size
         )
+        return pad_image, pad_mask
+
+    def _pad_forward(self, image, mask, config: InpaintRequest):
+        with span("pad"):
+            pad_image, pad_mask = self._pad(image, mask)
 
         # logger.info(f"final forward pad size: {pad_image.shape}")
 
+        with span("forward"):
+            if self.micro_batcher is not None:
+                result = self.micro_batcher(pad_image, pad_mask, config)
+            else:
+                result = self.forward(pad_image, pad_mask, config)
+        with span("post_process"):
+            return self._unpad_post_process(result, image, mask, config)
+
+    def _pad_forward_batch(
+        self, images, masks, config: InpaintRequest, batch_size: Optional[int] = None
+    ):
+        """Same as _pad_forward for a list of inputs. Inputs with the same padded
+        size run together through forward_batch, so every result is the same as
+        running it alone."""
+        batch_size = batch_size or self.max_batch_size
+        if not self.support_batch or len(images) == 1:
+            return [
+                self._pad_forward(image, mask, config)
+                for image, mask in zip(images, masks)
+            ]
+
+        with span("pad"):
+            padded = [self._pad(image, mask) for image, mask in zip(images, masks)]
+        buckets = {}
+        for i, (pad_image, pad_mask) in enumerate(padded):
+            buckets.setdefault(pad_image.shape, []).append(i)
+
+        results = [None] * len(images)
+        for shape, indices in buckets.items():
+            for start in range(0, len(indices), batch_size):
+                batch = indices[start : start + batch_size]
+                if len(batch) > 1:
+                    logger.info(f"Run batch of {len(batch)} crops, shape: {shape}")
+                with span("forward"):
+                    outputs = self.forward_batch(
+                        [padded[i][0] for i in batch],
+                        [padded[i][1] for i in batch],
+                        config,
+                    )
+                with span("post_process"):
+                    for i, output in zip(batch, outputs):
+                        results[i] = self._unpad_post_process(
+                            output, images[i], masks[i], config
+                        )
+        return results
+
+    def _unpad_post_process(self, result, image, mask, config: InpaintRequest):
+        origin_height, origin_width = image.shape[:2]
         image, mask = self.forward_pre_process(image, mask, config)
-
-        result = self.forward(pad_image, pad_mask, config)
         result = result[0:origin_height, 0:origin_width, :]
 
         result, image, mask = self.forward_post_process(result, image, mask, config)
@@ -84,37 +206,91 @@ class InpaintModel:
         return result, image, mask
 
     @torch.no_grad()
-    def __call__(self, image, mask, config: InpaintRequest):
+    def __call__(self, image, mask, config: InpaintRequest, prev_mask=None):
         """
         images: [H, W, C] RGB, not normalized
         masks: [H, W]
+        prev_mask: [H, W], mask already inpainted in image, see _call_incremental
         return: BGR IMAGE
         """
+        incremental = (
+            prev_mask is not None
+            and self.is_erase_model
+            and prev_mask.shape[:2] == mask.shape[:2]
+        )
+        with metric_labels(
+            model=self.name,
+            strategy="Incremental" if incremental else self._strategy_label(config),
+            size=size_bucket(*image.shape[:2]),
+        ):
+            if incremental:
+                return self._call_incremental(image, mask, prev_mask, config)
+            return self._call(image, mask, config)
+
+    def _call_incremental(self, image, mask, prev_mask, config: InpaintRequest):
+        """Only inpaint the part of mask outside prev_mask. image is the result of
+        inpainting prev_mask, the model runs on crops around the new strokes and
+        only their pixels are replaced, so the cost depends on the size of the new
+        strokes instead of the image."""
+        with span("pre_process"):
+            new_mask = mask.copy()
+            new_mask[prev_mask > 127] = 0
+            new_region = new_mask > 127
+
+        if self.fixed_input_size is not None:
+            # _call already crops around the strokes and resizes the crops
+            logger.info("Run incremental inpainting")
+            call_result = self._call(image, new_mask, config)
+            with span("post_process"):
+                inpaint_result = image[:, :, ::-1].copy()
+                inpaint_result[new_region] = call_result[new_region]
+            return inpaint_result
+
+        with span("pre_process"):
+            boxes = boxes_from_mask(new_mask)
+            if self.support_batch:
+                boxes = merge_boxes(boxes, config.hd_strategy_crop_margin)
+        logger.info(f"Run incremental inpainting, {len(boxes)} new regions")
+        crop_result = self._run_boxes(image, new_mask, boxes, config)
+
+        with span("post_process"):
+            inpaint_result = image[:, :, ::-1].copy()
+            for crop_image, (x1, y1, x2, y2) in crop_result:
+                region = new_region[y1:y2, x1:x2]
+                inpaint_result[y1:y2, x1:x2][region] = crop_image[region]
+        return inpaint_result
+
+    def _strategy_label(self, config: InpaintRequest) -> str:
+        return HDStrategy(config.hd_strategy).value
+
+    def _call(self, image, mask, config: InpaintRequest):
         inpaint_result = None
         # logger.info(f"hd_strategy: {config.hd_strategy}")
         if config.hd_strategy == HDStrategy.CROP:
             if max(image.shape) > config.hd_strategy_crop_trigger_size:
                 logger.info("Run crop strategy")
-                boxes = boxes_from_mask(mask)
-                crop_result = []
-                for box in boxes:
-                    crop_image, crop_box = self._run_box(image, mask, box, config)
-                    crop_result.append((crop_image, crop_box))
-
-                inpaint_result = image[:, :, ::-1]
-                for crop_image, crop_box in crop_result:
-                    x1, y1, x2, y2 = crop_box
-                    inpaint_result[y1:y2, x1:x2, :] = crop_image
+                with span("pre_process"):
+                    boxes = boxes_from_mask(mask)
+                    if self.support_batch:
+                        boxes = merge_boxes(boxes, config.hd_strategy_crop_margin)
+                crop_result = self._run_boxes(image, mask, boxes, config)
+
+                with span("post_process"):
+                    inpaint_result = image[:, :, ::-1]
+                    for crop_image, crop_box in crop_result:
+                        x1, y1, x2, y2 = crop_box
+                        inpaint_result[y1:y2, x1:x2, :] = crop_image
 
         elif config.hd_strategy == HDStrategy.RESIZE:
             if max(image.shape) > config.hd_strategy_resize_limit:
                 origin_size = image.shape[:2]
-                downsize_image = resize_max_size(
-                    image, size_limit=config.hd_strategy_resize_limit
-                )
-                downsize_mask = resize_max_size(
-                    mask, size_limit=config.hd_strategy_resize_limit
-                )
+                with span("pre_process"):
+                    downsize_image = resize_max_size(
+                        image, size_limit=config.hd_strategy_resize_limit
+                    )
+                    downsize_mask = resize_max_size(
+                        mask, size_limit=config.hd_strategy_resize_limit
+                    )
 
                 logger.info(
                     f"Run resize strategy, origin size: {image.shape} forward size: {downsize_image.shape}"
@@ -124,21 +300,82 @@ class InpaintModel:
                 )
 
                 # only paste masked area result
-                inpaint_result = cv2.resize(
-                    inpaint_result,
-                    (origin_size[1], origin_size[0]),
-                    interpolation=cv2.INTER_CUBIC,
+                with span("post_process"):
+                    inpaint_result = cv2.resize(
+                        inpaint_result,
+                        (origin_size[1], origin_size[0]),
+                        interpolation=cv2.INTER_CUBIC,
+                    )
+                    original_pixel_indices = mask < 127
+                    inpaint_result[original_pixel_indices] = image[:, :, ::-1][
+                        original_pixel_indices
+                    ]
+
+        elif config.hd_strategy == HDStrategy.TILE:
+            tile_size, batch_size = self._tile_size(config)
+            if max(image.shape[:2]) > tile_size:
+                inpaint_result = self._run_tiles(
+                    image, mask, tile_size, batch_size, config
                 )
-                original_pixel_indices = mask < 127
-                inpaint_result[original_pixel_indices] = image[:, :, ::-1][
-                    original_pixel_indices
-                ]
 
         if inpaint_result is None:
             inpaint_result = self._pad_forward(image, mask, config)
 
         return inpaint_result
 
+    def _tile_size(self, config: InpaintRequest):
+        """Tile size and number of tiles in one forward_batch call. Unless set in
+        config, the tile size is the largest one a forward pass should fit in half
+        of the free memory of the device, estimated with memory_per_pixel."""
+        budget = available_memory(self.device) // 2
+        tile_size = config.hd_strategy_tile_size
+        if not tile_size:
+            tile_size = pick_tile_size(budget, self.memory_per_pixel)
+        batch_size = budget // (tile_size**2 * self.memory_per_pixel)
+        return tile_size, int(min(max(batch_size, 1), self.max_batch_size))
+
+    def _run_tiles(self, image, mask, tile_size, batch_size, config: InpaintRequest):
+        """Run the model on overlapping tiles containing masked pixels, blend them
+        with feathered weights and keep the pixels outside the mask"""
+        height, width = image.shape[:2]
+        overlap = min(config.hd_strategy_tile_overlap, tile_size // 2)
+        with span("pre_process"):
+            boxes = [
+                box
+                for box in tile_boxes(height, width, tile_size, overlap)
+                if (mask[box[1] : box[3], box[0] : box[2]] > 127).any()
+            ]
+        logger.info(
+            f"Run tile strategy, tile size: {tile_size}, overlap: {overlap}, "
+            f"{len(boxes)} tiles"
+        )
+        results = self._pad_forward_batch(
+            [image[t:b, l:r] for l, t, r, b in boxes],
+            [mask[t:b, l:r] for l, t, r, b in boxes],
+            config,
+            batch_size=batch_size,
+        )
+
+        with span("post_process"):
+            blended = np.zeros((height, width, 3), dtype=np.float32)
+            weights = np.zeros((height, width), dtype=np.float32)
+            for result, box in zip(results, boxes):
+                l, t, r, b = box
+                weight = feather_weight(box, height, width, overlap)
+                blended[t:b, l:r] += result * weight[:, :, np.newaxis]
+                weights[t:b, l:r] += weight
+
+            inpaint_result = image[:, :, ::-1].copy()
+            covered = weights > 0
+            inpaint_result[covered] = np.clip(
+                blended[covered] / weights[covered][:, np.newaxis] + 0.5, 0, 255
+            )
+            original_pixel_indices = mask < 127
+            inpaint_result[original_pixel_indices] = image[:, :, ::-1][
+                original_pixel_indices
+            ]
+        return inpaint_result
+
     def _crop_box(self, image, mask, box, config: InpaintRequest):
         """
 
@@ -191,48 +428,8 @@ class InpaintModel:
 
         return crop_img, crop_mask, [l, t, r, b]
 
-    def _calculate_cdf(self, histogram):
-        cdf = histogram.cumsum()
-        normalized_cdf = cdf / float(cdf.max())
-        return normalized_cdf
-
-    def _calculate_lookup(self, source_cdf, reference_cdf):
-        lookup_table = np.zeros(256)
-        lookup_val = 0
-        for source_index, source_val in enumerate(source_cdf):
-            for reference_index, reference_val in enumerate(reference_cdf):
-                if reference_val >= source_val:
-                    lookup_val = reference_index
-                    break
-            lookup_table[source_index] = lookup_val
-        return lookup_table
-
     def _match_histograms(self, source, reference, mask):
-        transformed_channels = []
-        if len(mask.shape) == 3:
-            mask = mask[:, :, -1]
-
-        for channel in range(source.shape[-1]):
-            source_channel = source[:, :, channel]
-            reference_channel = reference[:, :, channel]
-
-            # only calculate histograms for non-masked parts
-            source_histogram, _ = np.histogram(source_channel[mask == 0], 256, [0, 256])
-            reference_histogram, _ = np.histogram(
-                reference_channel[mask == 0], 256, [0, 256]
-            )
-
-            source_cdf = self._calculate_cdf(source_histogram)
-            reference_cdf = self._calculate_cdf(reference_histogram)
-
-            lookup = self._calculate_lookup(source_cdf, reference_cdf)
-
-            transformed_channels.append(cv2.LUT(source_channel, lookup))
-
-        result = cv2.merge(transformed_channels)
-        result = cv2.convertScaleAbs(result)
-
-        return result
+        return match_histograms(source, reference, mask)
 
     def _apply_cropper(self, image, mask, config: InpaintRequest):
         img_h, img_w = image.shape[:2]
@@ -269,15 +466,39 @@ class InpaintModel:
 
         return self._pad_forward(crop_img, crop_mask, config), [l, t, r, b]
 
+    def _run_boxes(self, image, mask, boxes, config: InpaintRequest):
+        """
+        Same as _run_box for every box, crops are run in batches when the model
+        supports it.
+
+        Returns:
+            list of (BGR IMAGE, [l, t, r, b])
+        """
+        crops = [self._crop_box(image, mask, box, config) for box in boxes]
+        results = self._pad_forward_batch(
+            [it[0] for it in crops], [it[1] for it in crops], config
+        )
+        return [(result, crop[2]) for result, crop in zip(results, crops)]
+
 
 class DiffusionInpaintModel(InpaintModel):
     def __init__(self, device, **kwargs):
         self.model_info = kwargs["model_info"]
         self.model_id_or_path = self.model_info.path
         super().__init__(device, **kwargs)
+        # offloaded or cpu text encoder pipelines manage devices by themselves
+        self.can_offload = not (
+            kwargs.get("cpu_offload", False) or kwargs.get("sd_cpu_textencoder", False)
+        )
 
-    @torch.no_grad()
-    def __call__(self, image, mask, config: InpaintRequest):
+    def _strategy_label(self, config: InpaintRequest) -> str:
+        if config.use_croper:
+            return "cropper"
+        if config.use_extender:
+            return "extender"
+        return ""
+
+    def _call(self, image, mask, config: InpaintRequest):
         """
         images: [H, W, C] RGB, not normalized
         masks: [H, W]
@@ -397,7 +618,8 @@ class DiffusionInpaintModel(InpaintModel):
 
     def forward_post_process(self, result, image, mask, config):
         if config.sd_match_histograms:
-            result = self._match_histograms(result, image[:, :, ::-1], mask)
+            with span("match_histograms"):
+                result = self._match_histograms(result, image[:, :, ::-1], mask)
 
         if config.use_extender and config.sd_mask_blur != 0:
             k = 2 * config.sd_mask_blur + 1
@@ -13,6 +13,7 @@ from iopaint.helper import (
     get_cache_path_by_url,
     norm_img,
     boxes_from_mask,
+    merge_boxes,
     resize_max_size,
     download_model,
 )
@@ -1625,8 +1626,10 @@ class FcF(InpaintModel):
     name = "fcf"
     min_size = 512
     pad_mod = 512
+    fixed_input_size = 512
     pad_to_square = True
     is_erase_model = True
+    support_batch = True
 
     def init_model(self, device, **kwargs):
         seed = 0
@@ -1654,6 +1657,10 @@ class FcF(InpaintModel):
             mapping_kwargs={"num_layers": 2},
         )
         self.model = load_model(G, FCF_MODEL_URL, device, FCF_MODEL_MD5)
+        # minibatch std mixes samples of a batch, treat every image as its own group
+        for m in self.model.modules():
+            if isinstance(m, MinibatchStdLayer):
+                m.group_size = 1
         self.label = torch.zeros([1, self.model.c_dim], device=device)
 
     @staticmethod
@@ -1664,8 +1671,7 @@ class FcF(InpaintModel):
     def is_downloaded() -> bool:
         return os.path.exists(get_cache_path_by_url(FCF_MODEL_URL))
 
-    @torch.no_grad()
-    def __call__(self, image, mask, config: InpaintRequest):
+    def _call(self, image, mask, config: InpaintRequest):
         """
         images: [H, W, C] RGB, not normalized
         masks: [H, W]
@@ -1674,15 +1680,22 @@ class FcF(InpaintModel):
         if image.shape[0] == 512 and image.shape[1] == 512:
             return self._pad_forward(image, mask, config)
 
-        boxes = boxes_from_mask(mask)
-        crop_result = []
         config.hd_strategy_crop_margin = 128
-        for box in boxes:
-            crop_image, crop_mask, crop_box = self._crop_box(image, mask, box, config)
+        boxes = merge_boxes(
+            boxes_from_mask(mask), config.hd_strategy_crop_margin, max_size=512
+        )
+        crops = [self._crop_box(image, mask, box, config) for box in boxes]
+        # every crop is resized and padded to 512x512, so they run in one batch
+        inpaint_results = self._pad_forward_batch(
+            [resize_max_size(it[0], size_limit=512) for it in crops],
+            [resize_max_size(it[1], size_limit=512) for it in crops],
+            config,
+        )
+        crop_result = []
+        for (crop_image, crop_mask, crop_box), inpaint_result in zip(
+            crops, inpaint_results
+        ):
             origin_size = crop_image.shape[:2]
-            resize_image = resize_max_size(crop_image, size_limit=512)
-            resize_mask = resize_max_size(crop_mask, size_limit=512)
-            inpaint_result = self._pad_forward(resize_image, resize_mask, config)
 
             # only paste masked area result
             inpaint_result = cv2.resize(
@@ -1711,27 +1724,26 @@ class FcF(InpaintModel):
         masks: [H, W] mask area == 255
         return: BGR IMAGE
         """
+        return self.forward_batch([image], [mask], config)[0]
 
-        image = norm_img(image)  # [0, 1]
+    def forward_batch(self, images, masks, config: InpaintRequest):
+        image = np.stack([norm_img(it) for it in images])  # [0, 1]
         image = image * 2 - 1  # [0, 1] -> [-1, 1]
-        mask = (mask > 120) * 255
-        mask = norm_img(mask)
+        mask = np.stack([norm_img((it > 120) * 255) for it in masks])
 
-        image = torch.from_numpy(image).unsqueeze(0).to(self.device)
-        mask = torch.from_numpy(mask).unsqueeze(0).to(self.device)
+        image = torch.from_numpy(image).to(self.device)
+        mask = torch.from_numpy(mask).to(self.device)
 
         erased_img = image * (1 - mask)
         input_image = torch.cat([0.5 - mask, erased_img], dim=1)
 
-        output = self.model(
-            input_image, self.label, truncation_psi=0.1, noise_mode="none"
-        )
+        label = self.label.expand(len(images), -1)
+        output = self.model(input_image, label, truncation_psi=0.1, noise_mode="none")
         output = (
             (output.permute(0, 2, 3, 1) * 127.5 + 127.5)
             .round()
             .clamp(0, 255)
             .to(torch.uint8)
         )
-        output = output[0].cpu().numpy()
-        cur_res = cv2.cvtColor(output, cv2.COLOR_RGB2BGR)
-        return cur_res
+        output = output.cpu().numpy()
+        return [cv2.cvtColor(it, cv2.COLOR_RGB2BGR) for it in output]
@@ -32,6 +32,7 @@ class LaMa(InpaintModel):
     name = "lama"
     pad_mod = 8
     is_erase_model = True
+    support_batch = True
 
     @staticmethod
     def download():
@@ -50,19 +51,21 @@ class LaMa(InpaintModel):
         mask: [H, W]
         return: BGR IMAGE
         """
-        image = norm_img(image)
-        mask = norm_img(mask)
+        return self.forward_batch([image], [mask], config)[0]
+
+    def forward_batch(self, images, masks, config: InpaintRequest):
+        image = np.stack([norm_img(it) for it in images])
+        mask = np.stack([norm_img(it) for it in masks])
 
         mask = (mask > 0) * 1
-        image = torch.from_numpy(image).unsqueeze(0).to(self.device)
-        mask = torch.from_numpy(mask).unsqueeze(0).to(self.device)
+        image = torch.from_numpy(image).to(self.device)
+        mask = torch.from_numpy(mask).to(self.device)
 
         inpainted_image = self.model(image, mask)
 
-        cur_res = inpainted_image[0].permute(1, 2, 0).detach().cpu().numpy()
+        cur_res = inpainted_image.permute(0, 2, 3, 1).detach().cpu().numpy()
         cur_res = np.clip(cur_res * 255, 0, 255).astype("uint8")
-        cur_res = cv2.cvtColor(cur_res, cv2.COLOR_RGB2BGR)
-        return cur_res
+        return [cv2.cvtColor(it, cv2.COLOR_RGB2BGR) for it in cur_res]
 
 
 class AnimeLaMa(LaMa):
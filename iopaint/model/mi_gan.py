@@ -1,6 +1,7 @@
 import os
 
 import cv2
+import numpy as np
 import torch
 
 from iopaint.helper import (
@@ -8,6 +9,7 @@ from iopaint.helper import (
     download_model,
     get_cache_path_by_url,
     boxes_from_mask,
+    merge_boxes,
     resize_max_size,
     norm_img,
 )
@@ -25,8 +27,10 @@ class MIGAN(InpaintModel):
     name = "migan"
     min_size = 512
     pad_mod = 512
+    fixed_input_size = 512
     pad_to_square = True
     is_erase_model = True
+    support_batch = True
 
     def init_model(self, device, **kwargs):
         self.model = load_jit_model(MIGAN_MODEL_URL, device, MIGAN_MODEL_MD5).eval()
@@ -39,8 +43,7 @@ class MIGAN(InpaintModel):
     def is_downloaded() -> bool:
         return os.path.exists(get_cache_path_by_url(MIGAN_MODEL_URL))
 
-    @torch.no_grad()
-    def __call__(self, image, mask, config: InpaintRequest):
+    def _call(self, image, mask, config: InpaintRequest):
         """
         images: [H, W, C] RGB, not normalized
         masks: [H, W]
@@ -49,15 +52,22 @@ class MIGAN(InpaintModel):
         if image.shape[0] == 512 and image.shape[1] == 512:
             return self._pad_forward(image, mask, config)
 
-        boxes = boxes_from_mask(mask)
-        crop_result = []
         config.hd_strategy_crop_margin = 128
-        for box in boxes:
-            crop_image, crop_mask, crop_box = self._crop_box(image, mask, box, config)
+        boxes = merge_boxes(
+            boxes_from_mask(mask), config.hd_strategy_crop_margin, max_size=512
+        )
+        crops = [self._crop_box(image, mask, box, config) for box in boxes]
+        # every crop is resized and padded to 512x512, so they run in one batch
+        inpaint_results = self._pad_forward_batch(
+            [resize_max_size(it[0], size_limit=512) for it in crops],
+            [resize_max_size(it[1], size_limit=512) for it in crops],
+            config,
+        )
+        crop_result = []
+        for (crop_image, crop_mask, crop_box), inpaint_result in zip(
+            crops, inpaint_results
+        ):
             origin_size = crop_image.shape[:2]
-            resize_image = resize_max_size(crop_image, size_limit=512)
-            resize_mask = resize_max_size(crop_mask, size_limit=512)
-            inpaint_result = self._pad_forward(resize_image, resize_mask, config)
 
             # only paste masked area result
             inpaint_result = cv2.resize(
@@ -86,14 +96,15 @@ class MIGAN(InpaintModel):
         masks: [H, W] mask area == 255
         return: BGR IMAGE
         """
+        return self.forward_batch([image], [mask], config)[0]
 
-        image = norm_img(image)  # [0, 1]
+    def forward_batch(self, images, masks, config: InpaintRequest):
+        image = np.stack([norm_img(it) for it in images])  # [0, 1]
         image = image * 2 - 1  # [0, 1] -> [-1, 1]
-        mask = (mask > 120) * 255
-        mask = norm_img(mask)
+        mask = np.stack([norm_img((it > 120) * 255) for it in masks])
 
-        image = torch.from_numpy(image).unsqueeze(0).to(self.device)
-        mask = torch.from_numpy(mask).unsqueeze(0).to(self.device)
+        image = torch.from_numpy(image).to(self.device)
+        mask = torch.from_numpy(mask).to(self.device)
 
         erased_img = image * (1 - mask)
         input_image = torch.cat([0.5 - mask, erased_img], dim=1)
@@ -105,6 +116,5 @@ class MIGAN(InpaintModel):
             .clamp(0, 255)
             .to(torch.uint8)
         )
-        output = output[0].cpu().numpy()
-        cur_res = cv2.cvtColor(output, cv2.COLOR_RGB2BGR)
-        return cur_res
+        output = output.cpu().numpy()
+        return [cv2.cvtColor(it, cv2.COLOR_RGB2BGR) for it in output]
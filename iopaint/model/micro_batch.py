@@ -0,0 +1,93 @@
+import threading
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from loguru import logger
+
+from iopaint.schema import InpaintRequest
+
+# inputs and bookkeeping of a request, any other field may change the forward pass
+_REQUEST_ONLY_FIELDS = {
+    "image",
+    "image_id",
+    "mask",
+    "paint_by_example_example_image",
+    "store_result",
+    "incremental",
+}
+
+
+class _Bucket:
+    def __init__(self, config: InpaintRequest):
+        self.config = config
+        self.images: List[np.ndarray] = []
+        self.masks: List[np.ndarray] = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """Collect padded forward requests from concurrent threads into one batch.
+
+    Requests are bucketed by their padded shape and config, so every batch can
+    be stacked into a single tensor without extra padding and runs with the
+    settings of each of its requests. The first thread to open a bucket waits up to ``max_wait_ms`` for
+    others to join, then runs ``forward_batch`` for the whole bucket.
+    """
+
+    def __init__(
+        self,
+        forward_batch: Callable[
+            [List[np.ndarray], List[np.ndarray], InpaintRequest], List[np.ndarray]
+        ],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 5.0,
+    ):
+        self.forward_batch = forward_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._lock = threading.Lock()
+        self._open: Dict[Tuple, _Bucket] = {}
+
+    def __call__(self, image: np.ndarray, mask: np.ndarray, config: InpaintRequest):
+        key = (
+            image.shape,
+            mask.shape,
+            config.model_dump_json(exclude=_REQUEST_ONLY_FIELDS),
+        )
+        with self._lock:
+            bucket = self._open.get(key)
+            is_leader = bucket is None
+            if is_leader:
+                bucket = _Bucket(config)
+                self._open[key] = bucket
+            index = len(bucket.images)
+            bucket.images.append(image)
+            bucket.masks.append(mask)
+            if len(bucket.images) >= self.max_batch_size:
+                del self._open[key]
+                bucket.full.set()
+
+        if is_leader:
+            bucket.full.wait(self.max_wait_ms / 1000)
+            with self._lock:
+                if self._open.get(key) is bucket:
+                    del self._open[key]
+            if len(bucket.images) > 1:
+                logger.info(f"Run micro batch of {len(bucket.images)}, shape: {key[0]}")
+            try:
+                bucket.results = self.forward_batch(
+                    bucket.images, bucket.masks, bucket.config
+                )
+            except Exception as e:
+                bucket.error = e
+            finally:
+                bucket.done.set()
+        else:
+            bucket.done.wait()
+
+        if bucket.error is not None:
+            raise bucket.error
+        return bucket.results[index]
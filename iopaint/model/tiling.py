@@ -0,0 +1,78 @@
+import os
+from typing import List
+
+import numpy as np
+import torch
+
+
+def tile_starts(length: int, tile: int, overlap: int) -> List[int]:
+    """Start of every tile along one side, the last tile ends at the border so
+    all tiles have the same size"""
+    if length <= tile:
+        return [0]
+    stride = max(tile - overlap, 1)
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def tile_boxes(height: int, width: int, tile: int, overlap: int) -> List[List[int]]:
+    """[left, top, right, bottom] of overlapping tiles covering the image"""
+    return [
+        [left, top, min(left + tile, width), min(top + tile, height)]
+        for top in tile_starts(height, tile, overlap)
+        for left in tile_starts(width, tile, overlap)
+    ]
+
+
+def feather_weight(box: List[int], height: int, width: int, overlap: int):
+    """Blending weight of a tile, ramps up over the overlap on the sides shared
+    with other tiles, so seams fade between neighbours"""
+    left, top, right, bottom = box
+
+    def ramp(length, start_open, end_open):
+        weight = np.ones(length, dtype=np.float32)
+        n = min(overlap, length // 2)
+        if n > 0:
+            up = np.arange(1, n + 1, dtype=np.float32) / (n + 1)
+            if start_open:
+                weight[:n] = np.minimum(weight[:n], up)
+            if end_open:
+                weight[length - n :] = np.minimum(weight[length - n :], up[::-1])
+        return weight
+
+    weight_y = ramp(bottom - top, top > 0, bottom < height)
+    weight_x = ramp(right - left, left > 0, right < width)
+    return np.outer(weight_y, weight_x)
+
+
+def available_memory(device) -> int:
+    """Free memory in bytes on device, for cpu and mps the available system memory"""
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024**3
+
+
+def pick_tile_size(
+    memory: int,
+    memory_per_pixel: int,
+    min_size: int = 256,
+    max_size: int = 2048,
+    mod: int = 64,
+) -> int:
+    """Largest square tile whose forward pass fits in memory, as far as the
+    memory_per_pixel estimate holds"""
+    side = int((memory / memory_per_pixel) ** 0.5)
+    side = min(max(side, min_size), max_size)
+    return max(side // mod * mod, mod)
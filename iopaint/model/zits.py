@@ -1,11 +1,11 @@
 import os
-import time
 
 import cv2
 import torch
 import torch.nn.functional as F
 
 from iopaint.helper import get_cache_path_by_url, load_jit_model, download_model
+from iopaint.metrics import span
 from iopaint.schema import InpaintRequest
 import numpy as np
 
@@ -80,12 +80,25 @@ def to_tensor(img, scale=True, norm=False):
     return img_t
 
 
+# neighbours (dy, dx) of the four diagonal direction filters of the original
+# implementation: up-left, down-left, up-right, down-right
+DIRECT_NEIGHBOURS = [
+    [(-1, -1), (-1, 0), (0, -1)],
+    [(0, -1), (1, -1), (1, 0)],
+    [(-1, 0), (-1, 1), (0, 1)],
+    [(0, 1), (1, 0), (1, 1)],
+]
+
+
 def load_masked_position_encoding(mask):
-    ones_filter = np.ones((3, 3), dtype=np.float32)
-    d_filter1 = np.array([[1, 1, 0], [1, 1, 0], [0, 0, 0]], dtype=np.float32)
-    d_filter2 = np.array([[0, 0, 0], [1, 1, 0], [1, 1, 0]], dtype=np.float32)
-    d_filter3 = np.array([[0, 1, 1], [0, 1, 1], [0, 0, 0]], dtype=np.float32)
-    d_filter4 = np.array([[0, 0, 0], [0, 1, 1], [0, 1, 1]], dtype=np.float32)
+    """Distance of every masked pixel to the known area on a 256x256 grid and the
+    directions it is reached from.
+
+    The original implementation grows the known area one ring per iteration with
+    3x3 filters, so the ring a pixel is reached in is its chessboard distance to the
+    known area, and a direction is set when one of its neighbours on that side is
+    reached in an earlier ring. Both are computed in one pass here.
+    """
     str_size = 256
     pos_num = 128
 
@@ -95,39 +108,23 @@ def load_masked_position_encoding(mask):
     mask = cv2.resize(mask, (str_size, str_size), interpolation=cv2.INTER_AREA)
     mask[mask > 0] = 255
     h, w = mask.shape[0:2]
-    mask3 = mask.copy()
-    mask3 = 1.0 - (mask3 / 255.0)
-    pos = np.zeros((h, w), dtype=np.int32)
+
+    hole = (mask > 0).astype(np.uint8)
+    if hole.all():
+        # no known pixel to measure the distance to
+        pos = np.zeros((h, w), dtype=np.int32)
+    else:
+        pos = cv2.distanceTransform(hole, cv2.DIST_C, 3).astype(np.int32)
+
+    # same border handling as cv2.filter2D
+    padded = cv2.copyMakeBorder(pos, 1, 1, 1, 1, cv2.BORDER_REFLECT_101)
     direct = np.zeros((h, w, 4), dtype=np.int32)
-    i = 0
-    while np.sum(1 - mask3) > 0:
-        i += 1
-        mask3_ = cv2.filter2D(mask3, -1, ones_filter)
-        mask3_[mask3_ > 0] = 1
-        sub_mask = mask3_ - mask3
-        pos[sub_mask == 1] = i
-
-        m = cv2.filter2D(mask3, -1, d_filter1)
-        m[m > 0] = 1
-        m = m - mask3
-        direct[m == 1, 0] = 1
-
-        m = cv2.filter2D(mask3, -1, d_filter2)
-        m[m > 0] = 1
-        m = m - mask3
-        direct[m == 1, 1] = 1
-
-        m = cv2.filter2D(mask3, -1, d_filter3)
-        m[m > 0] = 1
-        m = m - mask3
-        direct[m == 1, 2] = 1
-
-        m = cv2.filter2D(mask3, -1, d_filter4)
-        m[m > 0] = 1
-        m = m - mask3
-        direct[m == 1, 3] = 1
-
-        mask3 = mask3_
+    for i, neighbours in enumerate(DIRECT_NEIGHBOURS):
+        nearest = np.min(
+            [padded[1 + dy : 1 + dy + h, 1 + dx : 1 + dx + w] for dy, dx in neighbours],
+            axis=0,
+        )
+        direct[:, :, i] = nearest < pos
 
     abs_pos = pos.copy()
     rel_pos = pos / (str_size / 2)  # to 0~1 maybe larger than 1
@@ -190,7 +187,8 @@ def load_image(img, mask, device, sigma256=3.0):
     # line
     img_512 = resize(img, 512, 512)
 
-    rel_pos, abs_pos, direct = load_masked_position_encoding(mask)
+    with span("masked_position_encoding"):
+        rel_pos, abs_pos, direct = load_masked_position_encoding(mask)
 
     batch = dict()
     batch["images"] = to_tensor(img.copy()).unsqueeze(0).to(device)
@@ -278,32 +276,29 @@ class ZITS(InpaintModel):
             items["line"] = torch.zeros_like(items["masks"])
             return
 
-        start = time.time()
-        try:
-            line_256 = self.wireframe_forward(
-                items["img_512"],
-                h=256,
-                w=256,
-                masks=items["mask_512"],
-                mask_th=0.85,
-            )
-        except:
-            line_256 = torch.zeros_like(items["mask_256"])
-
-        print(f"wireframe_forward time: {(time.time() - start) * 1000:.2f}ms")
+        with span("wireframe_forward"):
+            try:
+                line_256 = self.wireframe_forward(
+                    items["img_512"],
+                    h=256,
+                    w=256,
+                    masks=items["mask_512"],
+                    mask_th=0.85,
+                )
+            except:
+                line_256 = torch.zeros_like(items["mask_256"])
 
         # np_line = (line[0][0].numpy() * 255).astype(np.uint8)
         # cv2.imwrite("line.jpg", np_line)
 
-        start = time.time()
-        edge_pred, line_pred = self.sample_edge_line_logits(
-            context=[items["img_256"], items["edge_256"], line_256],
-            mask=items["mask_256"].clone(),
-            iterations=self.sample_edge_line_iterations,
-            add_v=0.05,
-            mul_v=4,
-        )
-        print(f"sample_edge_line_logits time: {(time.time() - start) * 1000:.2f}ms")
+        with span("sample_edge_line_logits"):
+            edge_pred, line_pred = self.sample_edge_line_logits(
+                context=[items["img_256"], items["edge_256"], line_256],
+                mask=items["mask_256"].clone(),
+                iterations=self.sample_edge_line_iterations,
+                add_v=0.05,
+                mul_v=4,
+            )
 
         # np_edge_pred = (edge_pred[0][0].numpy() * 255).astype(np.uint8)
         # cv2.imwrite("edge_pred.jpg", np_edge_pred)
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import torch
+from loguru import logger
+
+from iopaint.model.utils import torch_gc
+
+GB = 1024**3
+
+
+class CachedModel:
+    def __init__(self, name: str, model, state: Dict):
+        self.name = name
+        self.model = model
+        # device the model was loaded on, restored when the model is used again
+        self.device = torch.device(model.device)
+        # ModelManager flags (controlnet/brushnet...) the model was built with
+        self.state = state
+        self.size = model.memory_size()
+
+    @property
+    def on_cpu(self) -> bool:
+        return torch.device(self.model.device).type == "cpu"
+
+
+class ModelCache:
+    """Keep models that are not in use warm, so switching back to them does not
+    load them from disk again.
+
+    Cold models stay on their device while the total size of models on the
+    accelerator fits in ``vram_budget``, then the least recently used ones are
+    offloaded to cpu. Models on cpu are destroyed, least recently used first,
+    once they exceed ``ram_budget``. Budgets are in bytes and include the models
+    in use, a budget of 0 disables caching.
+    """
+
+    def __init__(self, vram_budget: int = 0, ram_budget: int = 0):
+        self.vram_budget = vram_budget
+        self.ram_budget = ram_budget
+        self._models: "OrderedDict[str, CachedModel]" = OrderedDict()
+        # memory size of every model seen, to make room before loading it again
+        self._sizes: Dict[str, int] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._models.keys())
+
+    def put(self, name: str, model, state: Dict, active_models=()):
+        self._models.pop(name, None)
+        self._models[name] = CachedModel(name, model, state)
+        self._sizes[name] = self._models[name].size
+        self.trim(active_models)
+
+    def record_size(self, name: str, model):
+        self._sizes[name] = model.memory_size()
+
+    def expected_size(self, name: str) -> Optional[int]:
+        """Memory size of model name when it was last loaded, None if never seen"""
+        return self._sizes.get(name)
+
+    def make_room(self, name: str, device, active_models=()):
+        """Trim before loading model name on device, so it fits next to the active
+        models. A model never loaded before may need the whole vram budget."""
+        size = self.expected_size(name)
+        if torch.device(device).type == "cpu":
+            self.trim(active_models, reserve_ram=size or 0)
+        else:
+            reserve = self.vram_budget if size is None else size
+            self.trim(active_models, reserve_vram=reserve)
+
+    def pop(self, name: str) -> Optional[CachedModel]:
+        """Take a cold model out of the cache and move it back to its device"""
+        entry = self._models.pop(name, None)
+        if entry is None:
+            return None
+        if torch.device(entry.model.device) != entry.device:
+            logger.info(f"Move cached model {name} to {entry.device}")
+            entry.model.to(entry.device)
+        else:
+            logger.info(f"Use cached model {name}")
+        return entry
+
+    def clear(self):
+        self._models.clear()
+        torch_gc()
+
+    def trim(self, active_models=(), reserve_vram: int = 0, reserve_ram: int = 0):
+        """Offload or evict least recently used models until budgets are met,
+        with reserve_vram/reserve_ram bytes kept free for a model about to load"""
+        active_vram, active_ram = reserve_vram, reserve_ram
+        for model in active_models:
+            if torch.device(model.device).type == "cpu":
+                active_ram += model.memory_size()
+            else:
+                active_vram += model.memory_size()
+
+        vram_used = active_vram
+        vram_used += sum(it.size for it in self._models.values() if not it.on_cpu)
+        for entry in list(self._models.values()):
+            if vram_used <= self.vram_budget:
+                break
+            if entry.on_cpu:
+                continue
+            vram_used -= entry.size
+            if entry.model.can_offload and entry.size <= self.ram_budget:
+                logger.info(f"Offload cached model {entry.name} to cpu")
+                entry.model.to(torch.device("cpu"))
+            else:
+                logger.info(f"Evict cached model {entry.name}")
+                del self._models[entry.name]
+
+        ram_used = active_ram
+        ram_used += sum(it.size for it in self._models.values() if it.on_cpu)
+        for entry in list(self._models.values()):
+            if ram_used <= self.ram_budget:
+                break
+            if not entry.on_cpu:
+                continue
+            logger.info(f"Evict cached model {entry.name}")
+            ram_used -= entry.size
+            del self._models[entry.name]
+        torch_gc()
@@ -1,4 +1,6 @@
-from typing import List, Dict
+import threading
+from contextlib import nullcontext
+from typing import List, Dict, Optional
 
 import torch
 from loguru import logger
@@ -11,6 +13,7 @@ from iopaint.model.brushnet.brushnet_wrapper import BrushNetWrapper
 from iopaint.model.brushnet.brushnet_xl_wrapper import BrushNetXLWrapper
 from iopaint.model.power_paint.power_paint_v2 import PowerPaintV2
 from iopaint.model.utils import torch_gc, is_local_files_only
+from iopaint.model_cache import GB, ModelCache
 from iopaint.schema import InpaintRequest, ModelInfo, ModelType
 
 
@@ -37,39 +40,52 @@ class ModelManager:
 
         self.enable_powerpaint_v2 = kwargs.get("enable_powerpaint_v2", False)
 
+        self.model_cache = ModelCache(
+            vram_budget=int(kwargs.get("model_cache_vram_gb", 0) * GB),
+            ram_budget=int(kwargs.get("model_cache_ram_gb", 0) * GB),
+        )
+        # models used by requests with InpaintRequest.model:
+        # name -> [model, users, lock held while a request runs on the model]
+        self._routed: Dict[str, List] = {}
+        self._lock = threading.RLock()
+        # diffusers schedulers keep state and controlnet/brushnet/lcm lora switches
+        # replace self.model, so calls of the current model run one at a time
+        self._model_lock = threading.Lock()
         self.model = self.init_model(name, device, **kwargs)
 
     @property
     def current_model(self) -> ModelInfo:
         return self.available_models[self.name]
 
-    def init_model(self, name: str, device, **kwargs):
+    def init_model(self, name: str, device, state: Optional[Dict] = None, **kwargs):
         logger.info(f"Loading model: {name}")
         if name not in self.available_models:
             raise NotImplementedError(
                 f"Unsupported model: {name}. Available models: {list(self.available_models.keys())}"
             )
 
+        if state is None:
+            state = self._model_state()
         model_info = self.available_models[name]
         kwargs = {
             **kwargs,
             "model_info": model_info,
-            "enable_controlnet": self.enable_controlnet,
-            "controlnet_method": self.controlnet_method,
-            "enable_brushnet": self.enable_brushnet,
-            "brushnet_method": self.brushnet_method,
+            "enable_controlnet": state["enable_controlnet"],
+            "controlnet_method": state["controlnet_method"],
+            "enable_brushnet": state["enable_brushnet"],
+            "brushnet_method": state["brushnet_method"],
         }
 
-        if model_info.support_controlnet and self.enable_controlnet:
+        if model_info.support_controlnet and state["enable_controlnet"]:
             return ControlNet(device, **kwargs)
 
-        if model_info.support_brushnet and self.enable_brushnet:
+        if model_info.support_brushnet and state["enable_brushnet"]:
             if model_info.model_type == ModelType.DIFFUSERS_SD:
                 return BrushNetWrapper(device, **kwargs)
             elif model_info.model_type == ModelType.DIFFUSERS_SDXL:
                 return BrushNetXLWrapper(device, **kwargs)
 
-        if model_info.support_powerpaint_v2 and self.enable_powerpaint_v2:
+        if model_info.support_powerpaint_v2 and state["enable_powerpaint_v2"]:
             return PowerPaintV2(device, **kwargs)
 
         if model_info.name in models:
@@ -90,25 +106,127 @@ class ModelManager:
         raise NotImplementedError(f"Unsupported model: {name}")
 
     @torch.inference_mode()
-    def __call__(self, image, mask, config: InpaintRequest):
+    def __call__(self, image, mask, config: InpaintRequest, **kwargs):
         """
 
         Args:
             image: [H, W, C] RGB
             mask: [H, W, 1] 255 means area to repaint
             config:
+            kwargs: passed to the model, e.g. prev_mask for incremental inpainting
 
         Returns:
             BGR image
         """
-        if config.enable_controlnet:
-            self.switch_controlnet_method(config)
-        if config.enable_brushnet:
-            self.switch_brushnet_method(config)
-
-        self.enable_disable_powerpaint_v2(config)
-        self.enable_disable_lcm_lora(config)
-        return self.model(image, mask, config).astype(np.uint8)
+        if config.model and config.model != self.name:
+            return self._routed_call(config.model, image, mask, config, **kwargs)
+
+        with self._call_lock(self.name, self.model):
+            if config.enable_controlnet:
+                self.switch_controlnet_method(config)
+            if config.enable_brushnet:
+                self.switch_brushnet_method(config)
+
+            self.enable_disable_powerpaint_v2(config)
+            self.enable_disable_lcm_lora(config)
+            return self.model(image, mask, config, **kwargs).astype(np.uint8)
+
+    @staticmethod
+    def _is_concurrent(model) -> bool:
+        """Erase models batching requests with MicroBatcher have no per request
+        state, they serve several inpaint workers at once"""
+        return getattr(model, "micro_batcher", None) is not None
+
+    def _call_lock(self, name: str, model):
+        if self._is_concurrent(model):
+            return nullcontext()
+        with self._lock:
+            if model is self.model:
+                return self._model_lock
+            return self._routed[name][2]
+
+    def _routed_call(self, name: str, image, mask, config: InpaintRequest, **kwargs):
+        model = self.acquire(name)
+        try:
+            # the lcm lora toggle and the call must not interleave with others
+            with self._call_lock(name, model):
+                self.enable_disable_lcm_lora(config, name, model)
+                return model(image, mask, config, **kwargs).astype(np.uint8)
+        finally:
+            self.release(name, model)
+
+    def acquire(self, name: str):
+        """Get model by name without switching the current model. Models other
+        than the current one are loaded in their plain form (no controlnet,
+        brushnet or powerpaint v2) and must be given back with release()."""
+        with self._lock:
+            if name == self.name:
+                return self.model
+            if name in self._routed:
+                self._routed[name][1] += 1
+                return self._routed[name][0]
+
+            cached = self.model_cache.pop(name)
+            if cached is not None and self._is_plain(name, cached.state):
+                model = cached.model
+            else:
+                if cached is not None:
+                    # built with controlnet/brushnet/powerpaint by a switch
+                    self.model_cache.put(
+                        name,
+                        cached.model,
+                        cached.state,
+                        active_models=self._active_models(),
+                    )
+                device = switch_mps_device(name, self.device)
+                self.model_cache.make_room(name, device, self._active_models())
+                model = self.init_model(
+                    name, device, state=self._plain_state(name), **self.kwargs
+                )
+                self.model_cache.record_size(name, model)
+            self._routed[name] = [model, 1, threading.Lock()]
+            self.model_cache.trim(self._active_models())
+            return model
+
+    def release(self, name: str, model):
+        with self._lock:
+            if model is self.model:
+                return
+            self._routed[name][1] -= 1
+            if self._routed[name][1] == 0:
+                del self._routed[name]
+                self.model_cache.put(
+                    name,
+                    model,
+                    self._plain_state(name),
+                    active_models=self._active_models(),
+                )
+
+    def _plain_state(self, name: str) -> Dict:
+        model_info = self.available_models[name]
+        return dict(
+            enable_controlnet=False,
+            controlnet_method=(
+                model_info.controlnets[0] if model_info.support_controlnet else None
+            ),
+            enable_brushnet=False,
+            brushnet_method=None,
+            enable_powerpaint_v2=False,
+        )
+
+    def _is_plain(self, name: str, state: Dict) -> bool:
+        model_info = self.available_models[name]
+        return not (
+            (model_info.support_controlnet and state["enable_controlnet"])
+            or (model_info.support_brushnet and state["enable_brushnet"])
+            or (model_info.support_powerpaint_v2 and state["enable_powerpaint_v2"])
+        )
+
+    def _active_models(self) -> List:
+        models = [it[0] for it in self._routed.values()]
+        if self.model is not None:
+            models.append(self.model)
+        return models
 
     def scan_models(self) -> List[ModelInfo]:
         available_models = scan_models()
@@ -119,32 +237,67 @@ class ModelManager:
         if new_name == self.name:
             return
 
-        old_name = self.name
-        old_controlnet_method = self.controlnet_method
-        self.name = new_name
+        with self._lock:
+            old_name = self.name
+            old_state = self._model_state()
+            self.name = new_name
 
-        if (
-            self.available_models[new_name].support_controlnet
-            and self.controlnet_method
-            not in self.available_models[new_name].controlnets
-        ):
-            self.controlnet_method = self.available_models[new_name].controlnets[0]
-        try:
-            # TODO: enable/disable controlnet without reload model
-            del self.model
-            torch_gc()
+            if (
+                self.available_models[new_name].support_controlnet
+                and self.controlnet_method
+                not in self.available_models[new_name].controlnets
+            ):
+                self.controlnet_method = self.available_models[new_name].controlnets[0]
 
-            self.model = self.init_model(
-                new_name, switch_mps_device(new_name, self.device), **self.kwargs
-            )
-        except Exception as e:
-            self.name = old_name
-            self.controlnet_method = old_controlnet_method
-            logger.info(f"Switch model from {old_name} to {new_name} failed, rollback")
-            self.model = self.init_model(
-                old_name, switch_mps_device(old_name, self.device), **self.kwargs
+            # TODO: enable/disable controlnet without reload model
+            # keep the old model warm, the cache offloads or destroys it by budget
+            old_model, self.model = self.model, None
+            self.model_cache.put(
+                old_name, old_model, old_state, active_models=self._active_models()
             )
-            raise e
+            del old_model
+            torch_gc()
+            try:
+                self.model = self._load_model(new_name)
+            except Exception as e:
+                self.name = old_name
+                self._set_model_state(old_state)
+                logger.info(
+                    f"Switch model from {old_name} to {new_name} failed, rollback"
+                )
+                self.model = self._load_model(old_name)
+                raise e
+
+    def _model_state(self) -> Dict:
+        return dict(
+            enable_controlnet=self.enable_controlnet,
+            controlnet_method=self.controlnet_method,
+            enable_brushnet=self.enable_brushnet,
+            brushnet_method=self.brushnet_method,
+            enable_powerpaint_v2=self.enable_powerpaint_v2,
+        )
+
+    def _set_model_state(self, state: Dict):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def _load_model(self, name: str):
+        cached = self.model_cache.pop(name)
+        if cached is not None:
+            self._set_model_state(cached.state)
+            model = cached.model
+        elif name in self._routed:
+            # in use by routed requests, release() leaves the current model alone
+            self._set_model_state(self._plain_state(name))
+            model = self._routed.pop(name)[0]
+        else:
+            device = switch_mps_device(name, self.device)
+            # the outgoing model may still be on the device, make room first
+            self.model_cache.make_room(name, device, self._active_models())
+            model = self.init_model(name, device, **self.kwargs)
+            self.model_cache.record_size(name, model)
+        self.model_cache.trim(self._active_models() + [model])
+        return model
 
     def switch_brushnet_method(self, config):
         if not self.available_models[self.name].support_brushnet:
@@ -247,22 +400,26 @@ class ModelManager:
             else:
                 logger.info("Disable PowerPaintV2")
 
-    def enable_disable_lcm_lora(self, config: InpaintRequest):
-        if self.available_models[self.name].support_lcm_lora:
+    def enable_disable_lcm_lora(
+        self, config: InpaintRequest, name: Optional[str] = None, model=None
+    ):
+        if name is None:
+            name, model = self.name, self.model
+        if self.available_models[name].support_lcm_lora:
             # TODO: change this if load other lora is supported
-            lcm_lora_loaded = bool(self.model.model.get_list_adapters())
+            lcm_lora_loaded = bool(model.model.get_list_adapters())
             if config.sd_lcm_lora:
                 if not lcm_lora_loaded:
                     logger.info("Load LCM LORA")
-                    self.model.model.load_lora_weights(
-                        self.model.lcm_lora_id,
+                    model.model.load_lora_weights(
+                        model.lcm_lora_id,
                         weight_name="pytorch_lora_weights.safetensors",
                         local_files_only=is_local_files_only(),
                     )
                 else:
                     logger.info("Enable LCM LORA")
-                    self.model.model.enable_lora()
+                    model.model.enable_lora()
             else:
                 if lcm_lora_loaded:
                     logger.info("Disable LCM LORA")
-                    self.model.model.disable_lora()
+                    model.model.disable_lora()
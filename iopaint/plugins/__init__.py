@@ -19,6 +19,7 @@ def build_plugins(
     remove_bg_device: Device,
     remove_bg_model: str,
     enable_anime_seg: bool,
+    anime_seg_device: Device,
     enable_realesrgan: bool,
     realesrgan_device: Device,
     realesrgan_model: RealESRGANModel,
@@ -41,7 +42,7 @@ def build_plugins(
 
     if enable_anime_seg:
         logger.info(f"Initialize {AnimeSeg.name} plugin")
-        plugins[AnimeSeg.name] = AnimeSeg()
+        plugins[AnimeSeg.name] = AnimeSeg(anime_seg_device, no_half=no_half)
 
     if enable_realesrgan:
         logger.info(
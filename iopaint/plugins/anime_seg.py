@@ -1,12 +1,14 @@
-import cv2
+from typing import List
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from PIL import Image
 
 from iopaint.helper import load_model
+from iopaint.model.utils import get_torch_dtype
 from iopaint.plugins.base_plugin import BasePlugin
+from iopaint.plugins.matting import MattingEngine
 from iopaint.schema import RunPluginRequest
 
 
@@ -418,45 +420,44 @@ class AnimeSeg(BasePlugin):
     name = "AnimeSeg"
     support_gen_image = True
     support_gen_mask = True
+    support_gen_image_batch = True
 
-    def __init__(self):
+    def __init__(self, device="cpu", no_half: bool = False, batch_size: int = 4):
         super().__init__()
+        self.device = device = torch.device(device)
+        _, self.dtype = get_torch_dtype(device, no_half)
+        # channels_last only pays off with the tensor cores of half precision
+        channels_last = self.dtype == torch.float16
+        memory_format = (
+            torch.channels_last if channels_last else torch.contiguous_format
+        )
         self.model = load_model(
             ISNetDIS(),
             ANIME_SEG_MODELS["url"],
-            "cpu",
+            device,
             ANIME_SEG_MODELS["md5"],
+        ).to(dtype=self.dtype, memory_format=memory_format)
+        # the image is resized to fit 1024x1024 and padded
+        self.engine = MattingEngine(
+            self.model,
+            device,
+            size=1024,
+            letterbox=True,
+            mean=0.0,
+            std=1.0,
+            batch_size=batch_size,
+            dtype=self.dtype,
+            channels_last=channels_last,
         )
 
     def gen_image(self, rgb_np_img, req: RunPluginRequest) -> np.ndarray:
-        mask = self.forward(rgb_np_img)
-        mask = Image.fromarray(mask, mode="L")
-        h0, w0 = rgb_np_img.shape[0], rgb_np_img.shape[1]
-        empty = Image.new("RGBA", (w0, h0), 0)
-        img = Image.fromarray(rgb_np_img)
-        cutout = Image.composite(img, empty, mask)
-        return np.asarray(cutout)
+        return self.engine.cutouts([rgb_np_img])[0]
+
+    def gen_image_batch(self, rgb_np_imgs) -> List[np.ndarray]:
+        return self.engine.cutouts(rgb_np_imgs)
 
     def gen_mask(self, rgb_np_img, req: RunPluginRequest) -> np.ndarray:
         return self.forward(rgb_np_img)
 
-    @torch.inference_mode()
     def forward(self, rgb_np_img):
-        s = 1024
-
-        h0, w0 = h, w = rgb_np_img.shape[0], rgb_np_img.shape[1]
-        if h > w:
-            h, w = s, int(s * w / h)
-        else:
-            h, w = int(s * h / w), s
-        ph, pw = s - h, s - w
-        tmpImg = np.zeros([s, s, 3], dtype=np.float32)
-        tmpImg[ph // 2 : ph // 2 + h, pw // 2 : pw // 2 + w] = (
-            cv2.resize(rgb_np_img, (w, h)) / 255
-        )
-        tmpImg = tmpImg.transpose((2, 0, 1))
-        tmpImg = torch.from_numpy(tmpImg).unsqueeze(0).type(torch.FloatTensor)
-        mask = self.model(tmpImg)
-        mask = mask[0, :, ph // 2 : ph // 2 + h, pw // 2 : pw // 2 + w]
-        mask = cv2.resize(mask.cpu().numpy().transpose((1, 2, 0)), (w0, h0))
-        return (mask * 255).astype("uint8")
+        return self.engine.masks([rgb_np_img])[0]
@@ -1,13 +1,25 @@
+from typing import List
+
 from loguru import logger
 import numpy as np
 
 from iopaint.schema import RunPluginRequest
 
 
+class ImageNotCachedError(Exception):
+    def __init__(self, image_id: str):
+        super().__init__(f"Image {image_id} is not cached")
+        self.image_id = image_id
+
+
 class BasePlugin:
     name: str
     support_gen_image: bool = False
     support_gen_mask: bool = False
+    support_gen_mask_batch: bool = False
+    support_gen_image_batch: bool = False
+    # gen_image gets RGBA images with their alpha channel and returns RGBA
+    support_alpha_channel: bool = False
 
     def __init__(self):
         err_msg = self.check_dep()
@@ -23,6 +35,18 @@ class BasePlugin:
         # return GRAY or BGR np image, 255 means foreground, 0 means background
         ...
 
+    def gen_mask_batch(self, rgb_np_imgs, prompts) -> List[List[np.ndarray]]:
+        # return a list of GRAY masks for each image, one mask per prompt
+        ...
+
+    def gen_image_batch(self, rgb_np_imgs) -> List[np.ndarray]:
+        # return a RGBA np image for each image
+        ...
+
+    def is_image_cached(self, image_id: str) -> bool:
+        # whether gen_image/gen_mask can run with req.image_id instead of req.image
+        return False
+
     def check_dep(self):
         ...
 
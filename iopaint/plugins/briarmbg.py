@@ -3,9 +3,8 @@ import cv2
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from PIL import Image
-import numpy as np
-from torchvision.transforms.functional import normalize
+
+from iopaint.plugins.matting import MattingEngine
 
 
 class REBNCONV(nn.Module):
@@ -463,13 +462,6 @@ class BriaRMBG(nn.Module):
         ], [hx1d, hx2d, hx3d, hx4d, hx5d, hx6]
 
 
-def resize_image(image):
-    image = image.convert("RGB")
-    model_input_size = (1024, 1024)
-    image = image.resize(model_input_size, Image.BILINEAR)
-    return image
-
-
 def create_briarmbg_session():
     from huggingface_hub import hf_hub_download
 
@@ -480,34 +472,24 @@ def create_briarmbg_session():
     return net
 
 
+def create_briarmbg_engine(
+    session, device, swap_rb: bool = False, batch_size: int = 4
+) -> MattingEngine:
+    return MattingEngine(
+        lambda x: session(x)[0][0],
+        device,
+        size=1024,
+        mean=0.5,
+        std=1.0,
+        min_max_norm=True,
+        swap_rb=swap_rb,
+        batch_size=batch_size,
+    )
+
+
 def briarmbg_process(device, bgr_np_image, session, only_mask=False):
-    # prepare input
-    orig_bgr_image = Image.fromarray(bgr_np_image)
-    w, h = orig_im_size = orig_bgr_image.size
-    image = resize_image(orig_bgr_image)
-    im_np = np.array(image)
-    im_tensor = torch.tensor(im_np, dtype=torch.float32).permute(2, 0, 1)
-    im_tensor = torch.unsqueeze(im_tensor, 0)
-    im_tensor = torch.divide(im_tensor, 255.0)
-    im_tensor = normalize(im_tensor, [0.5, 0.5, 0.5], [1.0, 1.0, 1.0])
-    im_tensor = im_tensor.to(device)
-    # inference
-    result = session(im_tensor)
-    # post process
-    result = torch.squeeze(F.interpolate(result[0][0], size=(h, w), mode="bilinear"), 0)
-    ma = torch.max(result)
-    mi = torch.min(result)
-    result = (result - mi) / (ma - mi)
-    # image to pil
-    im_array = (result * 255).cpu().data.numpy().astype(np.uint8)
-
-    mask = np.squeeze(im_array)
+    engine = create_briarmbg_engine(session, device)
     if only_mask:
-        return mask
-
-    pil_im = Image.fromarray(mask)
-    # paste the mask on the original image
-    new_im = Image.new("RGBA", pil_im.size, (0, 0, 0, 0))
-    new_im.paste(orig_bgr_image, mask=pil_im)
-    rgba_np_img = np.asarray(new_im)
-    return rgba_np_img
+        return engine.masks([bgr_np_image])[0]
+    # BGRA, the mask is pasted on the image as it is
+    return engine.cutouts([bgr_np_image])[0]
@@ -0,0 +1,121 @@
+import hashlib
+import threading
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+import torch
+from loguru import logger
+
+from iopaint.lru_cache import LRUCache, nbytes
+from iopaint.metrics import span
+
+# short side of the image face detection runs at, larger images are downscaled
+DETECT_RESIZE = 1024
+# bytes of a cache entry besides its array: the key (an image hash, or landmark
+# and template bytes) and python objects, measured ~400-500 bytes, rounded up.
+# Without it images with no faces, cached as (0, 15) arrays, would take no room.
+CACHE_ENTRY_OVERHEAD = 1024
+
+
+def array_hash(np_img: np.ndarray) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((np_img.shape, np_img.dtype.str)).encode("utf-8"))
+    h.update(np.ascontiguousarray(np_img).data)
+    return h.hexdigest()
+
+
+def _entry_size(value: np.ndarray) -> int:
+    return nbytes(value) + CACHE_ENTRY_OVERHEAD
+
+
+class FaceAnalysis:
+    """Face detection and alignment shared by the face restoration plugins.
+    One detector is loaded per device, detections are cached by image hash and
+    alignment matrices by landmarks and face template, so restoring faces of the
+    same image again, with another plugin or weight, skips detection."""
+
+    def __init__(
+        self,
+        det_model: str = "retinaface_resnet50",
+        model_rootpath: Optional[str] = None,
+        cache_size_mb: int = 16,
+    ):
+        self.det_model = det_model
+        self.model_rootpath = model_rootpath
+        self.detections = LRUCache(cache_size_mb * 1024 * 1024, size_fn=_entry_size)
+        self.affine_matrices = LRUCache(
+            cache_size_mb * 1024 * 1024, size_fn=_entry_size
+        )
+        self._detectors: Dict[str, torch.nn.Module] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _detector(self, device):
+        device = str(torch.device(device))
+        with self._lock:
+            if device not in self._detectors:
+                from .facexlib.detection import init_detection_model
+
+                logger.info(f"Load face detector {self.det_model} on {device}")
+                self._detectors[device] = init_detection_model(
+                    self.det_model,
+                    half=False,
+                    device=device,
+                    model_rootpath=self.model_rootpath,
+                )
+                self._locks[device] = threading.Lock()
+            return self._detectors[device], self._locks[device]
+
+    def detect(
+        self,
+        np_img: np.ndarray,
+        device,
+        conf_threshold: float = 0.97,
+        resize: Optional[int] = DETECT_RESIZE,
+    ) -> np.ndarray:
+        """Faces in the BGR np_img, as rows of box, score and 5 landmarks in
+        np_img coordinates. Images with a short side larger than resize are
+        downscaled before detection."""
+        key = (array_hash(np_img), conf_threshold, resize)
+        bboxes = self.detections.get(key)
+        if bboxes is not None:
+            return bboxes.copy()
+
+        h, w = np_img.shape[0:2]
+        scale = 1
+        if resize is not None and min(h, w) > resize:
+            scale = min(h, w) / resize
+            np_img = cv2.resize(
+                np_img,
+                (int(w / scale), int(h / scale)),
+                interpolation=cv2.INTER_AREA,
+            )
+        detector, lock = self._detector(device)
+        with span("face_detection"), lock, torch.no_grad():
+            bboxes = detector.detect_faces(np_img, conf_threshold)
+        # the score is not scaled
+        bboxes[:, 0:4] *= scale
+        bboxes[:, 5:] *= scale
+        self.detections.put(key, bboxes)
+        return bboxes.copy()
+
+    def affine_matrix(self, landmark: np.ndarray, face_template: np.ndarray):
+        """Affine matrix aligning landmark to face_template"""
+        key = (landmark.tobytes(), face_template.tobytes())
+        affine_matrix = self.affine_matrices.get(key)
+        if affine_matrix is None:
+            # use cv2.LMEDS method for the equivalence to skimage transform
+            affine_matrix = cv2.estimateAffinePartial2D(
+                landmark, face_template, method=cv2.LMEDS
+            )[0]
+            self.affine_matrices.put(key, affine_matrix)
+        return affine_matrix.copy()
+
+    def clear(self):
+        self.detections.clear()
+        self.affine_matrices.clear()
+
+
+# shared by all face restoration plugins
+face_analysis = FaceAnalysis()
@@ -2,12 +2,19 @@ import cv2
 import numpy as np
 import os
 import torch
+import torch.nn.functional as F
 from torchvision.transforms.functional import normalize
 
 from ..detection import init_detection_model
 from ..parsing import init_parsing_model
 from ..utils.misc import img2tensor, imwrite
 
+# face parsing classes blended into the output, skin, brows, eyes, nose, mouth...
+MASK_COLORMAP = [
+    0, 255, 255, 255, 255, 255, 255, 255, 255, 255,
+    255, 255, 255, 255, 0, 255, 0, 0, 0,
+]  # fmt: skip
+
 
 def get_largest_face(det_faces, h, w):
     def get_location(val, length):
@@ -61,6 +68,8 @@ class FaceRestoreHelper(object):
         use_parse=False,
         device=None,
         model_rootpath=None,
+        parse_batch_size=8,
+        face_analysis=None,
     ):
         self.template_3points = template_3points  # improve robustness
         self.upscale_factor = upscale_factor
@@ -92,6 +101,8 @@ class FaceRestoreHelper(object):
             self.face_template[:, 1] += face_size * (self.crop_ratio[0] - 1) / 2
         if self.crop_ratio[1] > 1:
             self.face_template[:, 0] += face_size * (self.crop_ratio[1] - 1) / 2
+        # blend mask of the square face area when use_parse is False
+        self.square_mask = np.ones(self.face_size, dtype=np.float32)
         self.save_ext = save_ext
         self.pad_blur = pad_blur
         if self.pad_blur is True:
@@ -110,13 +121,19 @@ class FaceRestoreHelper(object):
         else:
             self.device = device
 
-        # init face detection model
-        self.face_det = init_detection_model(
-            det_model, half=False, device=self.device, model_rootpath=model_rootpath
-        )
+        # init face detection model, unless detection and alignment are shared
+        # through face_analysis
+        self.face_analysis = face_analysis
+        if face_analysis is None:
+            self.face_det = init_detection_model(
+                det_model, half=False, device=self.device, model_rootpath=model_rootpath
+            )
+        else:
+            self.face_det = None
 
         # init face parsing model
         self.use_parse = use_parse
+        self.parse_batch_size = parse_batch_size
         self.face_parse = init_parsing_model(
             model_name="parsenet", device=self.device, model_rootpath=model_rootpath
         )
@@ -147,19 +164,24 @@ class FaceRestoreHelper(object):
         blur_ratio=0.01,
         eye_dist_threshold=None,
     ):
-        if resize is None:
-            scale = 1
-            input_img = self.input_img
-        else:
-            h, w = self.input_img.shape[0:2]
-            scale = min(h, w) / resize
-            h, w = int(h / scale), int(w / scale)
-            input_img = cv2.resize(
-                self.input_img, (w, h), interpolation=cv2.INTER_LANCZOS4
+        if self.face_analysis is not None:
+            bboxes = self.face_analysis.detect(
+                self.input_img, self.device, 0.97, resize=resize
             )
+        else:
+            if resize is None:
+                scale = 1
+                input_img = self.input_img
+            else:
+                h, w = self.input_img.shape[0:2]
+                scale = min(h, w) / resize
+                h, w = int(h / scale), int(w / scale)
+                input_img = cv2.resize(
+                    self.input_img, (w, h), interpolation=cv2.INTER_LANCZOS4
+                )
 
-        with torch.no_grad():
-            bboxes = self.face_det.detect_faces(input_img, 0.97) * scale
+            with torch.no_grad():
+                bboxes = self.face_det.detect_faces(input_img, 0.97) * scale
         for bbox in bboxes:
             # remove faces with too small eye distance: side faces or too small faces
             eye_dist = np.linalg.norm([bbox[5] - bbox[7], bbox[6] - bbox[8]])
@@ -283,11 +305,16 @@ class FaceRestoreHelper(object):
             ), f"Mismatched samples: {len(self.pad_input_imgs)} and {len(self.all_landmarks_5)}"
         for idx, landmark in enumerate(self.all_landmarks_5):
             # use 5 landmarks to get affine matrix
-            # use cv2.LMEDS method for the equivalence to skimage transform
-            # ref: https://blog.csdn.net/yichxi/article/details/115827338
-            affine_matrix = cv2.estimateAffinePartial2D(
-                landmark, self.face_template, method=cv2.LMEDS
-            )[0]
+            if self.face_analysis is not None:
+                affine_matrix = self.face_analysis.affine_matrix(
+                    landmark, self.face_template
+                )
+            else:
+                # use cv2.LMEDS method for the equivalence to skimage transform
+                # ref: https://blog.csdn.net/yichxi/article/details/115827338
+                affine_matrix = cv2.estimateAffinePartial2D(
+                    landmark, self.face_template, method=cv2.LMEDS
+                )[0]
             self.affine_matrices.append(affine_matrix)
             # warp and crop faces
             if border_mode == "constant":
@@ -329,6 +356,97 @@ class FaceRestoreHelper(object):
     def add_restored_face(self, face):
         self.restored_faces.append(face)
 
+    def _parse_soft_masks(self, faces):
+        """Blend masks in face space of the restored faces from the parsing model.
+        Faces are parsed and blurred in batches of parse_batch_size"""
+        colormap = torch.tensor(MASK_COLORMAP, dtype=torch.float32, device=self.device)
+        kernel = torch.from_numpy(cv2.getGaussianKernel(101, 11).astype(np.float32))
+        kernel = kernel.to(self.device)
+        masks = []
+        for i in range(0, len(faces), self.parse_batch_size):
+            face_input = []
+            for face in faces[i : i + self.parse_batch_size]:
+                face = cv2.resize(face, (512, 512), interpolation=cv2.INTER_LINEAR)
+                face = img2tensor(
+                    face.astype("float32") / 255.0, bgr2rgb=True, float32=True
+                )
+                normalize(face, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+                face_input.append(face)
+            with torch.no_grad():
+                out = self.face_parse(torch.stack(face_input).to(self.device))[0]
+            mask = colormap[out.argmax(dim=1)].unsqueeze(1)
+            #  blur the mask twice, same as cv2.GaussianBlur(mask, (101, 101), 11)
+            for _ in range(2):
+                mask = F.pad(mask, (50, 50, 0, 0), mode="reflect")
+                mask = F.conv2d(mask, kernel.view(1, 1, 1, 101))
+                mask = F.pad(mask, (0, 0, 50, 50), mode="reflect")
+                mask = F.conv2d(mask, kernel.view(1, 1, 101, 1))
+            mask = mask[:, 0]
+            # remove the black borders
+            thres = 10
+            mask[:, :thres, :] = 0
+            mask[:, -thres:, :] = 0
+            mask[:, :, :thres] = 0
+            mask[:, :, -thres:] = 0
+            masks.extend((mask / 255.0).cpu().numpy())
+        return masks
+
+    def _face_box(self, face, inverse_affine, w_up, h_up, margin=2):
+        """Box in the output image covering a face pasted with inverse_affine, with
+        a margin for interpolation"""
+        h, w = face.shape[0:2]
+        corners = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1]])
+        points = corners @ inverse_affine.T
+        x0, y0 = np.floor(points.min(axis=0)).astype(int) - margin
+        x1, y1 = np.ceil(points.max(axis=0)).astype(int) + margin
+        return max(x0, 0), max(y0, 0), min(x1, w_up), min(y1, h_up)
+
+    def _paste_face(self, upsample_img, restored_face, inverse_affine, mask, box):
+        """Blend restored_face into box of the float upsample_img in place. mask is
+        the parse mask in face space, or None to use the square face area"""
+        x0, y0, x1, y1 = box
+        if x1 <= x0 or y1 <= y0:
+            return
+        # warp into the box only, instead of the whole image
+        inverse_affine = inverse_affine.copy()
+        inverse_affine[:, 2] -= (x0, y0)
+        size = (x1 - x0, y1 - y0)
+        inv_restored = cv2.warpAffine(restored_face, inverse_affine, size)
+
+        if mask is not None:
+            mask = cv2.resize(mask, restored_face.shape[:2])
+            mask = cv2.warpAffine(mask, inverse_affine, size, flags=3)
+            inv_soft_mask = mask[:, :, None]
+            pasted_face = inv_restored
+        else:  # use square parse maps
+            inv_mask = cv2.warpAffine(self.square_mask, inverse_affine, size)
+            # remove the black borders
+            inv_mask_erosion = cv2.erode(
+                inv_mask,
+                np.ones(
+                    (int(2 * self.upscale_factor), int(2 * self.upscale_factor)),
+                    np.uint8,
+                ),
+            )
+            pasted_face = inv_mask_erosion[:, :, None] * inv_restored
+            total_face_area = np.sum(inv_mask_erosion)  # // 3
+            # compute the fusion edge based on the area of face
+            w_edge = int(total_face_area**0.5) // 20
+            erosion_radius = w_edge * 2
+            inv_mask_center = cv2.erode(
+                inv_mask_erosion,
+                np.ones((erosion_radius, erosion_radius), np.uint8),
+            )
+            blur_size = w_edge * 2
+            inv_soft_mask = cv2.GaussianBlur(
+                inv_mask_center, (blur_size + 1, blur_size + 1), 0
+            )
+            inv_soft_mask = inv_soft_mask[:, :, None]
+
+        # the alpha channel is kept
+        region = upsample_img[y0:y1, x0:x1, 0:3]
+        region[:] = inv_soft_mask * pasted_face + (1 - inv_soft_mask) * region
+
     def paste_faces_to_input_image(self, save_path=None, upsample_img=None):
         h, w, _ = self.input_img.shape
         h_up, w_up = int(h * self.upscale_factor), int(w * self.upscale_factor)
@@ -342,116 +460,27 @@ class FaceRestoreHelper(object):
             upsample_img = cv2.resize(
                 upsample_img, (w_up, h_up), interpolation=cv2.INTER_LANCZOS4
             )
+        if len(upsample_img.shape) == 2:  # upsample_img is gray image
+            upsample_img = cv2.cvtColor(upsample_img, cv2.COLOR_GRAY2BGR)
 
         assert len(self.restored_faces) == len(
             self.inverse_affine_matrices
         ), "length of restored_faces and affine_matrices are different."
-        for restored_face, inverse_affine in zip(
-            self.restored_faces, self.inverse_affine_matrices
+        if self.restored_faces:
+            upsample_img = upsample_img.astype(np.float32)
+        if self.use_parse:
+            masks = self._parse_soft_masks(self.restored_faces)
+        else:
+            masks = [None] * len(self.restored_faces)
+        for restored_face, inverse_affine, mask in zip(
+            self.restored_faces, self.inverse_affine_matrices, masks
         ):
             # Add an offset to inverse affine matrix, for more precise back alignment
+            inverse_affine = inverse_affine.copy()
             if self.upscale_factor > 1:
-                extra_offset = 0.5 * self.upscale_factor
-            else:
-                extra_offset = 0
-            inverse_affine[:, 2] += extra_offset
-            inv_restored = cv2.warpAffine(restored_face, inverse_affine, (w_up, h_up))
-
-            if self.use_parse:
-                # inference
-                face_input = cv2.resize(
-                    restored_face, (512, 512), interpolation=cv2.INTER_LINEAR
-                )
-                face_input = img2tensor(
-                    face_input.astype("float32") / 255.0, bgr2rgb=True, float32=True
-                )
-                normalize(face_input, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
-                face_input = torch.unsqueeze(face_input, 0).to(self.device)
-                with torch.no_grad():
-                    out = self.face_parse(face_input)[0]
-                out = out.argmax(dim=1).squeeze().cpu().numpy()
-
-                mask = np.zeros(out.shape)
-                MASK_COLORMAP = [
-                    0,
-                    255,
-                    255,
-                    255,
-                    255,
-                    255,
-                    255,
-                    255,
-                    255,
-                    255,
-                    255,
-                    255,
-                    255,
-                    255,
-                    0,
-                    255,
-                    0,
-                    0,
-                    0,
-                ]
-                for idx, color in enumerate(MASK_COLORMAP):
-                    mask[out == idx] = color
-                #  blur the mask
-                mask = cv2.GaussianBlur(mask, (101, 101), 11)
-                mask = cv2.GaussianBlur(mask, (101, 101), 11)
-                # remove the black borders
-                thres = 10
-                mask[:thres, :] = 0
-                mask[-thres:, :] = 0
-                mask[:, :thres] = 0
-                mask[:, -thres:] = 0
-                mask = mask / 255.0
-
-                mask = cv2.resize(mask, restored_face.shape[:2])
-                mask = cv2.warpAffine(mask, inverse_affine, (w_up, h_up), flags=3)
-                inv_soft_mask = mask[:, :, None]
-                pasted_face = inv_restored
-
-            else:  # use square parse maps
-                mask = np.ones(self.face_size, dtype=np.float32)
-                inv_mask = cv2.warpAffine(mask, inverse_affine, (w_up, h_up))
-                # remove the black borders
-                inv_mask_erosion = cv2.erode(
-                    inv_mask,
-                    np.ones(
-                        (int(2 * self.upscale_factor), int(2 * self.upscale_factor)),
-                        np.uint8,
-                    ),
-                )
-                pasted_face = inv_mask_erosion[:, :, None] * inv_restored
-                total_face_area = np.sum(inv_mask_erosion)  # // 3
-                # compute the fusion edge based on the area of face
-                w_edge = int(total_face_area**0.5) // 20
-                erosion_radius = w_edge * 2
-                inv_mask_center = cv2.erode(
-                    inv_mask_erosion,
-                    np.ones((erosion_radius, erosion_radius), np.uint8),
-                )
-                blur_size = w_edge * 2
-                inv_soft_mask = cv2.GaussianBlur(
-                    inv_mask_center, (blur_size + 1, blur_size + 1), 0
-                )
-                if len(upsample_img.shape) == 2:  # upsample_img is gray image
-                    upsample_img = upsample_img[:, :, None]
-                inv_soft_mask = inv_soft_mask[:, :, None]
-
-            if (
-                len(upsample_img.shape) == 3 and upsample_img.shape[2] == 4
-            ):  # alpha channel
-                alpha = upsample_img[:, :, 3:]
-                upsample_img = (
-                    inv_soft_mask * pasted_face
-                    + (1 - inv_soft_mask) * upsample_img[:, :, 0:3]
-                )
-                upsample_img = np.concatenate((upsample_img, alpha), axis=2)
-            else:
-                upsample_img = (
-                    inv_soft_mask * pasted_face + (1 - inv_soft_mask) * upsample_img
-                )
+                inverse_affine[:, 2] += 0.5 * self.upscale_factor
+            box = self._face_box(restored_face, inverse_affine, w_up, h_up)
+            self._paste_face(upsample_img, restored_face, inverse_affine, mask, box)
 
         if np.max(upsample_img) > 256:  # 16-bit image
             upsample_img = upsample_img.astype(np.uint16)
@@ -11,8 +11,9 @@ class GFPGANPlugin(BasePlugin):
     name = "GFPGAN"
     support_gen_image = True
 
-    def __init__(self, device, upscaler=None):
+    def __init__(self, device, upscaler=None, face_analysis=None):
         super().__init__()
+        from .face_analysis import DETECT_RESIZE, face_analysis as shared_analysis
         from .gfpganer import MyGFPGANer
 
         url = "https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.4.pth"
@@ -28,10 +29,9 @@ class GFPGANPlugin(BasePlugin):
             channel_multiplier=2,
             device=device,
             bg_upsampler=upscaler.model if upscaler is not None else None,
-        )
-        self.face_enhancer.face_helper.face_det.mean_tensor.to(device)
-        self.face_enhancer.face_helper.face_det = (
-            self.face_enhancer.face_helper.face_det.to(device)
+            # detector and detections are shared with the other face restorers
+            face_analysis=face_analysis or shared_analysis,
+            detect_resize=DETECT_RESIZE,
         )
 
     def gen_image(self, rgb_np_img, req: RunPluginRequest) -> np.ndarray:
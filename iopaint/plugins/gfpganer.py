@@ -2,6 +2,7 @@ import os
 
 import cv2
 import torch
+from loguru import logger
 from torchvision.transforms.functional import normalize
 from torch.hub import get_dir
 
@@ -24,6 +25,11 @@ class MyGFPGANer:
         arch (str): The GFPGAN architecture. Option: clean | original. Default: clean.
         channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: 2.
         bg_upsampler (nn.Module): The upsampler for the background. Default: None.
+        face_batch_size (int): Max number of faces restored in one forward. Default: 8.
+        face_analysis (FaceAnalysis): Shared face detection and alignment, the face
+            helper loads its own detector if None. Default: None.
+        detect_resize (int): Short side of the image face detection runs at, only
+            used with face_analysis. Default: None.
     """
 
     def __init__(
@@ -34,9 +40,14 @@ class MyGFPGANer:
         channel_multiplier=2,
         bg_upsampler=None,
         device=None,
+        face_batch_size=8,
+        face_analysis=None,
+        detect_resize=None,
     ):
         self.upscale = upscale
         self.bg_upsampler = bg_upsampler
+        self.face_batch_size = face_batch_size
+        self.detect_resize = detect_resize
 
         # initialize model
         self.device = (
@@ -76,6 +87,8 @@ class MyGFPGANer:
             use_parse=True,
             device=self.device,
             model_rootpath=model_dir,
+            parse_batch_size=face_batch_size,
+            face_analysis=face_analysis,
         )
 
         loadnet = torch.load(model_path)
@@ -87,6 +100,43 @@ class MyGFPGANer:
         self.gfpgan.eval()
         self.gfpgan = self.gfpgan.to(self.device)
 
+    def _forward(self, faces_t, weight):
+        try:
+            return self.gfpgan(faces_t, return_rgb=False, weight=weight)[0]
+        except torch.cuda.OutOfMemoryError:
+            if len(faces_t) == 1:
+                raise
+            logger.warning(f"Out of memory restoring {len(faces_t)} faces, split batch")
+            half = len(faces_t) // 2
+            return torch.cat(
+                [
+                    self._forward(faces_t[:half], weight),
+                    self._forward(faces_t[half:], weight),
+                ]
+            )
+
+    def _restore_faces(self, cropped_faces, weight):
+        # prepare data
+        faces_t = []
+        for cropped_face in cropped_faces:
+            cropped_face_t = img2tensor(
+                cropped_face / 255.0, bgr2rgb=True, float32=True
+            )
+            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+            faces_t.append(cropped_face_t)
+        faces_t = torch.stack(faces_t).to(self.device)
+
+        try:
+            output = self._forward(faces_t, weight)
+        except RuntimeError as error:
+            logger.error(f"Failed inference for GFPGAN: {error}.")
+            return [it.astype("uint8") for it in cropped_faces]
+        # convert to image
+        return [
+            tensor2img(it, rgb2bgr=True, min_max=(-1, 1)).astype("uint8")
+            for it in output
+        ]
+
     @torch.no_grad()
     def enhance(
         self,
@@ -105,34 +155,21 @@ class MyGFPGANer:
             self.face_helper.read_image(img)
             # get face landmarks for each face
             self.face_helper.get_face_landmarks_5(
-                only_center_face=only_center_face, eye_dist_threshold=5
+                only_center_face=only_center_face,
+                resize=self.detect_resize,
+                eye_dist_threshold=5,
             )
             # eye_dist_threshold=5: skip faces whose eye distance is smaller than 5 pixels
             # TODO: even with eye_dist_threshold, it will still introduce wrong detections and restorations.
             # align and warp each face
             self.face_helper.align_warp_face()
 
-        # face restoration
-        for cropped_face in self.face_helper.cropped_faces:
-            # prepare data
-            cropped_face_t = img2tensor(
-                cropped_face / 255.0, bgr2rgb=True, float32=True
-            )
-            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
-            cropped_face_t = cropped_face_t.unsqueeze(0).to(self.device)
-
-            try:
-                output = self.gfpgan(cropped_face_t, return_rgb=False, weight=weight)[0]
-                # convert to image
-                restored_face = tensor2img(
-                    output.squeeze(0), rgb2bgr=True, min_max=(-1, 1)
-                )
-            except RuntimeError as error:
-                print(f"\tFailed inference for GFPGAN: {error}.")
-                restored_face = cropped_face
-
-            restored_face = restored_face.astype("uint8")
-            self.face_helper.add_restored_face(restored_face)
+        # face restoration, all aligned faces go through the network in batches
+        cropped_faces = self.face_helper.cropped_faces
+        for i in range(0, len(cropped_faces), self.face_batch_size):
+            faces = cropped_faces[i : i + self.face_batch_size]
+            for restored_face in self._restore_faces(faces, weight):
+                self.face_helper.add_restored_face(restored_face)
 
         if not has_aligned and paste_back:
             # upsample the background
@@ -1,17 +1,19 @@
 import hashlib
-from typing import List
+import threading
+from typing import List, Optional
 
 import numpy as np
 import torch
 from loguru import logger
 
 from iopaint.helper import download_model
-from iopaint.plugins.base_plugin import BasePlugin
+from iopaint.lru_cache import LRUCache
+from iopaint.plugins.base_plugin import BasePlugin, ImageNotCachedError
 from iopaint.plugins.segment_anything import SamPredictor, sam_model_registry
 from iopaint.plugins.segment_anything.predictor_hq import SamHQPredictor
 from iopaint.plugins.segment_anything2.build_sam import build_sam2
 from iopaint.plugins.segment_anything2.sam2_image_predictor import SAM2ImagePredictor
-from iopaint.schema import RunPluginRequest
+from iopaint.schema import RunPluginRequest, SegmentPrompt
 
 # 从小到大
 SEGMENT_ANYTHING_MODELS = {
@@ -77,15 +79,39 @@ SEGMENT_ANYTHING_MODELS = {
     },
 }
 
+# predictor attributes set by set_image, SamPredictor/SamHQPredictor and SAM2ImagePredictor
+PREDICTOR_STATE = [
+    "features",
+    "interm_features",
+    "original_size",
+    "input_size",
+    "is_image_set",
+    "_features",
+    "_orig_hw",
+    "_is_image_set",
+    "_is_batch",
+]
+
+
+def image_hash(data) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
 
 class InteractiveSeg(BasePlugin):
     name = "InteractiveSeg"
     support_gen_mask = True
+    support_gen_mask_batch = True
+    # number of images embedded in one encoder call by gen_mask_batch
+    encoder_batch_size = 4
 
-    def __init__(self, model_name, device):
+    def __init__(self, model_name, device, cache_size_mb: int = 512):
         super().__init__()
         self.model_name = model_name
         self.device = device
+        # image embeddings of recently clicked images, by image id
+        self.embeddings = LRUCache(cache_size_mb * 1024 * 1024)
+        # the predictor holds the embedding of one image at a time
+        self._lock = threading.Lock()
         self._init_session(model_name)
 
     def _init_session(self, model_name: str):
@@ -107,7 +133,8 @@ class InteractiveSeg(BasePlugin):
             self.predictor = SamPredictor(
                 sam_model_registry[model_name](checkpoint=model_path).to(self.device)
             )
-        self.prev_img_md5 = None
+        self.embeddings.clear()
+        self.prev_image_id = None
 
     def switch_model(self, new_model_name):
         if self.model_name == new_model_name:
@@ -119,12 +146,18 @@ class InteractiveSeg(BasePlugin):
         self._init_session(new_model_name)
         self.model_name = new_model_name
 
+    def is_image_cached(self, image_id: str) -> bool:
+        return image_id == self.prev_image_id or image_id in self.embeddings
+
     def gen_mask(self, rgb_np_img, req: RunPluginRequest) -> np.ndarray:
-        img_md5 = hashlib.md5(req.image.encode("utf-8")).hexdigest()
-        return self.forward(rgb_np_img, req.clicks, img_md5)
+        """rgb_np_img can be None if req.image_id is cached. req.image_id is set to
+        the id of the image, clients send it instead of the image on next clicks"""
+        if req.image:
+            req.image_id = image_hash(req.image.encode("utf-8"))
+        return self.forward(rgb_np_img, req.clicks, req.image_id)
 
     @torch.inference_mode()
-    def forward(self, rgb_np_img, clicks: List[List], img_md5: str):
+    def forward(self, rgb_np_img, clicks: List[List], image_id: Optional[str]):
         input_point = []
         input_label = []
         for click in clicks:
@@ -133,14 +166,114 @@ class InteractiveSeg(BasePlugin):
             input_point.append([x, y])
             input_label.append(click[2])
 
-        if img_md5 and img_md5 != self.prev_img_md5:
-            self.prev_img_md5 = img_md5
-            self.predictor.set_image(rgb_np_img)
-
-        masks, _, _ = self.predictor.predict(
-            point_coords=np.array(input_point),
-            point_labels=np.array(input_label),
-            multimask_output=False,
-        )
+        with self._lock:
+            self._set_image(rgb_np_img, image_id)
+            masks, _, _ = self.predictor.predict(
+                point_coords=np.array(input_point),
+                point_labels=np.array(input_label),
+                multimask_output=False,
+            )
         mask = masks[0].astype(np.uint8) * 255
         return mask
+
+    def _set_image(self, rgb_np_img, image_id: Optional[str]):
+        if image_id and image_id == self.prev_image_id:
+            return
+        state = self.embeddings.get(image_id) if image_id else None
+        if state is not None:
+            for k, v in state.items():
+                setattr(self.predictor, k, v)
+        else:
+            if rgb_np_img is None:
+                raise ImageNotCachedError(image_id)
+            self.predictor.set_image(rgb_np_img)
+            if image_id:
+                self.embeddings.put(
+                    image_id,
+                    {
+                        k: getattr(self.predictor, k)
+                        for k in PREDICTOR_STATE
+                        if hasattr(self.predictor, k)
+                    },
+                )
+        self.prev_image_id = image_id
+
+    def gen_mask_batch(
+        self, rgb_np_imgs: List[np.ndarray], prompts: List[List[SegmentPrompt]]
+    ) -> List[List[np.ndarray]]:
+        """One GRAY mask per prompt of every image"""
+        with self._lock:
+            # the predictor no longer holds the embedding of the last clicked image
+            self.prev_image_id = None
+            if isinstance(self.predictor, SAM2ImagePredictor):
+                return self._sam2_gen_mask_batch(rgb_np_imgs, prompts)
+            return self._sam_gen_mask_batch(rgb_np_imgs, prompts)
+
+    @torch.inference_mode()
+    def _sam_gen_mask_batch(self, rgb_np_imgs, prompts):
+        results = []
+        for rgb_np_img, image_prompts in zip(rgb_np_imgs, prompts):
+            self.predictor.set_image(rgb_np_img)
+            masks = []
+            for prompt in image_prompts:
+                point_coords, point_labels, box = self._prompt_arrays([prompt])
+                out, _, _ = self.predictor.predict(
+                    point_coords=point_coords[0] if prompt.clicks else None,
+                    point_labels=point_labels[0] if prompt.clicks else None,
+                    box=box[0] if box is not None else None,
+                    multimask_output=False,
+                )
+                masks.append(out[0].astype(np.uint8) * 255)
+            results.append(masks)
+        return results
+
+    @torch.inference_mode()
+    def _sam2_gen_mask_batch(self, rgb_np_imgs, prompts):
+        """Images are embedded encoder_batch_size at a time, prompts of the same
+        shape (number of clicks, with or without box) of an image are decoded in
+        one mask decoder call"""
+        results = []
+        for start in range(0, len(rgb_np_imgs), self.encoder_batch_size):
+            end = start + self.encoder_batch_size
+            self.predictor.set_image_batch(rgb_np_imgs[start:end])
+            for img_idx, image_prompts in enumerate(prompts[start:end]):
+                groups = {}
+                for i, prompt in enumerate(image_prompts):
+                    key = (len(prompt.clicks), prompt.box is not None)
+                    groups.setdefault(key, []).append(i)
+
+                masks = [None] * len(image_prompts)
+                for indices in groups.values():
+                    point_coords, point_labels, box = self._prompt_arrays(
+                        [image_prompts[i] for i in indices]
+                    )
+                    _, coords, labels, boxes = self.predictor._prep_prompts(
+                        point_coords, point_labels, box, None, True, img_idx=img_idx
+                    )
+                    out, _, _ = self.predictor._predict(
+                        coords,
+                        labels,
+                        boxes,
+                        multimask_output=False,
+                        img_idx=img_idx,
+                    )
+                    out = out[:, 0].cpu().numpy()
+                    for i, mask in zip(indices, out):
+                        masks[i] = mask.astype(np.uint8) * 255
+                results.append(masks)
+        self.predictor.reset_predictor()
+        return results
+
+    @staticmethod
+    def _prompt_arrays(prompts: List[SegmentPrompt]):
+        """BxNx2 point coords, BxN point labels and Bx4 boxes of prompts with the
+        same number of clicks"""
+        point_coords, point_labels, box = None, None, None
+        if prompts[0].clicks:
+            point_coords = np.array(
+                [[click[:2] for click in it.clicks] for it in prompts], dtype=np.float32
+            )
+            point_labels = np.array([[click[2] for click in it.clicks] for it in prompts])
+        if prompts[0].box is not None:
+            box = np.array([it.box for it in prompts], dtype=np.float32)
+        return point_coords, point_labels, box
@@ -0,0 +1,151 @@
+import threading
+from typing import Callable, List, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from iopaint.metrics import span
+
+
+class MattingEngine:
+    """Foreground masks and cutouts of salient object models (briarmbg, anime seg).
+    Images are uploaded once, then resized, normalized, run in batches and
+    composited on the device, only the uint8 results are copied back."""
+
+    def __init__(
+        self,
+        forward: Callable[[torch.Tensor], torch.Tensor],
+        device,
+        size: int = 1024,
+        letterbox: bool = False,
+        mean: float = 0.5,
+        std: float = 1.0,
+        min_max_norm: bool = False,
+        swap_rb: bool = False,
+        batch_size: int = 4,
+        dtype: torch.dtype = torch.float32,
+        channels_last: bool = False,
+    ):
+        """
+        Args:
+            forward: model call, [N,3,size,size] input to [N,1,size,size] in 0~1
+            letterbox: keep the aspect ratio and pad to size, otherwise stretch
+            min_max_norm: stretch each mask to the full 0~1 range
+            swap_rb: feed the model the channels of the images in reverse order
+            dtype, channels_last: dtype and memory format of the model input
+        """
+        self.forward = forward
+        self.device = torch.device(device)
+        self.size = size
+        self.letterbox = letterbox
+        self.mean = mean
+        self.std = std
+        self.min_max_norm = min_max_norm
+        self.swap_rb = swap_rb
+        self.batch_size = batch_size
+        self.dtype = dtype
+        self.channels_last = channels_last
+        # model input of a whole batch, allocated once and reused by every call
+        self._buffer = None
+        self._lock = threading.Lock()
+
+    def _upload(self, np_img: np.ndarray) -> torch.Tensor:
+        """[1,3,H,W] uint8 tensor on device"""
+        tensor = torch.from_numpy(np.ascontiguousarray(np_img[:, :, :3]))
+        if self.device.type == "cuda":
+            tensor = tensor.pin_memory()
+        tensor = tensor.to(self.device, non_blocking=True)
+        return tensor.permute(2, 0, 1).unsqueeze(0)
+
+    def _content_box(self, h: int, w: int) -> Tuple[int, int, int, int]:
+        """top, left, height, width of the resized image in the model input"""
+        s = self.size
+        if not self.letterbox:
+            return 0, 0, s, s
+        if h > w:
+            h, w = s, int(s * w / h)
+        else:
+            h, w = int(s * h / w), s
+        return (s - h) // 2, (s - w) // 2, h, w
+
+    def _input_buffer(self, n: int) -> torch.Tensor:
+        if self._buffer is None:
+            memory_format = (
+                torch.channels_last if self.channels_last else torch.contiguous_format
+            )
+            self._buffer = torch.empty(
+                (self.batch_size, 3, self.size, self.size),
+                dtype=self.dtype,
+                device=self.device,
+                memory_format=memory_format,
+            )
+        return self._buffer[:n]
+
+    def _fill_input(self, buffer: torch.Tensor, image: torch.Tensor):
+        """Resize and normalize image into buffer, a [3,size,size] model input"""
+        _, _, h, w = image.shape
+        top, left, ch, cw = self._content_box(h, w)
+        image = image.float()
+        if self.swap_rb:
+            image = image.flip(1)
+        # stretching uses an antialiased resize, same as PIL bilinear
+        image = F.interpolate(
+            image,
+            size=(ch, cw),
+            mode="bilinear",
+            align_corners=False,
+            antialias=not self.letterbox,
+        )
+        image = (image / 255.0 - self.mean) / self.std
+        if self.letterbox:
+            buffer.zero_()
+        buffer[:, top : top + ch, left : left + cw] = image[0]
+
+    def _mask(self, output: torch.Tensor, h: int, w: int) -> torch.Tensor:
+        """[1,1,H,W] uint8 mask from one model output"""
+        top, left, ch, cw = self._content_box(h, w)
+        output = output[None, :, top : top + ch, left : left + cw].float()
+        mask = F.interpolate(output, size=(h, w), mode="bilinear", align_corners=False)
+        if self.min_max_norm:
+            mi, ma = mask.min(), mask.max()
+            mask = (mask - mi) / (ma - mi)
+        return (mask * 255).clamp(0, 255).to(torch.uint8)
+
+    def _run(self, np_imgs: List[np.ndarray], rgba: bool) -> List[np.ndarray]:
+        with self._lock:
+            return self._run_locked(np_imgs, rgba)
+
+    def _run_locked(self, np_imgs: List[np.ndarray], rgba: bool) -> List[np.ndarray]:
+        results = []
+        for i in range(0, len(np_imgs), self.batch_size):
+            with span("matting_preprocess"):
+                images = [self._upload(it) for it in np_imgs[i : i + self.batch_size]]
+                batch = self._input_buffer(len(images))
+                for buffer, image in zip(batch, images):
+                    self._fill_input(buffer, image)
+            with span("matting_forward"):
+                outputs = self.forward(batch)
+            with span("matting_postprocess"):
+                for image, output in zip(images, outputs):
+                    mask = self._mask(output, image.shape[2], image.shape[3])
+                    if rgba:
+                        # same as pasting the image on a transparent one with mask
+                        rgb = (image.float() * mask.float() / 255.0).round()
+                        result = torch.cat([rgb.to(torch.uint8), mask], dim=1)[0]
+                        result = result.permute(1, 2, 0)
+                    else:
+                        result = mask[0, 0]
+                    results.append(result.cpu().numpy())
+        return results
+
+    @torch.inference_mode()
+    def masks(self, np_imgs: List[np.ndarray]) -> List[np.ndarray]:
+        """uint8 masks of np_imgs, 255 means foreground"""
+        return self._run(np_imgs, rgba=False)
+
+    @torch.inference_mode()
+    def cutouts(self, np_imgs: List[np.ndarray]) -> List[np.ndarray]:
+        """np_imgs with the background removed, 4 channels in the channel order of
+        the input, the mask is the alpha channel"""
+        return self._run(np_imgs, rgba=True)
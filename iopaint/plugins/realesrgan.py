@@ -1,5 +1,3 @@
-import math
-
 import cv2
 import numpy as np
 import torch
@@ -8,8 +6,23 @@ import torch.nn.functional as F
 from loguru import logger
 
 from iopaint.helper import download_model
+from iopaint.model.tiling import available_memory, feather_weight, tile_boxes
 from iopaint.plugins.base_plugin import BasePlugin
-from iopaint.schema import RunPluginRequest, RealESRGANModel
+from iopaint.schema import AlphaUpsampler, RunPluginRequest, RealESRGANModel
+
+
+def upscale_alpha(alpha: np.ndarray, scale: int) -> np.ndarray:
+    """Cubic upscaling of an alpha channel in [0, 1]. Pixels in areas that are flat
+    in the input keep their exact value, so edges don't ring and fully opaque or
+    transparent areas stay 1 and 0"""
+    h, w = alpha.shape[0:2]
+    size = (w * scale, h * scale)
+    output = np.clip(cv2.resize(alpha, size, interpolation=cv2.INTER_CUBIC), 0, 1)
+    kernel = np.ones((3, 3), dtype=np.uint8)
+    flat = (cv2.dilate(alpha, kernel) == cv2.erode(alpha, kernel)).astype(np.uint8)
+    flat = cv2.resize(flat, size, interpolation=cv2.INTER_NEAREST) > 0
+    output[flat] = cv2.resize(alpha, size, interpolation=cv2.INTER_NEAREST)[flat]
+    return output
 
 
 class RealESRGANer:
@@ -22,11 +35,17 @@ class RealESRGANer:
         tile (int): As too large images result in the out of GPU memory issue, so this tile option will first crop
             input images into tiles, and then process each of them. Finally, they will be merged into one image.
             0 denotes for do not use tile. Default: 0.
-        tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
+        tile_pad (int): The pad size for each tile, to remove border artifacts. Neighbouring tiles overlap
+            by twice this size and are blended over the overlap. Default: 10.
         pre_pad (int): Pad the input images to avoid border artifacts. Default: 10.
         half (float): Whether to use half precision during inference. Default: False.
+        tile_batch_size (int): Max number of tiles upscaled in one forward, fewer if they don't fit in half
+            of the free memory of the device. Default: 8.
     """
 
+    # rough activation memory of a forward pass per input pixel in bytes, float32
+    memory_per_pixel = 12 * 1024
+
     def __init__(
         self,
         scale,
@@ -39,6 +58,7 @@ class RealESRGANer:
         half=False,
         device=None,
         gpu_id=None,
+        tile_batch_size=8,
     ):
         self.scale = scale
         self.tile_size = tile
@@ -46,6 +66,7 @@ class RealESRGANer:
         self.pre_pad = pre_pad
         self.mod_scale = None
         self.half = half
+        self.tile_batch_size = tile_batch_size
 
         # initialize model
         if gpu_id:
@@ -95,11 +116,15 @@ class RealESRGANer:
         return net_a
 
     def pre_process(self, img):
-        """Pre-process, such as pre-pad and mod pad, so that the images can be divisible"""
-        img = torch.from_numpy(np.transpose(img, (2, 0, 1))).float()
-        self.img = img.unsqueeze(0).to(self.device)
-        if self.half:
-            self.img = self.img.half()
+        """Pre-process, such as pre-pad and mod pad, so that the images can be divisible
+
+        Args:
+            img: [H, W, C] or a batch of same size images [N, H, W, C]
+        """
+        if img.ndim == 3:
+            img = img[np.newaxis]
+        # kept on host, tile_process copies tiles to the device batch by batch
+        self.img = torch.from_numpy(np.transpose(img, (0, 3, 1, 2))).float()
 
         # pre_pad
         if self.pre_pad != 0:
@@ -120,84 +145,96 @@ class RealESRGANer:
                 self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), "reflect"
             )
 
+    def _to_model_input(self, img, non_blocking=False):
+        img = img.to(self.device, non_blocking=non_blocking)
+        if self.half:
+            img = img.half()
+        return img
+
     def process(self):
         # model inference
-        self.output = self.model(self.img)
+        self.output = self.model(self._to_model_input(self.img))
+
+    def _tile_batch_size(self, tile_height, tile_width):
+        budget = available_memory(self.device) // 2
+        memory_per_pixel = self.memory_per_pixel // (2 if self.half else 1)
+        batch_size = budget // (tile_height * tile_width * memory_per_pixel)
+        return int(min(max(batch_size, 1), self.tile_batch_size))
+
+    def _forward_tiles(self, tiles):
+        try:
+            return self.model(tiles)
+        except torch.cuda.OutOfMemoryError:
+            if len(tiles) == 1:
+                raise
+            # the memory estimate was too optimistic, run the halves one by one
+            logger.warning(f"Out of memory upscaling {len(tiles)} tiles, split batch")
+            half = len(tiles) // 2
+            return torch.cat(
+                [self._forward_tiles(tiles[:half]), self._forward_tiles(tiles[half:])]
+            )
 
     def tile_process(self):
-        """It will first crop input images to tiles, and then process each tile.
-        Finally, all the processed tiles are merged into one images.
+        """Upscale overlapping tiles of the image and blend them with feathered
+        weights, so seams fade between neighbours instead of a hard cut.
 
-        Modified from: https://github.com/ata4/esrgan-launcher
+        All tiles have the same size, as many as fit in half of the free memory
+        go through the model in one forward. On cuda the next batch is copied to
+        the device on a side stream while the current one runs.
         """
         batch, channel, height, width = self.img.shape
-        output_height = height * self.scale
-        output_width = width * self.scale
-        output_shape = (batch, channel, output_height, output_width)
-
-        # start with black image
-        self.output = self.img.new_zeros(output_shape)
-        tiles_x = math.ceil(width / self.tile_size)
-        tiles_y = math.ceil(height / self.tile_size)
-
-        # loop over all tiles
-        for y in range(tiles_y):
-            for x in range(tiles_x):
-                # extract tile from input image
-                ofs_x = x * self.tile_size
-                ofs_y = y * self.tile_size
-                # input tile area on total image
-                input_start_x = ofs_x
-                input_end_x = min(ofs_x + self.tile_size, width)
-                input_start_y = ofs_y
-                input_end_y = min(ofs_y + self.tile_size, height)
-
-                # input tile area on total image with padding
-                input_start_x_pad = max(input_start_x - self.tile_pad, 0)
-                input_end_x_pad = min(input_end_x + self.tile_pad, width)
-                input_start_y_pad = max(input_start_y - self.tile_pad, 0)
-                input_end_y_pad = min(input_end_y + self.tile_pad, height)
-
-                # input tile dimensions
-                input_tile_width = input_end_x - input_start_x
-                input_tile_height = input_end_y - input_start_y
-                tile_idx = y * tiles_x + x + 1
-                input_tile = self.img[
-                    :,
-                    :,
-                    input_start_y_pad:input_end_y_pad,
-                    input_start_x_pad:input_end_x_pad,
-                ]
-
-                # upscale tile
-                try:
-                    with torch.no_grad():
-                        output_tile = self.model(input_tile)
-                except RuntimeError as error:
-                    print("Error", error)
-                print(f"\tTile {tile_idx}/{tiles_x * tiles_y}")
-
-                # output tile area on total image
-                output_start_x = input_start_x * self.scale
-                output_end_x = input_end_x * self.scale
-                output_start_y = input_start_y * self.scale
-                output_end_y = input_end_y * self.scale
-
-                # output tile area without padding
-                output_start_x_tile = (input_start_x - input_start_x_pad) * self.scale
-                output_end_x_tile = output_start_x_tile + input_tile_width * self.scale
-                output_start_y_tile = (input_start_y - input_start_y_pad) * self.scale
-                output_end_y_tile = output_start_y_tile + input_tile_height * self.scale
-
-                # put tile into output image
-                self.output[
-                    :, :, output_start_y:output_end_y, output_start_x:output_end_x
-                ] = output_tile[
-                    :,
-                    :,
-                    output_start_y_tile:output_end_y_tile,
-                    output_start_x_tile:output_end_x_tile,
-                ]
+        scale = self.scale
+        overlap = min(self.tile_pad * 2, self.tile_size // 2)
+        boxes = tile_boxes(height, width, self.tile_size, overlap)
+        l, t, r, b = boxes[0]
+        # every box has a tile of each image of the batch
+        batch_size = max(self._tile_batch_size(b - t, r - l) // batch, 1)
+        batches = [boxes[i : i + batch_size] for i in range(0, len(boxes), batch_size)]
+        logger.info(
+            f"RealESRGAN {len(boxes) * batch} tiles of {r - l}x{b - t}, "
+            f"overlap: {overlap}, batch size: {batch_size * batch}"
+        )
+
+        device = torch.device(self.device)
+        copy_stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+        def load_batch(batch_boxes):
+            tiles = torch.cat([self.img[:, :, t:b, l:r] for l, t, r, b in batch_boxes])
+            if copy_stream is None:
+                return self._to_model_input(tiles)
+            with torch.cuda.stream(copy_stream):
+                return self._to_model_input(tiles.pin_memory(), non_blocking=True)
+
+        self.output = torch.zeros(
+            (batch, channel, height * scale, width * scale), dtype=torch.float32
+        )
+        weights = torch.zeros((height * scale, width * scale), dtype=torch.float32)
+        next_tiles = load_batch(batches[0])
+        for i, batch_boxes in enumerate(batches):
+            tiles = next_tiles
+            if copy_stream is not None:
+                compute_stream = torch.cuda.current_stream(device)
+                compute_stream.wait_stream(copy_stream)
+                tiles.record_stream(compute_stream)
+            if i + 1 < len(batches):
+                next_tiles = load_batch(batches[i + 1])
+
+            with torch.no_grad():
+                output_tiles = self._forward_tiles(tiles).float().cpu()
+            output_tiles = output_tiles.view(
+                len(batch_boxes), batch, *output_tiles.shape[1:]
+            )
+
+            for output_tile, (l, t, r, b) in zip(output_tiles, batch_boxes):
+                box = [l * scale, t * scale, r * scale, b * scale]
+                weight = torch.from_numpy(
+                    feather_weight(box, height * scale, width * scale, overlap * scale)
+                )
+                self.output[:, :, box[1] : box[3], box[0] : box[2]] += (
+                    output_tile * weight
+                )
+                weights[box[1] : box[3], box[0] : box[2]] += weight
+        self.output /= weights
 
     def post_process(self):
         # remove extra pad
@@ -227,7 +264,7 @@ class RealESRGANer:
         img = img.astype(np.float32)
         if np.max(img) > 256:  # 16-bit image
             max_range = 65535
-            print("\tInput is a 16-bit image")
+            logger.info("Input is a 16-bit image")
         else:
             max_range = 255
         img = img / max_range
@@ -245,32 +282,25 @@ class RealESRGANer:
             img_mode = "RGB"
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
-        # ------------------- process image (without the alpha channel) ------------------- #
-        self.pre_process(img)
+        # ------------- process image, and the alpha channel in the same forward ------------- #
+        pack_alpha = img_mode == "RGBA" and alpha_upsampler == AlphaUpsampler.realesrgan
+        self.pre_process(np.stack([img, alpha]) if pack_alpha else img)
         if self.tile_size > 0:
             self.tile_process()
         else:
             self.process()
-        output_img = self.post_process()
-        output_img = output_img.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-        output_img = np.transpose(output_img[[2, 1, 0], :, :], (1, 2, 0))
+        output = self.post_process().data.float().cpu().clamp_(0, 1).numpy()
+        output = np.transpose(output[:, [2, 1, 0], :, :], (0, 2, 3, 1))
+        output_img = output[0]
         if img_mode == "L":
             output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
 
-        # ------------------- process the alpha channel if necessary ------------------- #
+        # ------------------- upscale the alpha channel if necessary ------------------- #
         if img_mode == "RGBA":
-            if alpha_upsampler == "realesrgan":
-                self.pre_process(alpha)
-                if self.tile_size > 0:
-                    self.tile_process()
-                else:
-                    self.process()
-                output_alpha = self.post_process()
-                output_alpha = (
-                    output_alpha.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-                )
-                output_alpha = np.transpose(output_alpha[[2, 1, 0], :, :], (1, 2, 0))
-                output_alpha = cv2.cvtColor(output_alpha, cv2.COLOR_BGR2GRAY)
+            if pack_alpha:
+                output_alpha = cv2.cvtColor(output[1], cv2.COLOR_BGR2GRAY)
+            elif alpha_upsampler == AlphaUpsampler.fast:
+                output_alpha = upscale_alpha(alpha, self.scale)
             else:  # use the cv2 resize for alpha channel
                 h, w = alpha.shape[0:2]
                 output_alpha = cv2.resize(
@@ -378,6 +408,7 @@ class SRVGGNetCompact(nn.Module):
 class RealESRGANUpscaler(BasePlugin):
     name = "RealESRGAN"
     support_gen_image = True
+    support_alpha_channel = True
 
     def __init__(self, name, device, no_half=False):
         super().__init__()
@@ -455,14 +486,27 @@ class RealESRGANUpscaler(BasePlugin):
         self.model_name = new_model_name
 
     def gen_image(self, rgb_np_img, req: RunPluginRequest) -> np.ndarray:
-        bgr_np_img = cv2.cvtColor(rgb_np_img, cv2.COLOR_RGB2BGR)
+        # RGB or RGBA
+        if rgb_np_img.shape[2] == 4:
+            bgr_np_img = cv2.cvtColor(rgb_np_img, cv2.COLOR_RGBA2BGRA)
+        else:
+            bgr_np_img = cv2.cvtColor(rgb_np_img, cv2.COLOR_RGB2BGR)
         logger.info(f"RealESRGAN input shape: {bgr_np_img.shape}, scale: {req.scale}")
-        result = self.forward(bgr_np_img, req.scale)
+        result = self.forward(bgr_np_img, req.scale, req.alpha_upsampler)
         logger.info(f"RealESRGAN output shape: {result.shape}")
+        if result.shape[2] == 4:
+            return cv2.cvtColor(result, cv2.COLOR_BGRA2RGBA)
         return result
 
     @torch.inference_mode()
-    def forward(self, bgr_np_img, scale: float):
+    def forward(
+        self,
+        bgr_np_img,
+        scale: float,
+        alpha_upsampler: AlphaUpsampler = AlphaUpsampler.realesrgan,
+    ):
         # 输出是 BGR
-        upsampled = self.model.enhance(bgr_np_img, outscale=scale)[0]
+        upsampled = self.model.enhance(
+            bgr_np_img, outscale=scale, alpha_upsampler=alpha_upsampler
+        )[0]
         return upsampled
@@ -1,4 +1,6 @@
 import os
+from typing import List
+
 import cv2
 import numpy as np
 from loguru import logger
@@ -20,10 +22,12 @@ class RemoveBG(BasePlugin):
     support_gen_mask = True
     support_gen_image = True
 
-    def __init__(self, model_name, device):
+    def __init__(self, model_name, device, batch_size: int = 4):
         super().__init__()
         self.model_name = model_name
         self.device = device
+        # number of images run in one forward by gen_image_batch
+        self.batch_size = batch_size
 
         if model_name.startswith("birefnet"):
             import rembg
@@ -41,15 +45,22 @@ class RemoveBG(BasePlugin):
 
     def _init_session(self, model_name: str):
         self.device_warning()
+        # device resident batched path, for the sessions that support it
+        self.engine = None
 
         if model_name == RemoveBGModel.briaai_rmbg_1_4:
             from iopaint.plugins.briarmbg import (
                 create_briarmbg_session,
+                create_briarmbg_engine,
                 briarmbg_process,
             )
 
             self.session = create_briarmbg_session().to(self.device)
             self.remove = briarmbg_process
+            # the session has always been fed BGR images
+            self.engine = create_briarmbg_engine(
+                self.session, self.device, swap_rb=True, batch_size=self.batch_size
+            )
         elif model_name == RemoveBGModel.briaai_rmbg_2_0:
             from iopaint.plugins.briarmbg2 import (
                 create_briarmbg2_session,
@@ -63,6 +74,7 @@ class RemoveBG(BasePlugin):
 
             self.session = new_session(model_name=model_name)
             self.remove = _rmbg_remove
+        self.support_gen_image_batch = self.engine is not None
 
     def switch_model(self, new_model_name):
         if self.model_name == new_model_name:
@@ -76,14 +88,21 @@ class RemoveBG(BasePlugin):
 
     @torch.inference_mode()
     def gen_image(self, rgb_np_img, req: RunPluginRequest) -> np.ndarray:
+        if self.engine is not None:
+            return self.engine.cutouts([rgb_np_img])[0]
         bgr_np_img = cv2.cvtColor(rgb_np_img, cv2.COLOR_RGB2BGR)
 
         # return BGRA image
         output = self.remove(self.device, bgr_np_img, session=self.session)
         return cv2.cvtColor(output, cv2.COLOR_BGRA2RGBA)
 
+    def gen_image_batch(self, rgb_np_imgs) -> List[np.ndarray]:
+        return self.engine.cutouts(rgb_np_imgs)
+
     @torch.inference_mode()
     def gen_mask(self, rgb_np_img, req: RunPluginRequest) -> np.ndarray:
+        if self.engine is not None:
+            return self.engine.masks([rgb_np_img])[0]
         bgr_np_img = cv2.cvtColor(rgb_np_img, cv2.COLOR_RGB2BGR)
 
         # return BGR image, 255 means foreground, 0 means background
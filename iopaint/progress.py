@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from loguru import logger
+from socketio import AsyncServer
+
+_local = threading.local()
+
+
+@contextmanager
+def progress_job(job_id: str):
+    """Tag events published by the current thread with job_id"""
+    old_job_id = getattr(_local, "job_id", None)
+    _local.job_id = job_id
+    try:
+        yield
+    finally:
+        _local.job_id = old_job_id
+
+
+def current_job_id() -> Optional[str]:
+    return getattr(_local, "job_id", None)
+
+
+class ProgressBus:
+    """Forward progress events from inference threads to socketio clients.
+
+    ``publish`` never blocks the caller: events are put in a pending table and
+    flushed by a coroutine on the server event loop, scheduled with
+    ``run_coroutine_threadsafe``. Progress events of the same job are
+    coalesced, only the latest one is sent, at most once per ``min_interval``
+    seconds. Final events are never coalesced, and flush the pending progress
+    of their job first.
+
+    The server loop is captured when the first socketio client connects, events
+    published before that have no one to receive them and are dropped.
+    """
+
+    def __init__(self, sio: Optional[AsyncServer] = None, min_interval: float = 0.1):
+        self.sio = sio
+        self.min_interval = min_interval
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._pending: "OrderedDict[tuple, Dict]" = OrderedDict()
+        self._last_sent: Dict[tuple, float] = {}
+        self._flush_scheduled = False
+        self._final_counter = 0
+        # keeps emits of consecutive flushes in order
+        self._emit_lock: Optional[asyncio.Lock] = None
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    async def on_connect(self, sid, environ, auth=None):
+        self._loop = asyncio.get_running_loop()
+
+    def publish(self, event: str, data: Optional[Dict] = None, final: bool = False):
+        loop = self._loop
+        if self.sio is None or loop is None or loop.is_closed():
+            return
+
+        job_id = current_job_id()
+        data = dict(data or {})
+        if job_id is not None:
+            data["job_id"] = job_id
+
+        with self._lock:
+            if final:
+                self._final_counter += 1
+                key = (event, job_id, self._final_counter)
+            else:
+                key = (event, job_id)
+            # assigning an existing key keeps its position, so a coalesced
+            # progress event is still sent before the final event of its job
+            self._pending[key] = dict(
+                event=event, data=data, final=final, job_id=job_id
+            )
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+
+        try:
+            asyncio.run_coroutine_threadsafe(self._flush(), loop)
+        except RuntimeError:
+            # event loop is closed
+            with self._lock:
+                self._flush_scheduled = False
+
+    async def _flush(self):
+        now = time.monotonic()
+        with self._lock:
+            pending = self._pending
+            self._pending = OrderedDict()
+            self._flush_scheduled = False
+            finished_jobs = {it["job_id"] for it in pending.values() if it["final"]}
+
+            send = []
+            retry_after = None
+            for key, it in pending.items():
+                if it["final"] or it["job_id"] in finished_jobs:
+                    send.append(it)
+                    continue
+                wait = self._last_sent.get(key, 0) + self.min_interval - now
+                if wait > 0:
+                    self._pending[key] = it
+                    retry_after = min(retry_after or wait, wait)
+                    continue
+                self._last_sent[key] = now
+                send.append(it)
+
+            # an event sent min_interval ago no longer limits anything, pruning
+            # by age also drops jobs that failed without a final event
+            for key, sent in list(self._last_sent.items()):
+                if key[1] in finished_jobs or now - sent >= self.min_interval:
+                    del self._last_sent[key]
+
+            if retry_after is not None:
+                self._flush_scheduled = True
+                loop = asyncio.get_running_loop()
+                loop.call_later(retry_after, self._schedule_flush)
+
+        if self._emit_lock is None:
+            self._emit_lock = asyncio.Lock()
+        async with self._emit_lock:
+            for it in send:
+                try:
+                    await self.sio.emit(it["event"], it["data"])
+                except Exception as e:
+                    logger.warning(f"Emit {it['event']} failed: {e}")
+
+    def _schedule_flush(self):
+        asyncio.ensure_future(self._flush())
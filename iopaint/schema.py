@@ -147,6 +147,14 @@ class RealESRGANModel(Choices):
     RealESRGAN_x4plus_anime_6B = "RealESRGAN_x4plus_anime_6B"
 
 
+class AlphaUpsampler(Choices):
+    # alpha goes through the network in the same forward as the color image
+    realesrgan = "realesrgan"
+    # cubic interpolation, exact in flat areas
+    fast = "fast"
+    linear = "linear"
+
+
 class RemoveBGModel(Choices):
     briaai_rmbg_1_4 = "briaai/RMBG-1.4"
     briaai_rmbg_2_0 = "briaai/RMBG-2.0"
@@ -192,6 +200,25 @@ class InteractiveSegModel(Choices):
     sam2_1_large = "sam2_1_large"
 
 
+class JobStatus(Choices):
+    pending = "pending"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
+class JobInfo(BaseModel):
+    id: str
+    status: JobStatus
+    position: Optional[int] = Field(
+        None, description="Number of jobs ahead of this one, only set when pending"
+    )
+    error: Optional[str] = None
+    queue_time_ms: Optional[float] = None
+    run_time_ms: Optional[float] = None
+
+
 class PluginInfo(BaseModel):
     name: str
     support_gen_image: bool = False
@@ -212,6 +239,9 @@ class HDStrategy(str, Enum):
     RESIZE = "Resize"
     # Crop masking area(with a margin controlled by hd_strategy_crop_margin) from the original image to do inpainting
     CROP = "Crop"
+    # Split the image into overlapping tiles(hd_strategy_tile_size/hd_strategy_tile_overlap), inpaint the tiles
+    # containing mask and blend them. Memory and latency stay bounded for any image and mask size.
+    TILE = "Tile"
 
 
 class LDMSampler(str, Enum):
@@ -273,6 +303,7 @@ class ApiConfig(BaseModel):
     remove_bg_device: Device
     remove_bg_model: str
     enable_anime_seg: bool
+    anime_seg_device: Device
     enable_realesrgan: bool
     realesrgan_device: Device
     realesrgan_model: RealESRGANModel
@@ -280,11 +311,38 @@ class ApiConfig(BaseModel):
     gfpgan_device: Device
     enable_restoreformer: bool
     restoreformer_device: Device
+    inpaint_workers: int = 1
+    max_queue_size: int = 16
+    erase_batch_size: int = 1
+    erase_batch_wait_ms: float = 5.0
+    model_cache_vram_gb: float = 0
+    model_cache_ram_gb: float = 0
+    image_store_mb: float = 1024
+    image_store_dir: Optional[Path] = None
+    image_store_dir_mb: float = 10240
 
 
 class InpaintRequest(BaseModel):
     image: Optional[str] = Field(None, description="base64 encoded image")
+    image_id: Optional[str] = Field(
+        None,
+        description="Id of an image in the image store, used when image is empty",
+    )
+    store_result: bool = Field(
+        False,
+        description="Keep the result in the image store, its id is returned in the X-Image-Id header",
+    )
+    incremental: bool = Field(
+        False,
+        description="image_id is a stored result, only inpaint the part of mask it was not inpainted with. "
+        "mask should contain all strokes so far, the result is always stored",
+    )
     mask: Optional[str] = Field(None, description="base64 encoded mask")
+    model: Optional[str] = Field(
+        None,
+        description="Run this request with the model instead of the current model, without switching it. "
+        "ControlNet/BrushNet/PowerPaint v2 are only available for the current model.",
+    )
 
     ldm_steps: int = Field(20, description="Steps for ldm model.")
     ldm_sampler: str = Field(LDMSampler.plms, description="Sampler for ldm model.")
@@ -304,6 +362,13 @@ class InpaintRequest(BaseModel):
     hd_strategy_resize_limit: int = Field(
         1280, description="Resize limit for hd_strategy=RESIZE"
     )
+    hd_strategy_tile_size: int = Field(
+        0,
+        description="Tile size for hd_strategy=TILE, 0 picks the largest tile fitting in free memory",
+    )
+    hd_strategy_tile_overlap: int = Field(
+        64, description="Overlap between tiles for hd_strategy=TILE"
+    )
 
     prompt: str = Field("", description="Prompt for diffusion models.")
     negative_prompt: str = Field(
@@ -450,11 +515,71 @@ class InpaintRequest(BaseModel):
 
 class RunPluginRequest(BaseModel):
     name: str
-    image: str = Field(..., description="base64 encoded image")
+    image: str = Field(
+        "", description="base64 encoded image, can be empty if image_id is cached"
+    )
+    image_id: Optional[str] = Field(
+        None,
+        description="Id of an image in the image store, or of an image sent before, returned in the X-Image-Id header",
+    )
     clicks: List[List[int]] = Field(
         [], description="Clicks for interactive seg, [[x,y,0/1], [x2,y2,0/1]]"
     )
     scale: float = Field(2.0, description="Scale for upscaling")
+    alpha_upsampler: AlphaUpsampler = Field(
+        AlphaUpsampler.fast,
+        description="How upscaling plugins upscale the alpha channel of RGBA images",
+    )
+
+
+class SegmentPrompt(BaseModel):
+    clicks: List[List[int]] = Field(
+        [], description="Clicks for interactive seg, [[x,y,0/1], [x2,y2,0/1]]"
+    )
+    box: Optional[List[int]] = Field(None, description="Box prompt, [x1,y1,x2,y2]")
+
+    @model_validator(mode="after")
+    def validate_field(cls, values: "SegmentPrompt"):
+        if not values.clicks and values.box is None:
+            raise ValueError("clicks or box is required")
+        if values.box is not None and len(values.box) != 4:
+            raise ValueError("box should be [x1,y1,x2,y2]")
+        return values
+
+
+class SegmentItem(BaseModel):
+    image: str = Field(..., description="base64 encoded image")
+    prompts: List[SegmentPrompt] = Field(
+        ..., description="Each prompt gives one mask of the image"
+    )
+
+
+class ImageInfo(BaseModel):
+    id: str
+    width: int
+    height: int
+
+
+class RunPluginBatchRequest(BaseModel):
+    name: str
+    items: List[SegmentItem]
+
+
+class RunPluginBatchResponse(BaseModel):
+    masks: List[List[str]] = Field(
+        ..., description="base64 encoded png masks, in the order of items and prompts"
+    )
+
+
+class RunPluginImageBatchRequest(BaseModel):
+    name: str
+    images: List[str] = Field(..., description="base64 encoded images")
+
+
+class RunPluginImageBatchResponse(BaseModel):
+    images: List[str] = Field(
+        ..., description="base64 encoded png RGBA images, in the order of images"
+    )
 
 
 MediaTab = Literal["input", "output", "mask"]
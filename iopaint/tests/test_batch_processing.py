@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from iopaint import batch_processing
+
+
+class FakeModelManager:
+    def __init__(self, name, device, **kwargs):
+        self.calls = 0
+
+    def __call__(self, image, mask, config):
+        self.calls += 1
+        # bgr, masked area filled with white
+        result = image[:, :, ::-1].copy()
+        result[mask > 127] = 255
+        return result
+
+
+@pytest.fixture
+def batch_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_processing, "ModelManager", FakeModelManager)
+    image_dir = tmp_path / "images"
+    mask_dir = tmp_path / "masks"
+    image_dir.mkdir()
+    mask_dir.mkdir()
+    rng = np.random.RandomState(0)
+    for i in range(7):
+        img = rng.randint(0, 255, (32, 48, 3), dtype=np.uint8)
+        Image.fromarray(img).save(image_dir / f"{i}.png")
+        # half size mask, resized to the image size
+        mask = np.zeros((16, 24), dtype=np.uint8)
+        mask[4:8, 4:8] = 200
+        Image.fromarray(mask).save(mask_dir / f"{i}.png")
+    return image_dir, mask_dir, tmp_path / "output"
+
+
+def test_batch_inpaint(batch_dirs):
+    image_dir, mask_dir, output_dir = batch_dirs
+    batch_processing.batch_inpaint(
+        "lama", "cpu", image_dir, mask_dir, output_dir, prefetch=2
+    )
+
+    for i in range(7):
+        img = np.array(Image.open(image_dir / f"{i}.png"))
+        result = np.array(Image.open(output_dir / f"{i}.png"))
+        assert (result[8:16, 8:16] == 255).all()
+        np.testing.assert_array_equal(result[16:], img[16:])
+
+
+def test_batch_inpaint_shard(batch_dirs):
+    image_dir, mask_dir, output_dir = batch_dirs
+    for i in range(3):
+        batch_processing.batch_inpaint(
+            "lama", "cpu", image_dir, mask_dir, output_dir / str(i), shard=f"{i}/3"
+        )
+    outputs = [{p.stem for p in (output_dir / str(i)).glob("*.png")} for i in range(3)]
+    assert sum(len(it) for it in outputs) == 7
+    assert set.union(*outputs) == {str(i) for i in range(7)}
+
+
+def test_batch_inpaint_resume(batch_dirs):
+    image_dir, mask_dir, output_dir = batch_dirs
+    manifest = output_dir.parent / "manifest.jsonl"
+    batch_processing.batch_inpaint(
+        "lama", "cpu", image_dir, mask_dir, output_dir, manifest=manifest
+    )
+    records = batch_processing.load_manifest(manifest)
+    assert len(records) == 7
+    assert all(it["status"] == "ok" and it["latency_ms"] >= 0 for it in records.values())
+
+    # changed image is processed again, broken image fails without stopping the run
+    Image.fromarray(np.zeros((32, 48, 3), dtype=np.uint8)).save(image_dir / "1.png")
+    (image_dir / "2.png").write_bytes(b"broken")
+    batch_processing.batch_inpaint(
+        "lama", "cpu", image_dir, mask_dir, output_dir, resume=True, manifest=manifest
+    )
+    records = batch_processing.load_manifest(manifest)
+    assert records["1"]["status"] == "ok"
+    assert records["2"]["status"] == "failed"
+    assert records["3"]["status"] == "skipped"
+    assert [it["status"] for it in records.values()].count("skipped") == 5
+
+
+def test_parse_shard():
+    assert batch_processing.parse_shard("1/4") == (1, 4)
+    for shard in ["4/4", "1", "a/b", "0/0"]:
+        with pytest.raises(ValueError):
+            batch_processing.parse_shard(shard)
+
+
+def test_batch_inpaint_workers(batch_dirs):
+    image_dir, mask_dir, output_dir = batch_dirs
+    manifest = output_dir.parent / "manifest.jsonl"
+    batch_processing.batch_inpaint(
+        "lama",
+        "cpu",
+        image_dir,
+        mask_dir,
+        output_dir,
+        manifest=manifest,
+        workers=3,
+        worker_threads=1,
+    )
+    records = batch_processing.load_manifest(manifest)
+    assert len(records) == 7
+    assert all(it["status"] == "ok" for it in records.values())
+    for i in range(7):
+        result = np.array(Image.open(output_dir / f"{i}.png"))
+        assert (result[8:16, 8:16] == 255).all()
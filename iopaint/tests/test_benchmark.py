@@ -0,0 +1,50 @@
+import time
+
+import numpy as np
+import torch
+
+from iopaint.benchmark import (
+    ModelTarget,
+    RssSampler,
+    bench_case,
+    compare,
+    synthetic_mask,
+)
+from iopaint.schema import HDStrategy
+
+
+def test_synthetic_mask_coverage():
+    mask = synthetic_mask(256, 384, 0.2)
+    assert mask.shape == (256, 384)
+    assert 0.2 <= (mask > 0).mean() < 0.4
+
+
+def test_bench_case_and_compare():
+    device = torch.device("cpu")
+    target = ModelTarget("cv2", device)
+    result = bench_case(target, device, (128, 128), 0.1, HDStrategy.CROP, 1, 1, 3)
+    assert result["target"] == "cv2"
+    assert len(result["warmup_ms"]) == 1
+    assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+    assert result["throughput"] > 0
+    assert "peak_rss_mb" not in result
+
+    slower = dict(result, p50_ms=result["p50_ms"] * 2)
+    assert compare([result], [result], 0.1) == 0
+    assert compare([slower], [result], 0.1) == 1
+
+
+def test_compare_matches_http_concurrency():
+    result = dict(target="http:inpaint", width=64, height=64, coverage=0.1)
+    old = [dict(result, concurrency=1, p50_ms=10.0)]
+    assert compare([dict(result, concurrency=8, p50_ms=100.0)], old, 0.1) == 0
+    assert compare([dict(result, concurrency=1, p50_ms=100.0)], old, 0.1) == 1
+
+
+def test_rss_sampler_measures_case_delta():
+    with RssSampler() as rss:
+        data = np.ones(64 * 1024 * 1024, dtype=np.uint8)
+        time.sleep(0.05)
+    del data
+    if rss.peak_delta_mb is not None:
+        assert rss.peak_delta_mb >= 32
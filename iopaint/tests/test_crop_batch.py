@@ -0,0 +1,72 @@
+import numpy as np
+
+from iopaint.helper import merge_boxes
+from iopaint.model.base import InpaintModel
+from iopaint.schema import HDStrategy, InpaintRequest
+
+
+class FakeModel(InpaintModel):
+    name = "fake"
+    support_batch = True
+
+    def init_model(self, device, **kwargs):
+        self.batch_sizes = []
+
+    @staticmethod
+    def is_downloaded() -> bool:
+        return True
+
+    def forward(self, image, mask, config: InpaintRequest):
+        return self.forward_batch([image], [mask], config)[0]
+
+    def forward_batch(self, images, masks, config: InpaintRequest):
+        self.batch_sizes.append(len(images))
+        results = []
+        for image, mask in zip(images, masks):
+            # depends on the whole input, like a real model
+            result = image.astype(np.float32) * 0.5 + image.mean()
+            result[mask[:, :, 0] > 127] = 255 - image.mean()
+            results.append(np.clip(result, 0, 255).astype(np.uint8)[:, :, ::-1])
+        return results
+
+
+class SerialFakeModel(FakeModel):
+    support_batch = False
+
+
+def test_merge_boxes():
+    boxes = [
+        np.array([100, 100, 120, 120]),
+        np.array([130, 100, 150, 120]),
+        np.array([800, 800, 820, 820]),
+    ]
+    merged = merge_boxes(boxes, margin=64)
+    assert len(merged) == 2
+    assert merged[0].tolist() == [100, 100, 150, 120]
+    assert merged[1].tolist() == [800, 800, 820, 820]
+
+    assert len(merge_boxes(boxes, margin=64, max_size=150)) == 3
+    assert len(merge_boxes(boxes, margin=0)) == 3
+
+
+def test_crop_strategy_batched_same_as_serial():
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 255, (1200, 1000, 3), dtype=np.uint8)
+    mask = np.zeros((1200, 1000), dtype=np.uint8)
+    # same size scribbles far away from each other
+    for y, x in [(100, 100), (100, 700), (900, 100), (900, 700)]:
+        mask[y : y + 40, x : x + 60] = 255
+    config = InpaintRequest(
+        hd_strategy=HDStrategy.CROP,
+        hd_strategy_crop_trigger_size=800,
+        hd_strategy_crop_margin=64,
+    )
+
+    model = FakeModel("cpu")
+    result = model(image.copy(), mask, config)
+    assert model.batch_sizes == [4]
+
+    serial_model = SerialFakeModel("cpu")
+    expected = serial_model(image.copy(), mask, config)
+    assert serial_model.batch_sizes == [1, 1, 1, 1]
+    np.testing.assert_array_equal(result, expected)
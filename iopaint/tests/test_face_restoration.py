@@ -0,0 +1,199 @@
+import threading
+
+import cv2
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from iopaint.plugins.face_analysis import FaceAnalysis
+from iopaint.plugins.facexlib.utils.face_restoration_helper import (
+    MASK_COLORMAP,
+    FaceRestoreHelper,
+)
+from iopaint.plugins.gfpganer import MyGFPGANer
+
+
+def _helper(use_parse=False, face_size=64):
+    helper = FaceRestoreHelper.__new__(FaceRestoreHelper)
+    helper.upscale_factor = 2
+    helper.face_size = (face_size, face_size)
+    helper.square_mask = np.ones(helper.face_size, dtype=np.float32)
+    helper.use_parse = use_parse
+    helper.parse_batch_size = 2
+    helper.device = torch.device("cpu")
+    helper.save_ext = "png"
+    return helper
+
+
+def _affine(angle, scale, tx, ty):
+    matrix = cv2.getRotationMatrix2D((0, 0), angle, scale)
+    matrix[:, 2] = (tx, ty)
+    return matrix
+
+
+def test_paste_faces_in_boxes(monkeypatch):
+    rng = np.random.RandomState(0)
+    helper = _helper()
+    helper.input_img = rng.randint(0, 255, (150, 200, 3), dtype=np.uint8)
+    # smooth faces, warpAffine rounds the sub-pixel position of noise differently
+    # when the translation changes
+    helper.restored_faces = [
+        cv2.GaussianBlur(rng.randint(0, 255, (64, 64, 3), dtype=np.uint8), (0, 0), 3)
+        for _ in range(3)
+    ]
+    helper.inverse_affine_matrices = [
+        _affine(10, 1.5, 40, 30),
+        _affine(-30, 2.0, 250, 150),
+        # partly outside the image
+        _affine(0, 1.2, 360, -20),
+    ]
+    result = helper.paste_faces_to_input_image()
+    assert result.shape == (300, 400, 3) and result.dtype == np.uint8
+
+    # same as blending the whole image for every face
+    monkeypatch.setattr(
+        FaceRestoreHelper, "_face_box", lambda self, face, m, w, h: (0, 0, w, h)
+    )
+    full = helper.paste_faces_to_input_image()
+    assert np.abs(result.astype(int) - full.astype(int)).max() <= 1
+    upsampled = cv2.resize(
+        helper.input_img, (400, 300), interpolation=cv2.INTER_LANCZOS4
+    )
+    assert (result != upsampled).any()
+
+
+def test_parse_masks_batched():
+    torch.manual_seed(0)
+    conv = nn.Conv2d(3, 19, 3, padding=1)
+    sizes = []
+
+    def face_parse(x):
+        sizes.append(len(x))
+        return (conv(x),)
+
+    helper = _helper(use_parse=True)
+    helper.face_parse = face_parse
+    rng = np.random.RandomState(0)
+    faces = [rng.randint(0, 255, (64, 64, 3), dtype=np.uint8) for _ in range(3)]
+    masks = helper._parse_soft_masks(faces)
+    assert sizes == [2, 1]
+
+    colormap = np.array(MASK_COLORMAP, dtype=np.float64)
+    with torch.no_grad():
+        for face, mask in zip(faces, masks):
+            face_input = cv2.resize(face, (512, 512), interpolation=cv2.INTER_LINEAR)
+            face_input = cv2.cvtColor(face_input, cv2.COLOR_BGR2RGB) / 255.0
+            face_input = torch.from_numpy(face_input.transpose(2, 0, 1)).float()
+            out = conv(((face_input - 0.5) / 0.5)[None])[0].argmax(0).numpy()
+            expected = cv2.GaussianBlur(colormap[out], (101, 101), 11)
+            expected = cv2.GaussianBlur(expected, (101, 101), 11)
+            expected[:10, :] = expected[-10:, :] = 0
+            expected[:, :10] = expected[:, -10:] = 0
+            np.testing.assert_allclose(mask, expected / 255.0, atol=1e-4)
+
+
+class FakeGFPGAN(nn.Module):
+    def __init__(self, max_batch):
+        super().__init__()
+        self.max_batch = max_batch
+        self.sizes = []
+
+    def forward(self, x, return_rgb=False, weight=0.5):
+        if len(x) > self.max_batch:
+            raise torch.cuda.OutOfMemoryError("out of memory")
+        self.sizes.append(len(x))
+        return -x, None
+
+
+def test_restore_faces_batched():
+    restorer = MyGFPGANer.__new__(MyGFPGANer)
+    restorer.device = torch.device("cpu")
+    restorer.gfpgan = FakeGFPGAN(max_batch=2)
+    rng = np.random.RandomState(0)
+    faces = [rng.randint(0, 255, (32, 32, 3), dtype=np.uint8) for _ in range(5)]
+    restored = restorer._restore_faces(faces, 0.5)
+    # out of memory splits the batch
+    assert restorer.gfpgan.sizes == [2, 1, 2]
+    assert len(restored) == 5
+    for face, it in zip(faces, restored):
+        assert it.dtype == np.uint8
+        assert np.abs(it.astype(int) - (255 - face.astype(int))).max() <= 1
+
+
+class FakeDetector:
+    def __init__(self):
+        self.shapes = []
+
+    def detect_faces(self, image, conf_threshold):
+        self.shapes.append(image.shape[:2])
+        h, w = image.shape[:2]
+        # one face in the center, eyes, nose and mouth corners
+        cx, cy, s = w / 2, h / 2, min(h, w) / 8
+        landmarks = [
+            cx - s, cy - s, cx + s, cy - s, cx, cy, cx - s / 2, cy + s, cx + s / 2, cy + s
+        ]  # fmt: skip
+        return np.array(
+            [[cx - 2 * s, cy - 2 * s, cx + 2 * s, cy + 2 * s, 0.99, *landmarks]],
+            dtype=np.float32,
+        )
+
+
+def test_face_analysis_cache():
+    analysis = FaceAnalysis(cache_size_mb=1)
+    detector = FakeDetector()
+    analysis._detectors["cpu"] = detector
+    analysis._locks["cpu"] = threading.Lock()
+
+    image = np.zeros((800, 1200, 3), dtype=np.uint8)
+    bboxes = analysis.detect(image, "cpu", resize=400)
+    # detection runs on the downscaled image, boxes are in image coordinates
+    assert detector.shapes == [(400, 600)]
+    np.testing.assert_allclose(bboxes[0, :4], [400, 200, 800, 600], atol=1e-3)
+    assert bboxes[0, 4] == pytest.approx(0.99)
+    np.testing.assert_allclose(bboxes[0, 5:7], [500, 300], atol=1e-3)
+
+    bboxes[:] = 0
+    np.testing.assert_allclose(analysis.detect(image, "cpu", resize=400)[0, 0], 400)
+    assert len(detector.shapes) == 1
+    image[0, 0] = 1
+    analysis.detect(image, "cpu", resize=400)
+    assert len(detector.shapes) == 2
+
+
+def test_face_analysis_cache_counts_empty_entries():
+    analysis = FaceAnalysis(cache_size_mb=1)
+    for i in range(20000):
+        # images without faces
+        analysis.detections.put((f"{i:032x}", 0.97, 1024), np.zeros((0, 15)))
+        analysis.affine_matrices.put((str(i).encode(), b""), np.zeros((2, 3)))
+    assert 0 < len(analysis.detections) <= 1024
+    assert 0 < len(analysis.affine_matrices) <= 1024
+
+
+def test_helpers_share_face_analysis():
+    analysis = FaceAnalysis(cache_size_mb=1)
+    detector = FakeDetector()
+    analysis._detectors["cpu"] = detector
+    analysis._locks["cpu"] = threading.Lock()
+
+    image = np.random.RandomState(0).randint(0, 255, (300, 400, 3), dtype=np.uint8)
+    affine_matrices = []
+    for _ in range(2):
+        helper = _helper(face_size=512)
+        helper.face_analysis = analysis
+        helper.template_3points = False
+        helper.pad_blur = False
+        helper.crop_ratio = (1, 1)
+        helper.face_template = np.array(
+            [[192.98138, 239.94708], [318.90277, 240.1936], [256.63416, 314.01935],
+             [201.26117, 371.41043], [313.08905, 371.15118]]
+        )  # fmt: skip
+        helper.clean_all()
+        helper.read_image(image)
+        assert helper.get_face_landmarks_5(resize=None, eye_dist_threshold=5) == 1
+        helper.align_warp_face()
+        affine_matrices.append(helper.affine_matrices[0])
+        assert helper.cropped_faces[0].shape == (512, 512, 3)
+    assert len(detector.shapes) == 1
+    np.testing.assert_array_equal(*affine_matrices)
@@ -0,0 +1,58 @@
+import numpy as np
+
+from iopaint.image_store import ImageStore, StoredImage
+
+
+def _image(value, size=10):
+    return StoredImage(
+        np.full((size, size, 3), value, dtype=np.uint8), None, {"dpi": (72, 72)}, "png"
+    )
+
+
+def test_image_store_returns_copies():
+    store = ImageStore(1024)
+    image_id = store.put(_image(1))
+    image = store.get(image_id)
+    image.image[:] = 0
+    assert (store.get(image_id).image == 1).all()
+    assert store.get(image_id).infos == {"dpi": (72, 72)}
+    assert store.get("nope") is None
+
+
+def test_image_store_eviction(tmp_path):
+    # room for two 300 bytes images
+    store = ImageStore(700)
+    ids = [store.put(_image(i)) for i in range(3)]
+    assert ids[0] not in store
+    assert store.get(ids[0]) is None
+    assert store.get(ids[2]).image[0, 0, 0] == 2
+
+    store = ImageStore(700, spill_dir=tmp_path)
+    ids = [store.put(_image(i)) for i in range(3)]
+    assert ids[0] in store
+    assert len(list(tmp_path.glob("*.pkl"))) == 1
+    # loaded back into memory, the least recently used one is spilled instead
+    assert store.get(ids[0]).image[0, 0, 0] == 0
+    assert [it.stem for it in tmp_path.glob("*.pkl")] == [ids[1]]
+    assert store.delete(ids[1])
+    assert not list(tmp_path.glob("*.pkl"))
+    assert not store.delete(ids[1])
+    # client sent ids are never used as paths
+    assert "../x" not in store
+
+
+def test_image_store_spill_budget(tmp_path):
+    (tmp_path / "stale.pkl").write_bytes(b"from a previous run")
+    store = ImageStore(700, spill_dir=tmp_path)
+    assert not (tmp_path / "stale.pkl").exists()
+    ids = [store.put(_image(i)) for i in range(3)]
+    file_size = (tmp_path / f"{ids[0]}.pkl").stat().st_size
+
+    # room for two spilled images on disk
+    store = ImageStore(700, spill_dir=tmp_path, spill_max_size=file_size * 2 + 10)
+    assert not list(tmp_path.glob("*.pkl"))
+    ids = [store.put(_image(i)) for i in range(5)]
+    assert [it in store for it in ids] == [False, True, True, True, True]
+    assert sorted(it.stem for it in tmp_path.glob("*.pkl")) == sorted(ids[1:3])
+    assert store.get(ids[0]) is None
+    assert store.get(ids[1]).image[0, 0, 0] == 1
@@ -0,0 +1,83 @@
+import numpy as np
+
+from iopaint.image_store import ImageStore, StoredImage
+from iopaint.model.mi_gan import MIGAN
+from iopaint.model.opencv2 import OpenCV2
+from iopaint.schema import InpaintRequest
+from iopaint.tests.test_crop_batch import FakeModel
+
+
+def test_incremental_only_runs_new_strokes(monkeypatch):
+    model = OpenCV2("cpu")
+    shapes = []
+    forward = model.forward
+
+    def record_forward(image, mask, config):
+        shapes.append(image.shape[:2])
+        return forward(image, mask, config)
+
+    monkeypatch.setattr(model, "forward", record_forward)
+
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 255, (2000, 1500, 3), dtype=np.uint8)
+    prev_mask = np.zeros((2000, 1500), dtype=np.uint8)
+    prev_mask[100:400, 100:400] = 255
+    config = InpaintRequest(hd_strategy_crop_margin=32)
+    prev_result = model(image.copy(), prev_mask, config)[:, :, ::-1].copy()
+
+    # a new stroke, partly over the area inpainted before
+    mask = prev_mask.copy()
+    mask[1500:1550, 300:600] = 255
+    mask[350:450, 350:450] = 255
+    shapes.clear()
+    result = model(prev_result.copy(), mask, config, prev_mask=prev_mask)
+
+    assert len(shapes) == 2
+    assert all(h * w < 300 * 400 for h, w in shapes)
+    new_region = (mask > 127) & (prev_mask <= 127)
+    bgr_prev_result = prev_result[:, :, ::-1]
+    np.testing.assert_array_equal(result[~new_region], bgr_prev_result[~new_region])
+    assert (result[new_region] != bgr_prev_result[new_region]).any()
+
+
+def test_stored_result_keeps_mask():
+    store = ImageStore(1024 * 1024)
+    mask = np.zeros((8, 8), dtype=np.uint8)
+    mask[2:4, 2:4] = 255
+    image_id = store.put(
+        StoredImage(np.zeros((8, 8, 3), dtype=np.uint8), None, {}, "png", mask)
+    )
+    np.testing.assert_array_equal(store.get_mask(image_id), mask)
+    store.get_mask(image_id)[:] = 0
+    assert store.get_mask(image_id).max() == 255
+
+
+class FakeMIGAN(MIGAN):
+    def init_model(self, device, **kwargs):
+        self.shapes = []
+
+    def forward_batch(self, images, masks, config):
+        self.shapes.extend(it.shape[:2] for it in images)
+        return FakeModel.forward_batch(self, images, masks, config)
+
+
+def test_incremental_fixed_input_size():
+    model = FakeMIGAN("cpu")
+    model.batch_sizes = []
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 255, (1500, 1500, 3), dtype=np.uint8)
+    prev_mask = np.zeros((1500, 1500), dtype=np.uint8)
+    prev_mask[100:200, 100:200] = 255
+    config = InpaintRequest()
+    prev_result = model(image.copy(), prev_mask, config)[:, :, ::-1].copy()
+
+    # a stroke whose crop is larger than 512
+    mask = prev_mask.copy()
+    mask[600:1000, 500:900] = 255
+    model.shapes.clear()
+    result = model(prev_result.copy(), mask, config, prev_mask=prev_mask)
+    assert model.shapes == [(512, 512)]
+    new_region = (mask > 127) & (prev_mask <= 127)
+    bgr_prev_result = prev_result[:, :, ::-1]
+    np.testing.assert_array_equal(result[~new_region], bgr_prev_result[~new_region])
+    assert (result[new_region] != bgr_prev_result[new_region]).any()
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+import torch
+
+from iopaint.lru_cache import LRUCache
+from iopaint.plugins.base_plugin import ImageNotCachedError
+from iopaint.plugins.interactive_seg import InteractiveSeg
+from iopaint.schema import RunPluginRequest, SegmentPrompt
+
+
+class FakePredictor:
+    def __init__(self):
+        self.encoded = 0
+        self.features = None
+
+    def set_image(self, image):
+        self.encoded += 1
+        self.features = torch.full((1, 4, 8, 8), float(image.mean()))
+
+    def predict(self, point_coords=None, point_labels=None, box=None, **kwargs):
+        mask = np.zeros((1, 4, 4), dtype=bool)
+        mask[0, 0, 0] = bool(self.features.mean() > 100)
+        if box is not None:
+            x1, y1, x2, y2 = box.astype(int)
+            mask[0, y1:y2, x1:x2] = True
+        return mask, None, None
+
+
+@pytest.fixture
+def plugin(monkeypatch):
+    def init_session(self, model_name):
+        self.predictor = FakePredictor()
+        self.embeddings.clear()
+        self.prev_image_id = None
+
+    monkeypatch.setattr(InteractiveSeg, "_init_session", init_session)
+    return InteractiveSeg("vit_b", "cpu", cache_size_mb=1)
+
+
+def test_lru_cache_size_bound():
+    cache = LRUCache(100)
+    cache.put("a", np.zeros(40, dtype=np.uint8))
+    cache.put("b", np.zeros(40, dtype=np.uint8))
+    cache.get("a")
+    cache.put("c", np.zeros(40, dtype=np.uint8))
+    assert cache.keys() == ["a", "c"]
+    assert cache.size == 80
+    assert not cache.put("d", np.zeros(101, dtype=np.uint8))
+    assert "d" not in cache
+
+
+def test_embedding_cache_between_images(plugin):
+    white = np.full((4, 4, 3), 255, dtype=np.uint8)
+    black = np.zeros((4, 4, 3), dtype=np.uint8)
+    clicks = [[0, 0, 1]]
+
+    req = RunPluginRequest(name=plugin.name, image="white", clicks=clicks)
+    assert plugin.gen_mask(white, req)[0, 0] == 255
+    white_id = req.image_id
+    req = RunPluginRequest(name=plugin.name, image="black", clicks=clicks)
+    assert plugin.gen_mask(black, req)[0, 0] == 0
+    black_id = req.image_id
+    assert plugin.predictor.encoded == 2
+
+    # clicks alternating between users only send the image id
+    for _ in range(3):
+        for image_id, value in [(white_id, 255), (black_id, 0)]:
+            req = RunPluginRequest(name=plugin.name, image_id=image_id, clicks=clicks)
+            assert plugin.gen_mask(None, req)[0, 0] == value
+    assert plugin.predictor.encoded == 2
+
+    assert plugin.is_image_cached(white_id)
+    assert not plugin.is_image_cached("nope")
+    with pytest.raises(ImageNotCachedError):
+        plugin.gen_mask(None, RunPluginRequest(name=plugin.name, image_id="nope"))
+
+
+def test_gen_mask_batch(plugin):
+    white = np.full((4, 4, 3), 255, dtype=np.uint8)
+    black = np.zeros((4, 4, 3), dtype=np.uint8)
+    prompts = [
+        [SegmentPrompt(clicks=[[0, 0, 1]]), SegmentPrompt(box=[2, 2, 4, 4])],
+        [SegmentPrompt(clicks=[[0, 0, 1], [1, 1, 0]], box=[0, 0, 1, 4])],
+    ]
+    masks = plugin.gen_mask_batch([white, black], prompts)
+    assert [len(it) for it in masks] == [2, 1]
+    assert masks[0][0][0, 0] == 255 and masks[0][0].sum() == 255
+    assert (masks[0][1][2:, 2:] == 255).all() and masks[0][1][0, 0] == 255
+    assert (masks[1][0][:, 0] == 255).all() and masks[1][0].sum() == 255 * 4
+    assert plugin.prev_image_id is None
+
+    point_coords, point_labels, box = InteractiveSeg._prompt_arrays(prompts[1] * 3)
+    assert point_coords.shape == (3, 2, 2)
+    assert point_labels.tolist() == [[1, 0]] * 3
+    assert box.shape == (3, 4)
+
+
+def test_segment_prompt_validation():
+    with pytest.raises(ValueError):
+        SegmentPrompt()
+    with pytest.raises(ValueError):
+        SegmentPrompt(box=[1, 2, 3])
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from iopaint.job_queue import JobQueue, QueueFullError
+from iopaint.schema import JobStatus
+
+
+def _blocking_queue(**kwargs):
+    # the first submitted job holds the only worker until the event is set
+    queue = JobQueue(num_workers=1, **kwargs)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block(job):
+        started.set()
+        release.wait()
+
+    blocker = queue.submit(block)
+    started.wait()
+    return queue, blocker, release
+
+
+def test_job_queue_priority():
+    queue, blocker, release = _blocking_queue(max_size=8)
+    order = []
+    jobs = [
+        queue.submit(lambda job, i=i: order.append(i), priority=p)
+        for i, p in enumerate([1, 0, 1, 0])
+    ]
+    assert queue.position(jobs[1]) == 0
+    assert queue.position(jobs[2]) == 3
+    release.set()
+    for job in jobs:
+        assert job.wait(5)
+        assert job.status == JobStatus.succeeded
+    assert order == [1, 3, 0, 2]
+    assert blocker.run_time_ms is not None
+    queue.shutdown()
+
+
+def test_job_queue_full():
+    queue, _, release = _blocking_queue(max_size=1)
+    queue.submit(lambda job: None)
+    with pytest.raises(QueueFullError) as e:
+        queue.submit(lambda job: None)
+    assert e.value.retry_after >= 1
+    release.set()
+    queue.shutdown()
+
+
+def test_job_queue_cancel_and_error():
+    queue, _, release = _blocking_queue(max_size=4)
+    pending = queue.submit(lambda job: "never")
+
+    def fail(job):
+        raise ValueError("boom")
+
+    failed = queue.submit(fail)
+    assert queue.cancel(pending.id)
+    assert pending.status == JobStatus.cancelled
+    assert not queue.cancel(pending.id)
+
+    release.set()
+    assert failed.wait(5)
+    assert failed.status == JobStatus.failed
+    assert isinstance(failed.exception, ValueError)
+    assert queue.info(failed).error == "boom"
+    queue.shutdown()
+
+
+def test_job_queue_exclusive():
+    queue = JobQueue(num_workers=2, max_size=4)
+    with queue.exclusive():
+        job = queue.submit(lambda job: 1)
+        assert not job.wait(0.1)
+        assert job.status == JobStatus.pending
+    assert job.wait(5)
+    assert job.result == 1
+    queue.shutdown()
+
+
+def test_job_queue_finished_results_size():
+    queue = JobQueue(num_workers=1, max_finished_size=250)
+    jobs = [queue.submit(lambda job: (b"x" * 100, "png")) for _ in range(4)]
+    for job in jobs:
+        assert job.wait(5)
+    big = queue.submit(lambda job: (b"x" * 1000, "png"))
+    assert big.wait(5)
+    queue.shutdown()
+    # results of older jobs are dropped beyond the size budget, the latest is kept
+    assert queue.get(big.id) is big
+    assert all(queue.get(it.id) is None for it in jobs)
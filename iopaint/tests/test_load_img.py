@@ -1,4 +1,8 @@
-from iopaint.helper import load_img
+import base64
+
+import numpy as np
+
+from iopaint.helper import load_img, decode_image_file, decode_base64_to_image
 from iopaint.tests.utils import current_dir
 
 png_img_p = current_dir / "image.png"
@@ -17,3 +21,15 @@ def test_load_jpg_image():
         np_img, alpha_channel = load_img(f.read())
     assert np_img.shape == (394, 448, 3)
     assert alpha_channel is None
+
+
+def test_decode_image_file():
+    for p, ext in [(png_img_p, "png"), (jpg_img_p, "jpeg")]:
+        with open(p, "rb") as f:
+            np_img, alpha_channel, _, file_ext = decode_image_file(f)
+            f.seek(0)
+            b64 = base64.b64encode(f.read()).decode()
+        assert file_ext == ext
+        b64_img, b64_alpha, _, b64_ext = decode_base64_to_image(b64)
+        assert b64_ext == ext
+        np.testing.assert_array_equal(np_img, b64_img)
@@ -1,6 +1,9 @@
+import cv2
+import numpy as np
 import pytest
 import torch
 
+from iopaint.helper import match_histograms
 from iopaint.model_manager import ModelManager
 from iopaint.schema import SDSampler, HDStrategy
 from iopaint.tests.utils import check_device, get_config, assert_equal, current_dir
@@ -34,3 +37,38 @@ def test_sd_match_histograms(device, sampler):
         img_p=current_dir / "overture-creations-5sI6fQgYIuo.png",
         mask_p=current_dir / "overture-creations-5sI6fQgYIuo_mask.png",
     )
+
+
+def _loop_match_histograms(source, reference, mask):
+    channels = []
+    for c in range(source.shape[-1]):
+        src_hist, _ = np.histogram(source[:, :, c][mask == 0], 256, [0, 256])
+        ref_hist, _ = np.histogram(reference[:, :, c][mask == 0], 256, [0, 256])
+        src_cdf = src_hist.cumsum() / float(src_hist.sum())
+        ref_cdf = ref_hist.cumsum() / float(ref_hist.sum())
+        lookup = np.zeros(256)
+        for i, val in enumerate(src_cdf):
+            lookup[i] = np.argmax(ref_cdf >= val)
+        channels.append(cv2.LUT(source[:, :, c], lookup))
+    return cv2.convertScaleAbs(cv2.merge(channels))
+
+
+def test_match_histograms_lookup():
+    rng = np.random.RandomState(0)
+    source = rng.randint(0, 200, (120, 90, 3), dtype=np.uint8)
+    reference = (rng.beta(2, 5, (120, 90, 3)) * 255).astype(np.uint8)
+    mask = np.zeros((120, 90), dtype=np.uint8)
+    mask[30:60, 20:70] = 255
+
+    result = match_histograms(source, reference, mask)
+    assert result.dtype == np.uint8 and result.shape == source.shape
+    np.testing.assert_array_equal(
+        result, _loop_match_histograms(source, reference, mask)
+    )
+    np.testing.assert_array_equal(
+        match_histograms(source, reference, mask[:, :, None]), result
+    )
+    # nothing to match against
+    np.testing.assert_array_equal(
+        match_histograms(source, reference, np.full_like(mask, 255)), source
+    )
@@ -0,0 +1,163 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch import nn
+from torchvision.transforms.functional import normalize
+
+from iopaint.plugins import anime_seg
+from iopaint.plugins.anime_seg import AnimeSeg
+from iopaint.plugins.briarmbg import briarmbg_process, create_briarmbg_engine
+from iopaint.plugins.matting import MattingEngine
+from iopaint.schema import RunPluginRequest
+
+
+class FakeNet(nn.Module):
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.conv = nn.Conv2d(3, 1, 9, padding=4)
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(len(x))
+        return torch.sigmoid(self.conv(x) * 4)
+
+
+class FakeBriaRMBG(FakeNet):
+    def forward(self, x):
+        return [super().forward(x)], []
+
+
+def _images():
+    rng = np.random.RandomState(0)
+    images = []
+    for h, w in [(300, 200), (150, 400), (256, 256)]:
+        image = cv2.resize(rng.randint(0, 255, (h // 10, w // 10, 3), np.uint8), (w, h))
+        images.append(image)
+    return images
+
+
+def _pil_briarmbg_process(device, bgr_np_image, session, only_mask=False):
+    orig_bgr_image = Image.fromarray(bgr_np_image)
+    w, h = orig_bgr_image.size
+    image = orig_bgr_image.convert("RGB").resize((1024, 1024), Image.BILINEAR)
+    im_tensor = torch.tensor(np.array(image), dtype=torch.float32).permute(2, 0, 1)
+    im_tensor = torch.divide(torch.unsqueeze(im_tensor, 0), 255.0)
+    im_tensor = normalize(im_tensor, [0.5, 0.5, 0.5], [1.0, 1.0, 1.0])
+    result = session(im_tensor.to(device))
+    result = torch.squeeze(F.interpolate(result[0][0], size=(h, w), mode="bilinear"), 0)
+    result = (result - torch.min(result)) / (torch.max(result) - torch.min(result))
+    mask = np.squeeze((result * 255).cpu().data.numpy().astype(np.uint8))
+    if only_mask:
+        return mask
+    new_im = Image.new("RGBA", orig_bgr_image.size, (0, 0, 0, 0))
+    new_im.paste(orig_bgr_image, mask=Image.fromarray(mask))
+    return np.asarray(new_im)
+
+
+def _cv2_anime_seg(model, rgb_np_img):
+    s = 1024
+    h0, w0 = h, w = rgb_np_img.shape[0], rgb_np_img.shape[1]
+    if h > w:
+        h, w = s, int(s * w / h)
+    else:
+        h, w = int(s * h / w), s
+    ph, pw = s - h, s - w
+    tmp_img = np.zeros([s, s, 3], dtype=np.float32)
+    tmp_img[ph // 2 : ph // 2 + h, pw // 2 : pw // 2 + w] = (
+        cv2.resize(rgb_np_img, (w, h)) / 255
+    )
+    tmp_img = torch.from_numpy(tmp_img.transpose((2, 0, 1))).unsqueeze(0)
+    mask = model(tmp_img)
+    mask = mask[0, :, ph // 2 : ph // 2 + h, pw // 2 : pw // 2 + w]
+    mask = cv2.resize(mask.cpu().numpy().transpose((1, 2, 0)), (w0, h0))
+    return (mask * 255).astype("uint8")
+
+
+def _assert_close(result, expected, max_diff, mean_diff):
+    diff = np.abs(result.astype(int) - expected.astype(int))
+    assert diff.max() <= max_diff and diff.mean() < mean_diff
+
+
+@torch.inference_mode()
+def test_briarmbg_same_as_pil():
+    session = FakeBriaRMBG()
+    for image in _images():
+        expected = _pil_briarmbg_process("cpu", image, session, only_mask=True)
+        mask = briarmbg_process("cpu", image, session, only_mask=True)
+        assert mask.shape == expected.shape and mask.dtype == np.uint8
+        _assert_close(mask, expected, 3, 0.5)
+
+        expected = _pil_briarmbg_process("cpu", image, session)
+        cutout = briarmbg_process("cpu", image, session)
+        assert cutout.shape == (*image.shape[:2], 4)
+        _assert_close(cutout, expected, 3, 0.5)
+
+
+@torch.inference_mode()
+def test_anime_seg_same_as_cv2():
+    plugin = AnimeSeg.__new__(AnimeSeg)
+    plugin.model = FakeNet()
+    plugin.engine = MattingEngine(plugin.model, "cpu", letterbox=True, mean=0.0)
+    req = RunPluginRequest(name=AnimeSeg.name)
+    for image in _images():
+        expected = _cv2_anime_seg(plugin.model, image)[:, :, None]
+        mask = plugin.gen_mask(image, req)
+        _assert_close(mask, expected[:, :, 0], 2, 0.5)
+        cutout = plugin.gen_image(image, req)
+        # same as PIL composite with the mask
+        expected_rgb = np.round(image * (expected / 255.0))
+        _assert_close(cutout[:, :, :3], expected_rgb, 2, 0.5)
+        _assert_close(cutout[:, :, 3], expected[:, :, 0], 2, 0.5)
+
+
+def test_batched_cutouts():
+    session = FakeBriaRMBG()
+    engine = create_briarmbg_engine(session, "cpu", swap_rb=True, batch_size=2)
+    images = _images() + _images()[:2]
+    cutouts = engine.cutouts(images)
+    assert session.batch_sizes == [2, 2, 1]
+    for image, cutout in zip(images, cutouts):
+        np.testing.assert_array_equal(cutout[:, :, 3], engine.masks([image])[0])
+        # the session is fed BGR images
+        expected = briarmbg_process("cpu", image[:, :, ::-1], session)
+        _assert_close(cutout[:, :, [2, 1, 0, 3]], expected, 1, 0.01)
+
+
+def test_anime_seg_device(monkeypatch):
+    monkeypatch.setattr(
+        anime_seg, "load_model", lambda model, url, device, md5: FakeNet().to(device)
+    )
+    plugin = AnimeSeg("cpu")
+    assert plugin.dtype == torch.float32 and not plugin.engine.channels_last
+    mask = plugin.gen_mask(_images()[0], RunPluginRequest(name=AnimeSeg.name))
+    assert mask.shape == (300, 200)
+
+
+def test_input_buffer_reused():
+    model = FakeNet()
+    engine = MattingEngine(model, "cpu", letterbox=True, mean=0.0, batch_size=2)
+    images = _images()
+    masks = engine.masks(images)
+    buffer = engine._buffer
+    assert buffer.shape == (2, 3, 1024, 1024)
+    # the padding of a wide image is cleared after a tall one
+    for mask, expected in zip(engine.masks(images[::-1]), masks[::-1]):
+        np.testing.assert_array_equal(mask, expected)
+    assert engine._buffer is buffer
+
+    half_model = FakeNet().to(torch.bfloat16, memory_format=torch.channels_last)
+    half_engine = MattingEngine(
+        half_model,
+        "cpu",
+        letterbox=True,
+        mean=0.0,
+        dtype=torch.bfloat16,
+        channels_last=True,
+    )
+    for mask, half_mask in zip(masks, half_engine.masks(images)):
+        _assert_close(half_mask, mask, 8, 1)
+    assert half_engine._buffer.dtype == torch.bfloat16
+    assert half_engine._buffer.is_contiguous(memory_format=torch.channels_last)
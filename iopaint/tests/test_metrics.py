@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from iopaint.metrics import (
+    Histogram,
+    metric_labels,
+    size_bucket,
+    span,
+    stage_seconds,
+)
+from iopaint.model.opencv2 import OpenCV2
+from iopaint.schema import HDStrategy, InpaintRequest
+
+
+def test_histogram_render():
+    histogram = Histogram("test_seconds", "Test", ["stage"], buckets=[0.1, 1])
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5, stage='b"')
+    text = histogram.render()
+    assert "# TYPE test_seconds histogram" in text
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 2' in text
+    assert 'test_seconds_count{stage="a"} 2' in text
+    assert 'test_seconds_bucket{stage="b\\"",le="1.0"} 0' in text
+    assert 'test_seconds_sum{stage="b\\""} 5.0' in text
+
+
+def test_span_labels():
+    histogram = Histogram("test_span_seconds", "Test", ["stage", "model", "size"])
+    with metric_labels(model="lama"):
+        with span("decode", histogram) as labels:
+            labels["size"] = size_bucket(600, 400)
+        with pytest.raises(ValueError):
+            with span("forward", histogram):
+                raise ValueError()
+    assert histogram.count(stage="decode", model="lama", size="<=1024") == 1
+    assert histogram.count(stage="forward", model="lama") == 0
+
+
+def test_model_call_spans():
+    stage_seconds.clear()
+    model = OpenCV2("cpu")
+    image = np.random.randint(0, 255, (1200, 800, 3), dtype=np.uint8)
+    mask = np.zeros((1200, 800), dtype=np.uint8)
+    mask[100:200, 100:200] = 255
+    config = InpaintRequest(hd_strategy=HDStrategy.CROP)
+    model(image, mask, config)
+
+    labels = dict(model="cv2", strategy="Crop", size="<=2048")
+    for stage in ["pre_process", "pad", "forward", "post_process"]:
+        assert stage_seconds.count(stage=stage, **labels) >= 1, stage
@@ -0,0 +1,69 @@
+import threading
+
+import numpy as np
+import pytest
+
+from iopaint.model.micro_batch import MicroBatcher
+from iopaint.schema import HDStrategy
+from iopaint.tests.utils import get_config
+
+
+def _run_concurrently(batcher, inputs, configs=None):
+    results = [None] * len(inputs)
+    configs = configs or [get_config()] * len(inputs)
+
+    def run(i, image):
+        results[i] = batcher(image, image[:, :, :1], configs[i])
+
+    threads = [
+        threading.Thread(target=run, args=(i, image)) for i, image in enumerate(inputs)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_micro_batch_by_shape():
+    batch_sizes = []
+
+    def forward_batch(images, masks, config):
+        batch_sizes.append(len(images))
+        return [image + 1 for image in images]
+
+    batcher = MicroBatcher(forward_batch, max_batch_size=4, max_wait_ms=200)
+    inputs = [np.full((8, 8, 3), i, dtype=np.uint8) for i in range(4)]
+    inputs += [np.full((16, 8, 3), i, dtype=np.uint8) for i in range(2)]
+    results = _run_concurrently(batcher, inputs)
+
+    for image, result in zip(inputs, results):
+        assert np.array_equal(result, image + 1)
+    assert sorted(batch_sizes) == [2, 4]
+
+
+def test_micro_batch_by_config():
+    batches = []
+
+    def forward_batch(images, masks, config):
+        batches.append((len(images), config.hd_strategy))
+        return images
+
+    batcher = MicroBatcher(forward_batch, max_batch_size=4, max_wait_ms=200)
+    inputs = [np.full((8, 8, 3), i, dtype=np.uint8) for i in range(4)]
+    configs = [get_config(strategy=HDStrategy.ORIGINAL)] * 2
+    configs += [
+        get_config(strategy=HDStrategy.CROP, image_id=f"image{i}")
+        for i in range(2)
+    ]
+    _run_concurrently(batcher, inputs, configs)
+    assert sorted(batches) == [(2, HDStrategy.CROP), (2, HDStrategy.ORIGINAL)]
+
+
+def test_micro_batch_error():
+    def forward_batch(images, masks, config):
+        raise RuntimeError("out of memory")
+
+    batcher = MicroBatcher(forward_batch, max_batch_size=2, max_wait_ms=1)
+    with pytest.raises(RuntimeError, match="out of memory"):
+        batcher(np.zeros((8, 8, 3)), np.zeros((8, 8, 1)), get_config())
@@ -0,0 +1,67 @@
+import torch
+
+from iopaint.model.base import InpaintModel
+from iopaint.model_cache import ModelCache
+
+
+class FakeModel(InpaintModel):
+    name = "fake"
+
+    def init_model(self, device, **kwargs):
+        self.model = torch.nn.Linear(16, 16)
+        self.moves = []
+
+    @staticmethod
+    def is_downloaded() -> bool:
+        return True
+
+    def forward(self, image, mask, config):
+        return image
+
+    def to(self, device):
+        # pretend to move, so accelerator devices can be tested on cpu
+        self.moves.append(str(device))
+        self.device = torch.device(device)
+        return self
+
+
+def test_memory_size():
+    model = FakeModel("cpu")
+    model.z = torch.zeros(10)
+    assert model.memory_size() == (16 * 16 + 16 + 10) * 4
+
+
+def test_model_cache_offload_and_evict():
+    size = FakeModel("cpu").memory_size()
+    cache = ModelCache(vram_budget=size * 2, ram_budget=size)
+    models = {name: FakeModel(torch.device("cuda")) for name in "abc"}
+
+    active = models["c"]
+    cache.put("a", models["a"], {}, active_models=[active])
+    assert models["a"].moves == []
+    cache.put("b", models["b"], {}, active_models=[active])
+    # a is least recently used, moved to cpu to fit vram budget
+    assert models["a"].moves == ["cpu"]
+    assert models["b"].moves == []
+
+    entry = cache.pop("a")
+    assert entry.model is models["a"]
+    assert models["a"].moves == ["cpu", "cuda"]
+
+    cache.put("c", models["c"], {}, active_models=[models["a"]])
+    assert models["b"].moves == ["cpu"]
+    cache.put("a", models["a"], {})
+    assert cache.names == ["b", "c", "a"]
+
+    # b is offloaded to cpu already, then evicted when c needs the ram
+    cache.trim([FakeModel(torch.device("cuda"))])
+    assert "b" not in cache
+    assert cache.names == ["c", "a"]
+
+
+def test_model_cache_disabled():
+    cache = ModelCache()
+    model = FakeModel("cpu")
+    cache.put("a", model, {}, active_models=[FakeModel("cpu")])
+    assert len(cache) == 0
+    assert cache.pop("a") is None
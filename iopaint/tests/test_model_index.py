@@ -0,0 +1,97 @@
+import json
+
+import huggingface_hub.constants
+import torch
+from safetensors.torch import save_file
+
+from iopaint import download
+from iopaint.download import get_unet_in_channels, scan_models
+from iopaint.schema import ModelType
+
+
+def _checkpoint(
+    path, in_channels, key="model.diffusion_model.input_blocks.0.0.weight"
+):
+    save_file({key: torch.zeros(320, in_channels, 1, 1)}, str(path))
+
+
+def test_unet_in_channels_from_header(tmp_path):
+    _checkpoint(tmp_path / "a.safetensors", 9)
+    _checkpoint(tmp_path / "b.safetensors", 4, key="conv_in.weight")
+    save_file({"lora_up.weight": torch.zeros(4, 4)}, str(tmp_path / "c.safetensors"))
+    (tmp_path / "d.safetensors").write_bytes(b"broken")
+    assert get_unet_in_channels(str(tmp_path / "a.safetensors")) == 9
+    assert get_unet_in_channels(str(tmp_path / "b.safetensors")) == 4
+    assert get_unet_in_channels(str(tmp_path / "c.safetensors")) is None
+    assert get_unet_in_channels(str(tmp_path / "d.safetensors")) is None
+    assert get_unet_in_channels(str(tmp_path / "e.ckpt")) is None
+
+
+def test_scan_models_index(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(
+        huggingface_hub.constants, "HF_HUB_CACHE", str(tmp_path / "hf")
+    )
+    download.model_scan_cache.clear()
+    sd_dir = tmp_path / "stable_diffusion"
+    sd_dir.mkdir()
+    _checkpoint(sd_dir / "base.safetensors", 4)
+    _checkpoint(sd_dir / "painter.safetensors", 9)
+    _checkpoint(sd_dir / "pix2pix.safetensors", 8)
+
+    inspected = []
+    get_sd_model_type = download.get_sd_model_type
+
+    def record(model_abs_path):
+        inspected.append(model_abs_path)
+        return get_sd_model_type(model_abs_path)
+
+    monkeypatch.setattr(download, "get_sd_model_type", record)
+    scans = []
+    scan_diffusers_models = download.scan_diffusers_models
+    monkeypatch.setattr(
+        download,
+        "scan_diffusers_models",
+        lambda: scans.append(1) or scan_diffusers_models(),
+    )
+
+    def diffusion_models():
+        return {
+            it.name: it.model_type
+            for it in scan_models()
+            if it.model_type != ModelType.INPAINT
+        }
+
+    assert diffusion_models() == {
+        "base.safetensors": ModelType.DIFFUSERS_SD,
+        "painter.safetensors": ModelType.DIFFUSERS_SD_INPAINT,
+    }
+    assert len(inspected) == 3
+    index = json.loads((sd_dir / "iopaint_cache.json").read_text())
+    assert index["pix2pix.safetensors"]["model_type"] is None
+    assert index["base.safetensors"]["size"] > 0
+
+    # unchanged directories are served from memory
+    monkeypatch.setattr(download, "scan_diffusers_models", lambda: 1 / 0)
+    assert len(diffusion_models()) == 2
+    monkeypatch.undo()
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(
+        huggingface_hub.constants, "HF_HUB_CACHE", str(tmp_path / "hf")
+    )
+    monkeypatch.setattr(download, "get_sd_model_type", record)
+    scans = []
+    scan_diffusers_models = download.scan_diffusers_models
+    monkeypatch.setattr(
+        download,
+        "scan_diffusers_models",
+        lambda: scans.append(1) or scan_diffusers_models(),
+    )
+
+    # only the new file is inspected, the others come from the index
+    inspected.clear()
+    _checkpoint(sd_dir / "other.safetensors", 9)
+    download.model_scan_cache.clear()
+    assert len(diffusion_models()) == 3
+    assert inspected == [str((sd_dir / "other.safetensors").absolute())]
+    download.model_scan_cache.clear()
@@ -0,0 +1,159 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from iopaint.model.micro_batch import MicroBatcher
+from iopaint.model_manager import ModelManager
+from iopaint.schema import InpaintRequest, ModelInfo, ModelType
+from iopaint.tests.test_model_cache import FakeModel
+
+
+@pytest.fixture
+def model_manager(monkeypatch):
+    loads = []
+
+    def init_model(self, name, device, state=None, **kwargs):
+        loads.append(name)
+        model = FakeModel(device)
+        model.name = name
+        return model
+
+    def scan_models(self):
+        self.available_models = {
+            name: ModelInfo(name=name, path=name, model_type=ModelType.INPAINT)
+            for name in ["lama", "mat", "migan"]
+        }
+
+    monkeypatch.setattr(ModelManager, "init_model", init_model)
+    monkeypatch.setattr(ModelManager, "scan_models", scan_models)
+    mm = ModelManager("lama", torch.device("cpu"), model_cache_ram_gb=1)
+    mm.loads = loads
+    return mm
+
+
+def test_routed_request_does_not_switch(model_manager, monkeypatch):
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    mask = np.zeros((8, 8), dtype=np.uint8)
+    used = []
+
+    def forward(self, image, mask, config):
+        used.append(self.name)
+        return image
+
+    monkeypatch.setattr(FakeModel, "__call__", forward)
+    model_manager(image, mask, InpaintRequest(model="mat"))
+    model_manager(image, mask, InpaintRequest())
+    model_manager(image, mask, InpaintRequest(model="mat"))
+    model_manager(image, mask, InpaintRequest(model="lama"))
+
+    assert used == ["mat", "lama", "mat", "lama"]
+    assert model_manager.name == "lama"
+    # mat is loaded once and kept warm in the cache between requests
+    assert model_manager.loads == ["lama", "mat"]
+    assert model_manager.model_cache.names == ["mat"]
+
+    model_manager.switch("mat")
+    assert model_manager.loads == ["lama", "mat"]
+    assert model_manager.model_cache.names == ["lama"]
+
+
+def test_acquire_shares_model_between_requests(model_manager):
+    first = model_manager.acquire("migan")
+    second = model_manager.acquire("migan")
+    assert first is second
+    assert model_manager.loads == ["lama", "migan"]
+
+    model_manager.release("migan", first)
+    assert "migan" not in model_manager.model_cache
+    model_manager.release("migan", second)
+    assert "migan" in model_manager.model_cache
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(model_manager.acquire("mat")))
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len({id(it) for it in results}) == 1
+    assert model_manager.loads == ["lama", "migan", "mat"]
+
+
+def test_switch_offloads_old_model_before_loading(monkeypatch):
+    size = FakeModel("cpu").memory_size()
+    cached_on_cpu = []
+
+    def init_model(self, name, device, state=None, **kwargs):
+        cached_on_cpu.extend(it.on_cpu for it in self.model_cache._models.values())
+        model = FakeModel(torch.device("cuda"))
+        model.name = name
+        return model
+
+    def scan_models(self):
+        self.available_models = {
+            name: ModelInfo(name=name, path=name, model_type=ModelType.INPAINT)
+            for name in ["lama", "mat"]
+        }
+
+    monkeypatch.setattr(ModelManager, "init_model", init_model)
+    monkeypatch.setattr(ModelManager, "scan_models", scan_models)
+    # FakeModel only pretends to move, no cuda device is needed
+    mm = ModelManager("lama", torch.device("cuda"), model_cache_ram_gb=1)
+    mm.model_cache.vram_budget = size
+    mm.switch("mat")
+    # lama fits the vram budget alone, it is moved to cpu before mat loads
+    assert cached_on_cpu == [True]
+    assert mm.model_cache.names == ["lama"]
+
+
+def _track_concurrency(monkeypatch):
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def forward(self, image, mask, config):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return image
+
+    monkeypatch.setattr(FakeModel, "__call__", forward)
+    return peak
+
+
+def _call_concurrently(model_manager, config, num=4):
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    mask = np.zeros((8, 8), dtype=np.uint8)
+    threads = [
+        threading.Thread(target=model_manager, args=(image, mask, config))
+        for _ in range(num)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_current_model_calls_are_serialized(model_manager, monkeypatch):
+    peak = _track_concurrency(monkeypatch)
+    _call_concurrently(model_manager, InpaintRequest())
+    assert peak[0] == 1
+
+    # micro batched erase models serve several workers at once
+    model_manager.model.micro_batcher = MicroBatcher(model_manager.model.forward_batch)
+    _call_concurrently(model_manager, InpaintRequest())
+    assert peak[0] > 1
+
+
+def test_routed_model_calls_are_serialized(model_manager, monkeypatch):
+    peak = _track_concurrency(monkeypatch)
+    _call_concurrently(model_manager, InpaintRequest(model="mat"))
+    assert peak[0] == 1
+    assert model_manager.loads == ["lama", "mat"]
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+
+from iopaint.progress import ProgressBus, progress_job
+
+
+class FakeSio:
+    def __init__(self):
+        self.events = []
+
+    async def emit(self, event, data=None):
+        await asyncio.sleep(0.001)
+        self.events.append((event, data))
+
+
+def _running_loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return loop
+
+
+def _wait_for(sio, event, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if any(it[0] == event for it in sio.events):
+            return
+        time.sleep(0.01)
+
+
+def test_progress_bus_coalesce_and_finish():
+    loop = _running_loop()
+    sio = FakeSio()
+    bus = ProgressBus(sio, min_interval=1.0)
+    bus.attach(loop)
+
+    with progress_job("a"):
+        for step in range(50):
+            bus.publish("diffusion_progress", {"step": step})
+        bus.publish("diffusion_finish", final=True)
+    _wait_for(sio, "diffusion_finish")
+
+    progress = [data for event, data in sio.events if event == "diffusion_progress"]
+    assert 1 <= len(progress) <= 2
+    assert progress[-1] == {"step": 49, "job_id": "a"}
+    assert sio.events[-1] == ("diffusion_finish", {"job_id": "a"})
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_progress_bus_rate_limit_per_job():
+    loop = _running_loop()
+    sio = FakeSio()
+    bus = ProgressBus(sio, min_interval=0.1)
+    bus.attach(loop)
+
+    def run(job_id):
+        with progress_job(job_id):
+            for step in range(20):
+                bus.publish("diffusion_progress", {"step": step})
+                time.sleep(0.01)
+
+    threads = [threading.Thread(target=run, args=(it,)) for it in "ab"]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    time.sleep(0.3)
+
+    for job_id in "ab":
+        steps = [data["step"] for _, data in sio.events if data["job_id"] == job_id]
+        # 20 steps in ~200ms, sent at most every 100ms, the latest one last
+        assert 2 <= len(steps) < 10
+        assert steps[-1] == 19
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_progress_bus_prunes_jobs_without_final_event():
+    loop = _running_loop()
+    sio = FakeSio()
+    bus = ProgressBus(sio, min_interval=0.05)
+    bus.attach(loop)
+
+    # failed jobs never publish a final event
+    for job_id in range(20):
+        with progress_job(str(job_id)):
+            bus.publish("diffusion_progress", {"step": 0})
+        time.sleep(0.06)
+    with progress_job("last"):
+        bus.publish("diffusion_finish", final=True)
+    _wait_for(sio, "diffusion_finish")
+
+    assert len(sio.events) == 21
+    assert len(bus._last_sent) <= 1
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_progress_bus_without_loop():
+    sio = FakeSio()
+    bus = ProgressBus(sio)
+    bus.publish("diffusion_progress", {"step": 1})
+    assert sio.events == []
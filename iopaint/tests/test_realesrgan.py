@@ -0,0 +1,100 @@
+import cv2
+import numpy as np
+import torch
+
+from iopaint.plugins import realesrgan
+from iopaint.plugins.realesrgan import RealESRGANer, SRVGGNetCompact, upscale_alpha
+
+
+def _upsampler(tmp_path, tile, tile_batch_size=8):
+    torch.manual_seed(0)
+    net = SRVGGNetCompact(num_feat=8, num_conv=2, upscale=4, act_type="relu")
+    model_path = tmp_path / "net.pth"
+    torch.save({"params": net.state_dict()}, model_path)
+    return RealESRGANer(
+        scale=4,
+        model_path=str(model_path),
+        model=SRVGGNetCompact(num_feat=8, num_conv=2, upscale=4, act_type="relu"),
+        tile=tile,
+        tile_pad=10,
+        pre_pad=10,
+        device=torch.device("cpu"),
+        tile_batch_size=tile_batch_size,
+    )
+
+
+def _forward_batch_sizes(upsampler):
+    sizes = []
+    upsampler.model.register_forward_hook(lambda m, i, o: sizes.append(len(i[0])))
+    return sizes
+
+
+def test_tile_process_batches_and_blends(tmp_path, monkeypatch):
+    monkeypatch.setattr(realesrgan, "available_memory", lambda device: 64 * 1024**3)
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 255, (150, 230, 3), dtype=np.uint8)
+
+    full, _ = _upsampler(tmp_path, tile=0).enhance(img)
+
+    upsampler = _upsampler(tmp_path, tile=64)
+    sizes = _forward_batch_sizes(upsampler)
+    tiled, _ = upsampler.enhance(img)
+    assert tiled.shape == full.shape == (600, 920, 3)
+    # 4 rows of 5 tiles of the pre padded 160x240 image
+    assert sizes == [8, 8, 4]
+    # apart from rounding, tile borders only get small weights in the overlap
+    diff = np.abs(tiled.astype(int) - full.astype(int))
+    assert diff.max() <= 2 and (diff > 1).mean() < 0.001
+
+    serial = _upsampler(tmp_path, tile=64, tile_batch_size=1)
+    sizes = _forward_batch_sizes(serial)
+    np.testing.assert_allclose(serial.enhance(img)[0], tiled, atol=1)
+    assert sizes == [1] * 20
+
+    # batches are limited by memory
+    monkeypatch.setattr(realesrgan, "available_memory", lambda device: 400 * 1024**2)
+    limited = _upsampler(tmp_path, tile=64)
+    sizes = _forward_batch_sizes(limited)
+    np.testing.assert_allclose(limited.enhance(img)[0], tiled, atol=1)
+    assert sizes == [4] * 5
+
+
+def test_alpha_packed_into_color_forward(tmp_path, monkeypatch):
+    monkeypatch.setattr(realesrgan, "available_memory", lambda device: 64 * 1024**3)
+    rng = np.random.RandomState(0)
+    bgra = rng.randint(0, 255, (100, 120, 4), dtype=np.uint8)
+
+    upsampler = _upsampler(tmp_path, tile=64)
+    sizes = _forward_batch_sizes(upsampler)
+    output, mode = upsampler.enhance(bgra, alpha_upsampler="realesrgan")
+    assert mode == "RGBA" and output.shape == (400, 480, 4)
+    # 9 tiles of the color image and 9 of the alpha, a box of both in a forward
+    assert sizes == [8, 8, 2]
+
+    sizes.clear()
+    color, _ = upsampler.enhance(bgra[:, :, :3])
+    gray_alpha = np.repeat(bgra[:, :, 3:], 3, axis=-1)
+    alpha, _ = upsampler.enhance(gray_alpha)
+    assert sizes == [8, 1, 8, 1]
+    np.testing.assert_allclose(output[:, :, :3], color, atol=1)
+    gray = cv2.cvtColor(alpha, cv2.COLOR_BGR2GRAY)
+    np.testing.assert_allclose(output[:, :, 3], gray, atol=1)
+
+    sizes.clear()
+    output, _ = upsampler.enhance(bgra, alpha_upsampler="fast")
+    assert sizes == [8, 1]
+    np.testing.assert_allclose(output[:, :, :3], color, atol=1)
+
+
+def test_upscale_alpha():
+    alpha = np.zeros((40, 40), dtype=np.float32)
+    alpha[10:30, 10:30] = 1
+    alpha[20, 5:10] = 0.5
+    output = upscale_alpha(alpha, 4)
+    assert output.shape == (160, 160)
+    assert output.min() >= 0 and output.max() <= 1
+    # flat areas are exact, no ringing next to edges
+    assert (output[48:112, 48:112] == 1).all()
+    assert (output[:32] == 0).all()
+    # edges are interpolated
+    assert 0 < output[80, 38] < 1
@@ -0,0 +1,66 @@
+import numpy as np
+
+from iopaint.model import base
+from iopaint.model.tiling import feather_weight, pick_tile_size, tile_boxes, tile_starts
+from iopaint.schema import HDStrategy, InpaintRequest
+from iopaint.tests.test_crop_batch import FakeModel, SerialFakeModel
+
+
+def test_tile_grid():
+    assert tile_starts(300, 512, 64) == [0]
+    assert tile_starts(1000, 512, 64) == [0, 448, 488]
+    boxes = tile_boxes(1000, 1200, 512, 64)
+    assert len(boxes) == 9
+    assert all(r - l == 512 and b - t == 512 for l, t, r, b in boxes)
+    covered = np.zeros((1000, 1200), dtype=bool)
+    for l, t, r, b in boxes:
+        covered[t:b, l:r] = True
+    assert covered.all()
+
+
+def test_feather_weight():
+    weight = feather_weight([448, 0, 960, 512], 1000, 1200, 64)
+    # image border on top, neighbours on the other sides
+    assert weight[0, 256] == 1
+    assert weight[256, 0] < 0.05 and weight[256, -1] < 0.05
+    assert weight[-1, 256] < 0.05
+    assert weight[64:-64, 64:-64].min() == 1
+
+
+def test_pick_tile_size():
+    assert pick_tile_size(1024**3, 4096) == 512
+    assert pick_tile_size(1024**2, 4096) == 256
+    assert pick_tile_size(1024**4, 4096) == 2048
+
+
+def test_tile_strategy(monkeypatch):
+    monkeypatch.setattr(base, "available_memory", lambda device: 64 * 1024**3)
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 255, (1500, 1100, 3), dtype=np.uint8)
+    mask = np.zeros((1500, 1100), dtype=np.uint8)
+    mask[100:200, 100:900] = 255
+    mask[1300:1400, 1000:1050] = 255
+    config = InpaintRequest(
+        hd_strategy=HDStrategy.TILE,
+        hd_strategy_tile_size=512,
+        hd_strategy_tile_overlap=64,
+    )
+
+    model = FakeModel("cpu")
+    result = model(image.copy(), mask, config)
+    # 3 tiles on the top row, 2 in the bottom right corner, in one batch
+    assert model.batch_sizes == [5]
+    keep = mask < 127
+    np.testing.assert_array_equal(result[keep], image[:, :, ::-1][keep])
+    assert (result[~keep] != image[:, :, ::-1][~keep]).any()
+
+    serial_model = SerialFakeModel("cpu")
+    serial_result = serial_model(image.copy(), mask, config)
+    assert serial_model.batch_sizes == [1] * 5
+    np.testing.assert_array_equal(result, serial_result)
+
+    # batches are limited by memory
+    monkeypatch.setattr(base, "available_memory", lambda device: 4 * 1024**3)
+    model.batch_sizes.clear()
+    np.testing.assert_array_equal(model(image.copy(), mask, config), result)
+    assert model.batch_sizes == [2, 2, 1]
@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+import pytest
+
+from iopaint.model.zits import load_masked_position_encoding
+
+
+def _loop_masked_position_encoding(mask):
+    ones_filter = np.ones((3, 3), dtype=np.float32)
+    d_filter1 = np.array([[1, 1, 0], [1, 1, 0], [0, 0, 0]], dtype=np.float32)
+    d_filter2 = np.array([[0, 0, 0], [1, 1, 0], [1, 1, 0]], dtype=np.float32)
+    d_filter3 = np.array([[0, 1, 1], [0, 1, 1], [0, 0, 0]], dtype=np.float32)
+    d_filter4 = np.array([[0, 0, 0], [0, 1, 1], [0, 1, 1]], dtype=np.float32)
+    str_size = 256
+    pos_num = 128
+
+    ori_mask = mask.copy()
+    ori_h, ori_w = ori_mask.shape[0:2]
+    ori_mask = ori_mask / 255
+    mask = cv2.resize(mask, (str_size, str_size), interpolation=cv2.INTER_AREA)
+    mask[mask > 0] = 255
+    h, w = mask.shape[0:2]
+    mask3 = mask.copy()
+    mask3 = 1.0 - (mask3 / 255.0)
+    pos = np.zeros((h, w), dtype=np.int32)
+    direct = np.zeros((h, w, 4), dtype=np.int32)
+    i = 0
+    while np.sum(1 - mask3) > 0:
+        i += 1
+        mask3_ = cv2.filter2D(mask3, -1, ones_filter)
+        mask3_[mask3_ > 0] = 1
+        sub_mask = mask3_ - mask3
+        pos[sub_mask == 1] = i
+
+        m = cv2.filter2D(mask3, -1, d_filter1)
+        m[m > 0] = 1
+        m = m - mask3
+        direct[m == 1, 0] = 1
+
+        m = cv2.filter2D(mask3, -1, d_filter2)
+        m[m > 0] = 1
+        m = m - mask3
+        direct[m == 1, 1] = 1
+
+        m = cv2.filter2D(mask3, -1, d_filter3)
+        m[m > 0] = 1
+        m = m - mask3
+        direct[m == 1, 2] = 1
+
+        m = cv2.filter2D(mask3, -1, d_filter4)
+        m[m > 0] = 1
+        m = m - mask3
+        direct[m == 1, 3] = 1
+
+        mask3 = mask3_
+
+    abs_pos = pos.copy()
+    rel_pos = pos / (str_size / 2)  # to 0~1 maybe larger than 1
+    rel_pos = (rel_pos * pos_num).astype(np.int32)
+    rel_pos = np.clip(rel_pos, 0, pos_num - 1)
+
+    if ori_w != w or ori_h != h:
+        rel_pos = cv2.resize(rel_pos, (ori_w, ori_h), interpolation=cv2.INTER_NEAREST)
+        rel_pos[ori_mask == 0] = 0
+        direct = cv2.resize(direct, (ori_w, ori_h), interpolation=cv2.INTER_NEAREST)
+        direct[ori_mask == 0, :] = 0
+
+    return rel_pos, abs_pos, direct
+
+
+def _random_mask(rng, h, w):
+    mask = np.zeros((h, w), dtype=np.uint8)
+    for _ in range(4):
+        x, y = rng.randint(0, w), rng.randint(0, h)
+        size = rng.randint(10, max(h, w) // 2)
+        cv2.circle(mask, (x, y), size, 255, -1)
+    # a hole touching the border
+    mask[: h // 5, w // 3 : w // 2] = 255
+    return mask
+
+
+@pytest.mark.parametrize("size", [(256, 256), (512, 384), (300, 700)])
+def test_masked_position_encoding(size):
+    rng = np.random.RandomState(sum(size))
+    for _ in range(3):
+        mask = _random_mask(rng, *size)
+        expected = _loop_masked_position_encoding(mask.copy())
+        result = load_masked_position_encoding(mask.copy())
+        for it, expected_it in zip(result, expected):
+            assert it.dtype == expected_it.dtype
+            np.testing.assert_array_equal(it, expected_it)
+
+
+def test_masked_position_encoding_full_mask():
+    mask = np.full((300, 200), 255, dtype=np.uint8)
+    rel_pos, abs_pos, direct = load_masked_position_encoding(mask)
+    assert rel_pos.shape == (300, 200) and abs_pos.shape == (256, 256)
+    assert direct.shape == (300, 200, 4)
@@ -54,6 +54,7 @@ default_configs = dict(
     remove_bg_device=Device.cpu,
     remove_bg_model=RemoveBGModel.briaai_rmbg_1_4,
     enable_anime_seg=False,
+    anime_seg_device=Device.cpu,
     enable_realesrgan=False,
     realesrgan_device=Device.cpu,
     realesrgan_model=RealESRGANModel.realesr_general_x4v3,
@@ -103,6 +104,7 @@ def save_config(
     remove_bg_device,
     remove_bg_model,
     enable_anime_seg,
+    anime_seg_device,
     enable_realesrgan,
     realesrgan_device,
     realesrgan_model,
@@ -252,6 +254,11 @@ def main(config_file: Path):
                     enable_anime_seg = gr.Checkbox(
                         init_config.enable_anime_seg, label=ANIMESEG_HELP
                     )
+                    anime_seg_device = gr.Radio(
+                        Device.values(),
+                        label=ANIME_SEG_DEVICE_HELP,
+                        value=init_config.anime_seg_device,
+                    )
 
                 with gr.Row():
                     enable_realesrgan = gr.Checkbox(
@@ -314,6 +321,7 @@ def main(config_file: Path):
                 remove_bg_device,
                 remove_bg_model,
                 enable_anime_seg,
+                anime_seg_device,
                 enable_realesrgan,
                 realesrgan_device,
                 realesrgan_model,